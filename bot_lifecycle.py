@@ -15,6 +15,7 @@ from config import logger
 from src.utils.error_handler import error_handler
 from src.utils.error_monitor import cleanup_old_errors
 from src.utils.exceptions import ConfigurationError
+from src.ai.service import get_ai_service
 from src.bot.routers import register_handlers
 from src.core.template_manager import TemplateManager
 
@@ -48,6 +49,9 @@ class BotLifecycle:
             # Регистрация обработчиков
             self.routers = register_handlers(self.dp, self.template_manager)
 
+            # Фоновая загрузка базы знаний AI (не задерживает запуск polling)
+            await get_ai_service().start()
+
             # Очистка старых ошибок
             cleanup_old_errors(days=30)
 
@@ -138,6 +142,9 @@ class BotLifecycle:
             # Очищаем фабрику
             cleanup_bot_resources()
 
+            # Дописываем аналитику AI и закрываем соединения с OpenAI
+            await get_ai_service().aclose()
+
             # Сохраняем статистику если нужно
             if self.template_manager and self.template_manager.stats:
                 # Здесь можно добавить сохранение финальной статистики
@@ -43,6 +43,7 @@ class Config:
     AI_MODEL = os.getenv("AI_MODEL", "gpt-4o-mini")
     AI_TEMPERATURE = float(os.getenv("AI_TEMPERATURE", "0.1"))
     AI_MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", "1000"))
+    AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "32"))
 
     # RAG настройки
     SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.85"))
@@ -61,6 +62,18 @@ class Config:
         "yes",
     )
 
+    # Кэш ответов AI
+    AI_RESPONSE_CACHE_SIZE = int(os.getenv("AI_RESPONSE_CACHE_SIZE", "1024"))
+    AI_RESPONSE_CACHE_TTL = float(os.getenv("AI_RESPONSE_CACHE_TTL", "3600"))
+    # Семантический кэш выключен по умолчанию: модель эмбеддингов ChromaDB англоязычная,
+    # короткие украинские/русские вопросы о разных товарах для нее почти совпадают
+    AI_SEMANTIC_CACHE_ENABLED = os.getenv("AI_SEMANTIC_CACHE_ENABLED", "False").lower() in (
+        "true",
+        "1",
+        "yes",
+    )
+    AI_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("AI_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
     # Пути к CSV файлам для базы знаний
     VISITKI_CSV_PATH = os.getenv("VISITKI_CSV_PATH", "./data/templates/visitki_templates.csv")
     FUTBOLKI_CSV_PATH = os.getenv("FUTBOLKI_CSV_PATH", "./data/templates/futbolki_templates.csv")
@@ -347,6 +347,16 @@ class QuickCorrectionsService:
                 documents=[search_text], metadatas=[metadata], ids=[entry_id]
             )
 
+            # Список админских записей и записи категории изменились,
+            # сохраненные ответы AI могли устареть
+            from src.ai.service import invalidate_response_cache
+            from src.ai.smart_knowledge_updater import smart_updater
+            from src.ai.upselling_engine import upsell_engine
+
+            smart_updater.invalidate_admin_ids_cache()
+            upsell_engine.invalidate_category_cache()
+            invalidate_response_cache()
+
             logger.info(f"Добавлена админская запись {entry_id} в категорию {entry['category']}")
 
             return {"success": True, "entry_id": entry_id, "category": entry["category"]}
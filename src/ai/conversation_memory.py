@@ -7,6 +7,7 @@ import json
 import logging
 import os
 import time
+from itertools import islice
 from typing import Dict, List, Optional
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
@@ -47,16 +48,23 @@ class ConversationSession:
         """Возвращает последние N сообщений"""
         return self.messages[-limit:] if self.messages else []
 
-    def get_context_for_ai(self, max_messages: int = 6) -> List[Dict]:
-        """Формирует контекст для OpenAI API"""
-        recent_messages = self.get_recent_messages(max_messages)
+    def get_context_for_ai(self, max_messages: int = 6, exclude_last: bool = False) -> List[Dict]:
+        """
+        Формирует контекст для OpenAI API
 
-        # Конвертируем в формат OpenAI
-        context = []
-        for msg in recent_messages:
-            context.append({"role": msg.role, "content": msg.content})
+        Args:
+            max_messages: Сколько последних сообщений взять
+            exclude_last: Не включать последнее из них (текущий запрос пользователя)
+        """
+        end = len(self.messages)
+        start = max(end - max_messages, 0)
+        if exclude_last:
+            end = max(end - 1, start)
 
-        return context
+        # Конвертируем в формат OpenAI без промежуточных срезов списка
+        return [
+            {"role": msg.role, "content": msg.content} for msg in islice(self.messages, start, end)
+        ]
 
     def is_expired(self, timeout_hours: int = 24) -> bool:
         """Проверяет, истекла ли сессия"""
@@ -125,13 +133,15 @@ class ConversationMemory:
             self._save_session(session)
             logger.debug(f"Добавлен ответ ассистента для пользователя {user_id}: {message[:50]}...")
 
-    def get_conversation_context(self, user_id: int, max_messages: int = 6) -> List[Dict]:
+    def get_conversation_context(
+        self, user_id: int, max_messages: int = 6, exclude_last: bool = False
+    ) -> List[Dict]:
         """Получает контекст разговора для AI"""
         if user_id not in self.sessions:
             return []
 
         session = self.sessions[user_id]
-        return session.get_context_for_ai(max_messages)
+        return session.get_context_for_ai(max_messages, exclude_last)
 
     def clear_session(self, user_id: int):
         """Очищает сессию пользователя"""
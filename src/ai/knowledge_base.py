@@ -8,6 +8,8 @@ import logging
 import os
 from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+
 try:
     import chromadb
     from chromadb.config import Settings
@@ -19,6 +21,35 @@ from config import Config
 
 logger = logging.getLogger(__name__)
 
+# Метаданные новой коллекции. Параметры HNSW рассчитаны на первичную загрузку:
+# векторы копятся в буфере и попадают в граф одной партией, а не каждые 100 документов
+_COLLECTION_METADATA = {
+    "description": "Bot knowledge base from CSV templates",
+    "hnsw:batch_size": 5000,
+    "hnsw:sync_threshold": 5000,
+}
+
+# Значения ChromaDB по умолчанию для инкрементальных обновлений после загрузки
+_INCREMENTAL_HNSW_CONFIGURATION = {"hnsw": {"batch_size": 100, "sync_threshold": 1000}}
+
+# Бонус к релевантности за контекстное соответствие документа запросу
+_CONTEXT_MATCH_BONUS = {"exact": 0.3, "partial": 0.1}
+
+# Типы значений, которые ChromaDB принимает в метаданных без преобразования
+_CHROMA_SCALAR_TYPES = (str, int, float, bool)
+
+
+def _to_chroma_metadata(metadata: Dict) -> Dict:
+    """Приводит метаданные к плоским скалярным типам, которые ChromaDB сохраняет напрямую"""
+    return {
+        key: (
+            value
+            if isinstance(value, _CHROMA_SCALAR_TYPES)
+            else ("" if value is None else str(value))
+        )
+        for key, value in metadata.items()
+    }
+
 
 class KnowledgeBase:
     """Класс для работы с базой знаний из CSV файлов"""
@@ -65,10 +96,7 @@ class KnowledgeBase:
                 logger.info(f"Загружена существующая коллекция: {collection_name}")
             except Exception:
                 # Коллекция не существует, создаем новую
-                self.collection = self.chroma_client.create_collection(
-                    name=collection_name,
-                    metadata={"description": "Bot knowledge base from CSV templates"},
-                )
+                self.collection = self._create_collection()
                 logger.info(f"Создана новая коллекция: {collection_name}")
 
             self.is_initialized = True
@@ -78,6 +106,19 @@ class KnowledgeBase:
             logger.error(f"Ошибка инициализации ChromaDB: {e}")
             self.is_initialized = False
 
+    def _create_collection(self):
+        """Создает коллекцию с параметрами HNSW для пакетной загрузки"""
+        return self.chroma_client.create_collection(
+            name=self.config.CHROMA_COLLECTION_NAME, metadata=dict(_COLLECTION_METADATA)
+        )
+
+    def _finish_bulk_load(self):
+        """Возвращает параметры HNSW для инкрементальных обновлений после загрузки"""
+        try:
+            self.collection.modify(configuration=_INCREMENTAL_HNSW_CONFIGURATION)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить параметры HNSW коллекции: {e}")
+
     def load_csv_data(self) -> List[Dict]:
         """Загружает данные из всех CSV файлов"""
         all_data = []
@@ -165,8 +206,18 @@ class KnowledgeBase:
 
     def _is_valid_row(self, row: Dict) -> bool:
         """Проверяет валидность строки данных"""
-        required_fields = ["keywords", "answer_ukr", "answer_rus"]
-        return all(row.get(field, "").strip() for field in required_fields)
+        # Пустые значения отсекаются без вызова strip() - частый случай в разреженных CSV
+        keywords = row.get("keywords")
+        answer_ukr = row.get("answer_ukr")
+        answer_rus = row.get("answer_rus")
+        return bool(
+            keywords
+            and answer_ukr
+            and answer_rus
+            and keywords.strip()
+            and answer_ukr.strip()
+            and answer_rus.strip()
+        )
 
     def create_search_documents(self, data: List[Dict]) -> List[Dict]:
         """Создает документы для поиска, объединяя ключевые слова и ответы"""
@@ -189,15 +240,17 @@ class KnowledgeBase:
             doc = {
                 "id": item["id"],
                 "text": search_text,
-                "metadata": {
-                    "category": item["category"],
-                    "subcategory": item["subcategory"],
-                    "button_text": item["button_text"],
-                    "keywords": keywords,
-                    "answer_ukr": item["answer_ukr"],
-                    "answer_rus": item["answer_rus"],
-                    "sort_order": item["sort_order"],
-                },
+                "metadata": _to_chroma_metadata(
+                    {
+                        "category": item["category"],
+                        "subcategory": item["subcategory"],
+                        "button_text": item["button_text"],
+                        "keywords": keywords,
+                        "answer_ukr": item["answer_ukr"],
+                        "answer_rus": item["answer_rus"],
+                        "sort_order": item["sort_order"],
+                    }
+                ),
             }
             documents.append(doc)
 
@@ -220,10 +273,7 @@ class KnowledgeBase:
             if force_reload and collection_count > 0:
                 logger.info("Очистка существующей коллекции...")
                 self.chroma_client.delete_collection(self.config.CHROMA_COLLECTION_NAME)
-                self.collection = self.chroma_client.create_collection(
-                    name=self.config.CHROMA_COLLECTION_NAME,
-                    metadata={"description": "Bot knowledge base from CSV templates"},
-                )
+                self.collection = self._create_collection()
 
             # Загружаем данные из CSV
             csv_data = self.load_csv_data()
@@ -241,6 +291,7 @@ class KnowledgeBase:
 
             # Добавляем документы в коллекцию
             self.collection.add(documents=texts, metadatas=metadatas, ids=ids)
+            self._finish_bulk_load()
 
             logger.info(f"Успешно добавлено {len(documents)} документов в векторную базу данных")
             return True
@@ -249,6 +300,13 @@ class KnowledgeBase:
             logger.error(f"Ошибка при заполнении векторной базы: {e}")
             return False
 
+    def embed_texts(self, texts: List[str]) -> Optional[List]:
+        """Вычисляет эмбеддинги той же моделью, что используется для векторного поиска"""
+        embedding_function = getattr(self.collection, "_embedding_function", None)
+        if embedding_function is None:
+            return None
+        return embedding_function(texts)
+
     def search_by_keywords(
         self, query: str, language: str = "ukr", n_results: int = 3
     ) -> List[Dict]:
@@ -267,50 +325,63 @@ class KnowledgeBase:
             # Анализируем контекст запроса
             query_intent = self._analyze_query_intent(query)
 
-            # Ищем совпадения по ключевым словам
-            matches = []
-            for i, (doc_id, metadata) in enumerate(zip(all_docs["ids"], all_docs["metadatas"])):
+            # Отбираем кандидатов: сначала дешевое пересечение слов,
+            # контекстный анализ только для документов с совпадениями
+            candidates = []
+            overlaps = []
+            bonuses = []
+            for doc_id, metadata in zip(all_docs["ids"], all_docs["metadatas"]):
                 keywords = metadata.get("keywords", "").lower()
+                keyword_words = set(keywords.replace(",", " ").split())
+
+                # Считаем количество совпадающих слов
+                overlap = len(query_words.intersection(keyword_words))
+                if not overlap:
+                    continue
+
                 answer = metadata.get(f"answer_{language}", metadata.get("answer_ukr", ""))
 
                 # Проверяем контекстное соответствие
                 context_match = self._check_context_match(query, query_intent, keywords, answer)
-
                 if not context_match:
                     continue
 
-                keyword_words = set(word.strip() for word in keywords.replace(",", " ").split())
+                candidates.append((doc_id, metadata, answer, context_match))
+                overlaps.append(overlap)
+                # Повышаем релевантность за контекстное соответствие
+                bonuses.append(_CONTEXT_MATCH_BONUS.get(context_match, 0.0))
 
-                # Считаем количество совпадающих слов
-                intersection = query_words.intersection(keyword_words)
-                if intersection:
-                    match_score = len(intersection) / len(query_words)  # Доля совпавших слов
+            if not candidates:
+                return []
 
-                    # Повышаем релевантность за контекстное соответствие
-                    if context_match == "exact":
-                        match_score += 0.3
-                    elif context_match == "partial":
-                        match_score += 0.1
+            # Доля совпавших слов + бонус, одним проходом по всем кандидатам
+            scores = np.asarray(overlaps, dtype=np.float64) / len(query_words)
+            scores += np.asarray(bonuses, dtype=np.float64)
 
-                    # Добавляем ID в метаданные для комбинирования
-                    metadata_with_id = dict(metadata)
-                    metadata_with_id["id"] = doc_id
+            # Стабильная сортировка сохраняет порядок документов при равной релевантности
+            top_indices = np.argsort(-scores, kind="stable")[:n_results]
 
-                    matches.append(
-                        {
-                            "category": metadata.get("category", ""),
-                            "keywords": metadata.get("keywords", ""),
-                            "answer": answer,
-                            "relevance_score": match_score,
-                            "metadata": metadata_with_id,
-                            "search_type": "keyword",
-                            "context_match": context_match,
-                        }
-                    )
+            matches = []
+            for idx in top_indices:
+                doc_id, metadata, answer, context_match = candidates[idx]
+
+                # Добавляем ID в метаданные для комбинирования
+                metadata_with_id = dict(metadata)
+                metadata_with_id["id"] = doc_id
+
+                matches.append(
+                    {
+                        "category": metadata.get("category", ""),
+                        "keywords": metadata.get("keywords", ""),
+                        "answer": answer,
+                        "relevance_score": float(scores[idx]),
+                        "metadata": metadata_with_id,
+                        "search_type": "keyword",
+                        "context_match": context_match,
+                    }
+                )
 
-            # Сортируем по релевантности и возвращаем топ результаты
-            matches.sort(key=lambda x: x["relevance_score"], reverse=True)
-            return matches[:n_results]
+            return matches
 
         except Exception as e:
             logger.error(f"Ошибка при поиске по ключевым словам: {e}")
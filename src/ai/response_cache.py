@@ -0,0 +1,196 @@
+"""
+Кэш ответов AI сервиса
+Точное совпадение нормализованного запроса (LRU) + семантическое совпадение по эмбеддингам
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    # Только для аннотаций: service импортирует этот модуль
+    from src.ai.service import AIResult
+
+logger = logging.getLogger(__name__)
+
+# Ключ кэша: (язык, хэш нормализованного запроса)
+CacheKey = Tuple[str, str]
+
+# Группа семантического уровня: (язык, тема запроса). Близость ищется только внутри группы:
+# короткие вопросы о разных товарах почти совпадают по эмбеддингу
+SemanticGroup = Tuple[str, str]
+
+# Результат семантического поиска для put: (группа, нормированный эмбеддинг запроса)
+SemanticProbe = Tuple[SemanticGroup, np.ndarray]
+
+
+def normalize_query(query: str) -> str:
+    """Нормализует запрос: нижний регистр и схлопывание пробелов"""
+    return " ".join(query.lower().split())
+
+
+class ResponseCache:
+    """Двухуровневый кэш ответов: точный LRU и семантический по косинусной близости"""
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        similarity_threshold: float = 0.95,
+        embedding_function: Optional[Callable[[List[str]], List]] = None,
+        ttl: float = 3600.0,
+        scope_function: Optional[Callable[[str], str]] = None,
+    ):
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self.embedding_function = embedding_function
+        # Тема запроса (например, товар) для группы семантического уровня
+        self.scope_function = scope_function
+        # Сколько секунд ответ считается актуальным (цены и тексты в базе знаний меняются)
+        self.ttl = ttl
+
+        # Точный уровень: порядок вставки = порядок использования (LRU),
+        # значение - (время сохранения по time.monotonic(), ответ)
+        self._exact: "OrderedDict[CacheKey, Tuple[float, AIResult]]" = OrderedDict()
+
+        # Семантический уровень: по группе кольцевой буфер нормированных эмбеддингов
+        # и время сохранения каждой строки
+        self._vectors: Dict[SemanticGroup, np.ndarray] = {}
+        self._vector_times: Dict[SemanticGroup, np.ndarray] = {}
+        self._vector_results: Dict[SemanticGroup, List[Optional["AIResult"]]] = {}
+        self._vector_cursor: Dict[SemanticGroup, int] = {}
+        self._vector_count: Dict[SemanticGroup, int] = {}
+
+        # clear() вызывается из потоков обновления базы знаний, остальные операции -
+        # из цикла событий: состояние уровней меняется и читается под блокировкой
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(query: str, language: str) -> CacheKey:
+        """Создает ключ кэша для запроса"""
+        digest = hashlib.blake2b(normalize_query(query).encode("utf-8"), digest_size=16)
+        return language, digest.hexdigest()
+
+    def get(self, key: CacheKey) -> Optional["AIResult"]:
+        """Ищет ответ по точному совпадению нормализованного запроса"""
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                # Устаревший ответ удаляется, запрос уйдет в OpenAI заново
+                del self._exact[key]
+                return None
+
+            self._exact.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    async def get_similar(
+        self, query: str, language: str
+    ) -> Tuple[Optional["AIResult"], Optional[SemanticProbe]]:
+        """
+        Ищет ответ на семантически близкий запрос того же языка и той же темы
+
+        Returns:
+            (найденный ответ или None, группа и эмбеддинг запроса для последующего put)
+        """
+        if self.embedding_function is None:
+            self.misses += 1
+            return None, None
+
+        embedding = await asyncio.to_thread(self._embed, query)
+        if embedding is None:
+            self.misses += 1
+            return None, None
+
+        scope = self.scope_function(query) if self.scope_function is not None else ""
+        group = (language, scope)
+        with self._lock:
+            count = self._vector_count.get(group, 0)
+            if count:
+                # Одно матричное умножение вместо цикла по всем сохраненным запросам,
+                # устаревшие ответы исключаются из выбора
+                similarities = self._vectors[group][:count] @ embedding
+                expired = self._vector_times[group][:count] <= time.monotonic() - self.ttl
+                similarities[expired] = -np.inf
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self.semantic_hits += 1
+                    return self._vector_results[group][best], (group, embedding)
+
+        self.misses += 1
+        return None, (group, embedding)
+
+    def put(self, key: CacheKey, result: "AIResult", probe: Optional[SemanticProbe] = None):
+        """Сохраняет ответ в кэш (с результатом get_similar - и в семантический уровень)"""
+        with self._lock:
+            self._exact[key] = (time.monotonic(), result)
+            self._exact.move_to_end(key)
+            if len(self._exact) > self.max_size:
+                self._exact.popitem(last=False)
+
+            if probe is not None:
+                self._put_vector(*probe, result)
+
+    def clear(self):
+        """Очищает кэш (например, после обновления базы знаний)"""
+        with self._lock:
+            self._exact.clear()
+            self._vectors.clear()
+            self._vector_times.clear()
+            self._vector_results.clear()
+            self._vector_cursor.clear()
+            self._vector_count.clear()
+
+    def get_stats(self) -> Dict:
+        """Статистика использования кэша"""
+        with self._lock:
+            return {
+                "size": len(self._exact),
+                "semantic_size": sum(self._vector_count.values()),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
+
+    def _embed(self, query: str) -> Optional[np.ndarray]:
+        """Вычисляет нормированный эмбеддинг запроса"""
+        try:
+            vector = np.asarray(
+                self.embedding_function([normalize_query(query)])[0], dtype=np.float32
+            )
+        except Exception as e:
+            logger.warning(f"Семантический кэш отключен, ошибка эмбеддинга: {e}")
+            self.embedding_function = None
+            return None
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _put_vector(self, group: SemanticGroup, embedding: np.ndarray, result: "AIResult"):
+        """Добавляет эмбеддинг в кольцевой буфер группы, вытесняя самый старый (под блокировкой)"""
+        vectors = self._vectors.get(group)
+        if vectors is None or vectors.shape[1] != embedding.shape[0]:
+            vectors = np.zeros((self.max_size, embedding.shape[0]), dtype=np.float32)
+            self._vectors[group] = vectors
+            self._vector_times[group] = np.zeros(self.max_size, dtype=np.float64)
+            self._vector_results[group] = [None] * self.max_size
+            self._vector_cursor[group] = 0
+            self._vector_count[group] = 0
+
+        cursor = self._vector_cursor[group]
+        vectors[cursor] = embedding
+        self._vector_times[group][cursor] = time.monotonic()
+        self._vector_results[group][cursor] = result
+        self._vector_cursor[group] = (cursor + 1) % self.max_size
+        self._vector_count[group] = min(self._vector_count[group] + 1, self.max_size)
@@ -3,28 +3,267 @@ AI сервис для обработки запросов пользовате
 Retrieval-Augmented Generation с векторным поиском по базе знаний
 """
 
+import functools
 import logging
 import asyncio
+import re
 import time
-from typing import Dict, Optional
+from dataclasses import dataclass, field, fields, replace
+from types import MappingProxyType
+from typing import (
+    AsyncIterator,
+    Dict,
+    Final,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Pattern,
+    Tuple,
+    TypedDict,
+)
 
 try:
+    import httpx
     import openai
     from openai import AsyncOpenAI
 except ImportError:
+    httpx = None
     openai = None
     AsyncOpenAI = None
 
+try:
+    import h2  # noqa: F401 - нужен httpx для HTTP/2
+
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
 from src.core.business_hours import is_business_time
 from src.ai.knowledge_base import knowledge_base
 from src.ai.rag_service import rag_service
 from src.ai.conversation_memory import conversation_memory
+from src.ai.response_cache import CacheKey, ResponseCache
 from src.analytics.analytics_service import analytics_service
 from config import Config
 
 
 logger = logging.getLogger(__name__)
 
+# Поддерживаемые языки ответов
+Language = Literal["ukr", "rus"]
+
+
+def _freeze(table: Dict[str, Dict]) -> Mapping[str, Mapping]:
+    """Оборачивает двухуровневый словарь в представления только для чтения"""
+    return MappingProxyType({key: MappingProxyType(value) for key, value in table.items()})
+
+
+# Ключевые слова mock-режима по категориям ответов (порядок категорий = приоритет).
+# Неизменяемые и создаются один раз при импорте, а не при каждом вызове
+_MOCK_KEYWORDS: Final[Mapping[str, Mapping[str, Tuple[str, ...]]]] = _freeze(
+    {
+        "ukr": {
+            "price": (
+                "ціна",
+                "цін",
+                "коштує",
+                "коштують",
+                "стоїть",
+                "стоять",
+                "вартість",
+                "тариф",
+            ),
+            "design": ("макет", "дизайн", "файл", "psd", "ai", "pdf", "png"),
+            "timeline": (
+                "терміни",
+                "термін",
+                "час",
+                "швидко",
+                "скоро",
+                "виготовлення",
+                "готовий",
+                "готові",
+            ),
+            "quality": ("якість", "матеріал", "друк", "поліграфія", "качество"),
+            "tshirts": ("футболка", "футболки", "майка", "майки", "одяг"),
+        },
+        "rus": {
+            "price": ("цена", "цен", "стоит", "стоят", "стоимость", "тариф"),
+            "design": ("макет", "дизайн", "файл", "psd", "ai", "pdf", "png"),
+            "timeline": (
+                "сроки",
+                "срок",
+                "время",
+                "быстро",
+                "скоро",
+                "изготовление",
+                "готов",
+                "готовы",
+            ),
+            "quality": ("качество", "материал", "печать", "полиграфия"),
+            "tshirts": ("футболка", "футболки", "майка", "майки", "одежда"),
+        },
+    }
+)
+
+# Ответы mock-режима по категориям
+_MOCK_RESPONSES: Final[Mapping[str, Mapping[str, str]]] = _freeze(
+    {
+        "ukr": {
+            "price": "🔸 Ціни на нашу продукцію залежать від тиражу та складності.\n\n"
+            "📋 Візитки: від 50 грн за 100 шт\n"
+            "👕 Футболки: від 200 грн\n"
+            "📄 Листівки: від 80 грн за 100 шт\n\n"
+            "📞 Для точного розрахунку зверніться до менеджера!",
+            "design": "🎨 Щодо макетів:\n\n"
+            "✅ Приймаємо файли: AI, PSD, PDF, PNG (300+ dpi)\n"
+            "✅ Безкоштовна корекція макету\n"
+            "✅ Можемо створити макет з нуля\n\n"
+            "📞 Надішліть ваш макет менеджеру для перевірки!",
+            "timeline": "⏰ Терміни виготовлення:\n\n"
+            "📋 Візитки: 1-2 дні\n"
+            "👕 Футболки: 2-3 дні\n"
+            "📄 Листівки: 1-2 дні\n\n"
+            "⚡ Є експрес-виготовлення за доплату!",
+            "tshirts": "👕 Про футболки:\n\n"
+            "💰 Ціна: від 200 грн\n"
+            "⏰ Терміни: 2-3 дні\n"
+            "🎨 Друк: цифровий, шовкографія\n"
+            "📏 Розміри: XS-5XL\n\n"
+            "📞 Для детальної консультації зверніться до менеджера!",
+            "quality": "🏆 Якість нашої продукції:\n\n"
+            "✅ Преміум матеріали\n"
+            "✅ Професійне обладнання\n"
+            "✅ Контроль якості на всіх етапах\n"
+            "✅ Гарантія на всі роботи\n\n"
+            "📞 Маємо сертифікати якості - питайте у менеджера!",
+        },
+        "rus": {
+            "price": "🔸 Цены на нашу продукцию зависят от тиража и сложности.\n\n"
+            "📋 Визитки: от 50 грн за 100 шт\n"
+            "👕 Футболки: от 200 грн\n"
+            "📄 Листовки: от 80 грн за 100 шт\n\n"
+            "📞 Для точного расчета обратитесь к менеджеру!",
+            "design": "🎨 По макетам:\n\n"
+            "✅ Принимаем файлы: AI, PSD, PDF, PNG (300+ dpi)\n"
+            "✅ Бесплатная коррекция макета\n"
+            "✅ Можем создать макет с нуля\n\n"
+            "📞 Отправьте ваш макет менеджеру для проверки!",
+            "timeline": "⏰ Сроки изготовления:\n\n"
+            "📋 Визитки: 1-2 дня\n"
+            "👕 Футболки: 2-3 дня\n"
+            "📄 Листовки: 1-2 дня\n\n"
+            "⚡ Есть экспресс-изготовление за доплату!",
+            "tshirts": "👕 О футболках:\n\n"
+            "💰 Цена: от 200 грн\n"
+            "⏰ Сроки: 2-3 дня\n"
+            "🎨 Печать: цифровая, шелкография\n"
+            "📏 Размеры: XS-5XL\n\n"
+            "📞 Для детальной консультации обратитесь к менеджеру!",
+            "quality": "🏆 Качество нашей продукции:\n\n"
+            "✅ Премиум материалы\n"
+            "✅ Профессиональное оборудование\n"
+            "✅ Контроль качества на всех этапах\n"
+            "✅ Гарантия на все работы\n\n"
+            "📞 У нас есть сертификаты качества - спрашивайте у менеджера!",
+        },
+    }
+)
+
+# Запросы короче этого (без пробелов по краям) не обрабатываются
+_MIN_QUERY_LENGTH: Final[int] = 2
+
+# Запрос только из знаков препинания, эмодзи и пробелов
+_NON_TEXT_QUERY_RE: Final[Pattern[str]] = re.compile(r"[\W_]+")
+
+# Сколько запрос ждет окончания фоновой загрузки базы знаний (секунды)
+_KNOWLEDGE_BASE_WAIT_TIMEOUT: Final[float] = 0.05
+
+# Эмодзи форматирования ответа (все - одиночные code point, поэтому проверка
+# по символам ответа за один проход эквивалентна поиску подстрок)
+_FORMATTING_EMOJI: Final[frozenset[str]] = frozenset(["🔸", "📋", "👕", "📄", "💰", "⏰"])
+
+# Fallback ответы: (язык, техническая ошибка, рабочее время) -> текст
+_FALLBACK_INTROS: Final[Mapping[Tuple[str, bool], str]] = MappingProxyType(
+    {
+        ("ukr", True): "😔 Вибачте, сталася технічна помилка з AI-помічником.\n\n",
+        ("ukr", False): "🤔 На жаль, я не знайшов точної відповіді на ваше питання.\n\n",
+        ("rus", True): "😔 Извините, произошла техническая ошибка с AI-помощником.\n\n",
+        ("rus", False): "🤔 К сожалению, я не нашел точного ответа на ваш вопрос.\n\n",
+    }
+)
+_FALLBACK_MANAGER_NOTES: Final[Mapping[Tuple[str, bool], str]] = MappingProxyType(
+    {
+        ("ukr", True): "📞 Наш менеджер зараз онлайн і обов'язково вам допоможе!",
+        ("ukr", False): "📞 Наш менеджер зв'яжеться з вами найближчим часом!",
+        ("rus", True): "📞 Наш менеджер сейчас онлайн и обязательно вам поможет!",
+        ("rus", False): "📞 Наш менеджер свяжется с вами в ближайшее время!",
+    }
+)
+_FALLBACK_MESSAGES: Final[Mapping[Tuple[str, bool, bool], str]] = MappingProxyType(
+    {
+        (language, error, is_work_time): (
+            _FALLBACK_INTROS[language, error] + _FALLBACK_MANAGER_NOTES[language, is_work_time]
+        )
+        for language in ("ukr", "rus")
+        for error in (True, False)
+        for is_work_time in (True, False)
+    }
+)
+
+# Как долго переиспользуется результат проверки рабочего времени (секунды)
+_BUSINESS_TIME_TTL: Final[float] = 60.0
+
+# Предкомпилированные шаблоны: одна альтернация ключевых слов на категорию.
+# Совпадение по подстроке, как и при проверке `word in query`
+_MOCK_KEYWORD_PATTERNS: Final[Dict[str, Tuple[Tuple[str, Pattern[str]], ...]]] = {
+    language: tuple(
+        (response_type, re.compile("|".join(map(re.escape, words))))
+        for response_type, words in categories.items()
+    )
+    for language, categories in _MOCK_KEYWORDS.items()
+}
+
+
+class AIResultDict(TypedDict, total=False):
+    """Результат обработки запроса в виде словаря (публичный формат process_query)"""
+
+    success: bool
+    answer: str
+    confidence: float
+    source: str
+    should_contact_manager: bool
+    context_used: str
+    search_type: str
+    relevance_scores: List[float]
+    response_time_ms: int
+
+
+@dataclass(slots=True)
+class AIResult:
+    """Результат обработки запроса внутри сервиса"""
+
+    success: bool
+    answer: str
+    confidence: float = 0.0
+    source: str = "unknown"  # "ai", "ai_cache", "template" или "fallback"
+    should_contact_manager: bool = False
+    context_used: str = ""
+    search_type: str = ""
+    relevance_scores: List[float] = field(default_factory=list)
+    response_time_ms: int = 0
+
+    def to_dict(self) -> AIResultDict:
+        """Преобразует результат в словарь для обратной совместимости"""
+        return {item.name: getattr(self, item.name) for item in fields(self)}
+
+
+@functools.lru_cache(maxsize=256)
+def _build_system_prompt(language: str, context: str) -> str:
+    """Системный промпт зависит только от языка и контекста - кэшируем готовые строки"""
+    return rag_service.create_system_prompt(language, context)
+
 
 class AIService:
     """Сервис для AI-обработки запросов пользователей"""
@@ -34,17 +273,45 @@ class AIService:
         self.enabled = self.config.AI_ENABLED
         self.fallback_to_templates = self.config.AI_FALLBACK_TO_TEMPLATES
 
+        # Параметры генерации не меняются во время работы - читаем их один раз
+        self._model = self.config.AI_MODEL
+        self._max_tokens = self.config.AI_MAX_TOKENS
+        self._temperature = self.config.AI_TEMPERATURE
+
         # Инициализация OpenAI клиента
         self.openai_client: Optional[AsyncOpenAI] = None
+        self._http_client = None
+        self._openai_create = None
         self.use_real_ai = False
 
+        # Ограничиваем число одновременных запросов к OpenAI размером пула соединений:
+        # при всплесках нагрузки запросы ждут свободное соединение, а не открывают новые
+        max_concurrency = self.config.AI_MAX_CONCURRENCY
+        self._openai_semaphore = asyncio.Semaphore(max_concurrency)
+
         if self.enabled and openai and self.config.OPENAI_API_KEY:
             try:
-                self.openai_client = AsyncOpenAI(api_key=self.config.OPENAI_API_KEY, timeout=30.0)
+                # Один постоянный HTTP клиент на весь процесс: соединения (и TLS сессии)
+                # переиспользуются, HTTP/2 мультиплексирует запросы в одном соединении
+                self._http_client = httpx.AsyncClient(
+                    http2=_HTTP2_AVAILABLE,
+                    limits=httpx.Limits(
+                        max_connections=max_concurrency,
+                        max_keepalive_connections=max_concurrency,
+                        keepalive_expiry=300,
+                    ),
+                    timeout=httpx.Timeout(30.0, connect=5.0),
+                )
+                self.openai_client = AsyncOpenAI(
+                    api_key=self.config.OPENAI_API_KEY,
+                    timeout=30.0,
+                    http_client=self._http_client,
+                )
+                self._openai_create = self.openai_client.chat.completions.create
                 self.use_real_ai = True
                 logger.info("AI Service инициализирован с реальным OpenAI API")
-            except Exception as e:
-                logger.error(f"Ошибка инициализации OpenAI: {e}")
+            except Exception:
+                logger.exception("Ошибка инициализации OpenAI")
                 self.use_real_ai = False
                 logger.info("AI Service работает в mock режиме")
 
@@ -52,46 +319,87 @@ class AIService:
         self.knowledge_base = knowledge_base
         self.knowledge_ready = False
 
+        # Кэш ответов OpenAI (точный + семантический на эмбеддингах базы знаний);
+        # семантическое совпадение ищется только среди запросов о том же товаре/теме
+        self.response_cache = ResponseCache(
+            max_size=self.config.AI_RESPONSE_CACHE_SIZE,
+            ttl=self.config.AI_RESPONSE_CACHE_TTL,
+            similarity_threshold=self.config.AI_SEMANTIC_CACHE_THRESHOLD,
+            embedding_function=(
+                self.knowledge_base.embed_texts if self.config.AI_SEMANTIC_CACHE_ENABLED else None
+            ),
+            scope_function=analytics_service.classify_query_category,
+        )
+
+        # База знаний загружается в фоновом потоке после start()
+        self._kb_task: Optional[asyncio.Task] = None
+
+        # Последняя проверка рабочего времени: (time.monotonic(), результат)
+        self._business_time_cache: Tuple[float, bool] = (-_BUSINESS_TIME_TTL, False)
+
+        # Доступность вычисляется один раз: настройки и клиент не меняются во время работы
+        self._available = False
+        self.invalidate_availability()
+
         if self.enabled:
-            # Загружаем базу знаний в фоновом режиме
-            self._init_knowledge_base()
             mode = "REAL OpenAI" if self.use_real_ai else "MOCK"
-            kb_status = "with Knowledge Base" if self.knowledge_ready else "without Knowledge Base"
-            logger.info(f"AI Service инициализирован в режиме: ENABLED ({mode}) {kb_status}")
+            logger.info("AI Service инициализирован в режиме: ENABLED (%s)", mode)
         else:
             logger.info("AI Service инициализирован в режиме: DISABLED (fallback to templates)")
 
+    async def start(self):
+        """Запускает загрузку базы знаний в фоновом потоке, не блокируя event loop"""
+        if not self.enabled or self._kb_task is not None:
+            return
+
+        self._kb_task = asyncio.create_task(asyncio.to_thread(self._init_knowledge_base))
+
+    async def _wait_knowledge_base(self) -> bool:
+        """Ждет загрузку базы знаний не дольше короткого таймаута, True - если загрузка завершена"""
+        if self._kb_task is None:
+            await self.start()
+
+        if not self._kb_task.done():
+            # asyncio.wait не отменяет задачу по таймауту, в отличие от wait_for
+            await asyncio.wait({self._kb_task}, timeout=_KNOWLEDGE_BASE_WAIT_TIMEOUT)
+
+        return self._kb_task.done()
+
     def _init_knowledge_base(self):
-        """Инициализация базы знаний"""
+        """Инициализация базы знаний (выполняется в отдельном потоке)"""
         try:
             # Загружаем векторную базу знаний
             success = self.knowledge_base.populate_vector_store()
             if success:
                 self.knowledge_ready = True
                 stats = self.knowledge_base.get_statistics()
-                logger.info(f"База знаний готова: {stats.get('total_documents', 0)} документов")
+                logger.info("База знаний готова: %s документов", stats.get("total_documents", 0))
             else:
                 logger.warning("Не удалось инициализировать базу знаний")
-        except Exception as e:
-            logger.error(f"Ошибка инициализации базы знаний: {e}")
+        except Exception:
+            logger.exception("Ошибка инициализации базы знаний")
 
     def is_available(self) -> bool:
         """Проверяет доступность AI сервиса"""
-        if not self.enabled:
-            return False
+        return self._available
 
-        # Для mock режима всегда доступен
-        if not self.use_real_ai:
-            return True
-
-        # Для реального AI проверяем клиент
-        if not self.openai_client or not self.config.OPENAI_API_KEY:
+    def invalidate_availability(self):
+        """Пересчитывает доступность (после смены ключа API, клиента или режима работы)"""
+        if not self.enabled:
+            self._available = False
+        elif not self.use_real_ai:
+            # Для mock режима всегда доступен
+            self._available = True
+        elif not self.openai_client or not self.config.OPENAI_API_KEY:
+            # Для реального AI проверяем клиент
             logger.warning("AI Service недоступен: проблемы с OpenAI API")
-            return False
-
-        return True
+            self._available = False
+        else:
+            self._available = True
 
-    async def process_query(self, user_query: str, user_id: int, language: str = None) -> Dict:
+    async def process_query(
+        self, user_query: str, user_id: int, language: Optional[Language] = None
+    ) -> AIResultDict:
         """
         Обрабатывает запрос пользователя
 
@@ -101,327 +409,510 @@ class AIService:
             language: Язык ответа ("ukr" или "rus", None для автоопределения)
 
         Returns:
-            Dict с результатом обработки:
+            Dict с результатом обработки (поля AIResult):
             {
                 "success": bool,
                 "answer": str,
                 "confidence": float,
-                "source": str,  # "ai" или "template" или "fallback"
-                "should_contact_manager": bool
+                "source": str,  # "ai", "ai_cache", "template" или "fallback"
+                "should_contact_manager": bool,
+                ...
             }
         """
-        start_time = time.time()
+        rejection_reason = self._get_rejection_reason(user_query)
+        if rejection_reason:
+            analytics_service.log_rejected(user_id, rejection_reason)
+            language = self._resolve_language(user_id, language)
+            return self._create_fallback_response(language).to_dict()
+
+        start_ns = time.perf_counter_ns()
         query_id = None
 
         try:
-            # Автоопределяем язык если не задан
-            if language is None:
-                from src.core.template_manager import TemplateManager
+            language, query_id = self._start_query(user_query, user_id, language)
+
+            # Если AI отключен, сразу возвращаем fallback
+            if self.is_available():
+                result = await self._answer_query(user_query, user_id, language)
+            else:
+                result = self._create_fallback_response(language)
+
+        except Exception:
+            logger.exception("Ошибка при обработке AI запроса")
+            result = self._create_fallback_response(language, error=True)
 
-                temp_manager = TemplateManager()
-                language = temp_manager.get_user_language(user_id, auto_detect_text=user_query)
-                logger.info(f"Автоопределен язык для запроса пользователя {user_id}: {language}")
+        # Единая точка выхода: аналитика логируется ровно один раз
+        self._log_response_analytics(query_id, result, start_ns)
+        return result.to_dict()
 
-            logger.info(f"Обработка AI запроса от пользователя {user_id}: {user_query[:100]}...")
+    async def process_query_stream(
+        self, user_query: str, user_id: int, language: Optional[Language] = None
+    ) -> AsyncIterator[str]:
+        """
+        Обрабатывает запрос пользователя, отдавая ответ фрагментами по мере генерации
 
-            # 1. Логируем начало обработки запроса
-            query_id = analytics_service.log_user_query(user_id, user_query, language)
+        Ответ OpenAI передается частями по мере генерации, начиная с первого эмодзи
+        форматирования (ответ без них отдается в конце с эмодзи, как в process_query);
+        остальные ответы (кэш, mock, fallback) - одним фрагментом. Кэш, память разговора
+        и аналитика обновляются так же, как в process_query.
 
-            # Добавляем сообщение пользователя в память
-            conversation_memory.add_user_message(user_id, user_query, language)
+        Args:
+            user_query: Текст запроса пользователя
+            user_id: ID пользователя
+            language: Язык ответа ("ukr" или "rus", None для автоопределения)
+
+        Yields:
+            Фрагменты текста ответа
+        """
+        rejection_reason = self._get_rejection_reason(user_query)
+        if rejection_reason:
+            analytics_service.log_rejected(user_id, rejection_reason)
+            language = self._resolve_language(user_id, language)
+            yield self._create_fallback_response(language).answer
+            return
+
+        start_ns = time.perf_counter_ns()
+        query_id = None
+        streamed = False
+        result = None
+
+        try:
+            language, query_id = self._start_query(user_query, user_id, language)
 
-            # Если AI отключен, сразу возвращаем fallback
             if not self.is_available():
                 result = self._create_fallback_response(language)
-                self._log_response_analytics(query_id, result, start_time)
-                return result
-
-            # Если используем реальный AI - пробуем его
-            if self.use_real_ai:
-                ai_result = await self._process_with_openai(user_query, user_id, language)
-                if ai_result["success"]:
+            else:
+                if self.use_real_ai:
+                    result, cache_key, cache_probe = await self._get_cached_response(
+                        user_query, user_id, language
+                    )
+
+                    if result is None:
+                        knowledge_loaded = await self._wait_knowledge_base()
+                        outcome: List[AIResult] = []
+                        async for chunk in self._stream_with_openai(
+                            user_query, user_id, language, knowledge_loaded, outcome
+                        ):
+                            streamed = True
+                            yield chunk
+
+                        result = outcome[0]
+                        if result.success:
+                            # Ответ без базы знаний (она еще загружается) не кэшируется
+                            if cache_key and knowledge_loaded:
+                                self.response_cache.put(cache_key, result, cache_probe)
+                        elif not streamed:
+                            logger.warning("OpenAI запрос неуспешен, переходим на mock")
+                            result = None
+
+                # Fallback на mock ответы
+                if result is None:
+                    result = self._create_mock_ai_response(user_query, language)
+
+                if result.success:
                     # Сохраняем ответ ассистента в память
-                    conversation_memory.add_assistant_message(user_id, ai_result["answer"])
-                    self._log_response_analytics(query_id, ai_result, start_time)
-                    return ai_result
-                else:
-                    logger.warning("OpenAI запрос неуспешен, переходим на mock")
+                    conversation_memory.add_assistant_message(user_id, result.answer)
 
-            # Fallback на mock ответы
-            mock_result = self._create_mock_ai_response(user_query, language)
-            if mock_result["success"]:
-                # Сохраняем mock ответ в память
-                conversation_memory.add_assistant_message(user_id, mock_result["answer"])
+        except Exception:
+            logger.exception("Ошибка при потоковой обработке AI запроса")
+            result = self._create_fallback_response(language, error=True)
 
-            self._log_response_analytics(query_id, mock_result, start_time)
-            return mock_result
+        if not streamed:
+            yield result.answer
 
-        except Exception as e:
-            logger.error(f"Ошибка при обработке AI запроса: {e}")
-            result = self._create_fallback_response(language, error=True)
-            if query_id:
-                self._log_response_analytics(query_id, result, start_time)
-            return result
+        self._log_response_analytics(query_id, result, start_ns)
 
-    async def _process_with_openai(self, user_query: str, user_id: int, language: str) -> Dict:
-        """Обработка запроса через реальный OpenAI API с использованием базы знаний"""
-        start_time = time.time()
-        try:
-            context = await rag_service.get_context_for_query(user_query, language)
+    def _start_query(
+        self, user_query: str, user_id: int, language: Optional[Language]
+    ) -> Tuple[Language, int]:
+        """
+        Начинает обработку запроса: определяет язык, логирует запрос и сохраняет его в память
+
+        Returns:
+            (язык ответа, ID запроса в аналитике)
+        """
+        # Автоопределяем язык если не задан
+        if language is None:
+            language = self._resolve_language(user_id, language, user_query)
+            logger.info("Автоопределен язык для запроса пользователя %s: %s", user_id, language)
+
+        # %.100s обрезает запрос только если сообщение действительно будет записано
+        logger.info("Обработка AI запроса от пользователя %s: %.100s...", user_id, user_query)
 
-            # Создаем системный промпт с контекстом из базы знаний
-            system_prompt = rag_service.create_system_prompt(language, context)
+        # 1. Логируем начало обработки запроса
+        query_id = analytics_service.log_user_query(user_id, user_query, language)
 
-            # Получаем историю разговора
-            conversation_history = conversation_memory.get_conversation_context(
-                user_id, max_messages=6
+        # Добавляем сообщение пользователя в память
+        conversation_memory.add_user_message(user_id, user_query, language)
+
+        return language, query_id
+
+    def _resolve_language(
+        self, user_id: int, language: Optional[Language], auto_detect_text: Optional[str] = None
+    ) -> Language:
+        """
+        Возвращает язык ответа: заданный явно, определенный по тексту или сохраненный
+
+        Для отклоненных запросов текст не передается: по пустому запросу или эмодзи язык не
+        определить, поэтому берется последний определенный язык пользователя.
+        """
+        if language is not None:
+            return language
+
+        from src.core.template_manager import TemplateManager
+
+        return TemplateManager().get_user_language(user_id, auto_detect_text=auto_detect_text)
+
+    def _get_rejection_reason(self, user_query: str) -> Optional[str]:
+        """Возвращает причину отклонения запроса без обработки или None для нормального запроса"""
+        if not user_query or not user_query.strip():
+            return "empty"
+        if len(user_query.strip()) < _MIN_QUERY_LENGTH:
+            return "too_short"
+        if _NON_TEXT_QUERY_RE.fullmatch(user_query):
+            return "no_text"
+        return None
+
+    async def _answer_query(self, user_query: str, user_id: int, language: Language) -> AIResult:
+        """Получает ответ по цепочке: кэш -> OpenAI -> mock"""
+        result = None
+
+        # Если используем реальный AI - пробуем его
+        if self.use_real_ai:
+            result, cache_key, cache_probe = await self._get_cached_response(
+                user_query, user_id, language
             )
 
-            # Формируем сообщения для OpenAI
-            messages = [{"role": "system", "content": system_prompt}]
+            if result is None:
+                # Пока база знаний загружается, отвечаем без контекста из нее
+                knowledge_loaded = await self._wait_knowledge_base()
+                ai_result = await self._process_with_openai(
+                    user_query, user_id, language, use_knowledge_base=knowledge_loaded
+                )
+                if ai_result.success:
+                    # Ответ без базы знаний (она еще загружается) не кэшируется
+                    if cache_key and knowledge_loaded:
+                        self.response_cache.put(cache_key, ai_result, cache_probe)
+                    result = ai_result
+                else:
+                    logger.warning("OpenAI запрос неуспешен, переходим на mock")
 
-            # Добавляем историю разговора (если есть)
-            if conversation_history:
-                # Добавляем предыдущие сообщения, исключая текущий запрос пользователя
-                for msg in conversation_history[
-                    :-1
-                ]:  # Исключаем последнее сообщение (текущий запрос)
-                    messages.append(msg)
+        # Fallback на mock ответы
+        if result is None:
+            result = self._create_mock_ai_response(user_query, language)
 
-            # Добавляем текущий запрос
-            messages.append({"role": "user", "content": user_query})
+        if result.success:
+            # Сохраняем ответ ассистента в память
+            conversation_memory.add_assistant_message(user_id, result.answer)
 
-            # Выполняем запрос к OpenAI
-            response = await self.openai_client.chat.completions.create(
-                model=self.config.AI_MODEL,
-                messages=messages,
-                max_tokens=self.config.AI_MAX_TOKENS,
-                temperature=self.config.AI_TEMPERATURE,
-                timeout=30.0,
+        return result
+
+    async def _get_cached_response(
+        self, user_query: str, user_id: int, language: Language
+    ) -> Tuple[Optional[AIResult], Optional[CacheKey], Optional[object]]:
+        """
+        Ищет готовый ответ в кэше
+
+        Returns:
+            (ответ из кэша или None, ключ кэша или None, данные для семантического put или None)
+        """
+        # Кэшируем только запросы без предыдущего контекста разговора:
+        # ответ на уточняющий вопрос зависит от истории
+        history = conversation_memory.get_conversation_context(user_id, max_messages=2)
+        if len(history) > 1:
+            return None, None, None
+
+        cache_key = self.response_cache.make_key(user_query, language)
+        cached = self.response_cache.get(cache_key)
+        probe = None
+        if cached is None:
+            cached, probe = await self.response_cache.get_similar(user_query, language)
+            if cached is not None:
+                # Запоминаем формулировку для точного совпадения в следующий раз
+                self.response_cache.put(cache_key, cached)
+
+        if cached is None:
+            return None, cache_key, probe
+
+        logger.info("Ответ для пользователя %s взят из кэша", user_id)
+        return replace(cached, source="ai_cache", response_time_ms=0), cache_key, probe
+
+    async def _process_with_openai(
+        self, user_query: str, user_id: int, language: Language, use_knowledge_base: bool = True
+    ) -> AIResult:
+        """Обработка запроса через реальный OpenAI API с использованием базы знаний"""
+        start_ns = time.perf_counter_ns()
+        try:
+            messages, context = await self._build_openai_messages(
+                user_query, user_id, language, use_knowledge_base
             )
 
+            # Выполняем запрос к OpenAI
+            async with self._openai_semaphore:
+                response = await self._openai_create(
+                    model=self._model,
+                    messages=messages,
+                    max_tokens=self._max_tokens,
+                    temperature=self._temperature,
+                    timeout=30.0,
+                )
+
             if response.choices and response.choices[0].message:
                 answer = response.choices[0].message.content.strip()
 
                 # Логируем успешный запрос
-                logger.info(f"OpenAI успешно ответил на запрос: {user_query[:50]}...")
+                logger.info("OpenAI успешно ответил на запрос: %.50s...", user_query)
 
                 # Добавляем эмодзи и форматирование если их нет
-                if not any(emoji in answer for emoji in ["🔸", "📋", "👕", "📄", "💰", "⏰"]):
-                    answer = f"🤖 {answer}"
-
-                response_time_ms = int((time.time() - start_time) * 1000)
-
-                return {
-                    "success": True,
-                    "answer": answer,
-                    "confidence": 0.95,  # Высокая уверенность для реального AI
-                    "source": "ai",
-                    "should_contact_manager": False,
-                    "context_used": context,
-                    "search_type": "hybrid",
-                    "response_time_ms": response_time_ms,
-                }
+                answer = self._format_answer(answer)
+
+                response_time_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
+
+                return AIResult(
+                    success=True,
+                    answer=answer,
+                    confidence=0.95,  # Высокая уверенность для реального AI
+                    source="ai",
+                    context_used=context,
+                    search_type="hybrid",
+                    response_time_ms=response_time_ms,
+                )
             else:
                 logger.warning("OpenAI вернул пустой ответ")
-                return {"success": False, "answer": "", "confidence": 0.0, "source": "ai"}
+                return AIResult(success=False, answer="", source="ai")
+
+        except Exception as e:
+            logger.exception("Ошибка запроса к OpenAI")
+            return AIResult(success=False, answer=str(e), source="ai")
+
+    async def _stream_with_openai(
+        self,
+        user_query: str,
+        user_id: int,
+        language: Language,
+        use_knowledge_base: bool,
+        outcome: List[AIResult],
+    ) -> AsyncIterator[str]:
+        """
+        Потоковый запрос к OpenAI: отдает фрагменты ответа по мере генерации
+
+        Итоговый результат (полный ответ или ошибка) добавляется в outcome
+        """
+        start_ns = time.perf_counter_ns()
+        parts: List[str] = []
+        context = ""
+        deltas: asyncio.Queue = asyncio.Queue()
+        reader: Optional[asyncio.Task] = None
+        try:
+            messages, context = await self._build_openai_messages(
+                user_query, user_id, language, use_knowledge_base
+            )
+
+            # Поток OpenAI читает отдельная задача: слот семафора освобождается, когда
+            # закончится ответ OpenAI, а не когда потребитель заберет все фрагменты
+            reader = asyncio.create_task(self._read_openai_stream(messages, deltas))
+
+            # Ответ копится, пока в нем нет эмодзи форматирования: без них к ответу
+            # добавляется эмодзи (как в process_query), а это известно только в конце
+            pending: Optional[str] = ""
+            while (delta := await deltas.get()) is not None:
+                if pending is None:
+                    parts.append(delta)
+                    yield delta
+                    continue
+
+                pending += delta
+                if not _FORMATTING_EMOJI.isdisjoint(pending):
+                    pending = pending.lstrip()
+                    parts.append(pending)
+                    yield pending
+                    pending = None
+
+            # Ошибка OpenAI поднимается здесь
+            await reader
+
+            if pending and pending.strip():
+                pending = self._format_answer(pending.strip())
+                parts.append(pending)
+                yield pending
 
         except Exception as e:
-            logger.error(f"Ошибка запроса к OpenAI: {e}")
-            return {"success": False, "answer": str(e), "confidence": 0.0, "source": "ai"}
+            logger.exception("Ошибка потокового запроса к OpenAI")
+            outcome.append(AIResult(success=False, answer="".join(parts) or str(e), source="ai"))
+            return
+
+        finally:
+            # Потребитель мог прекратить чтение раньше конца ответа
+            if reader is not None and not reader.done():
+                reader.cancel()
+
+        answer = "".join(parts).rstrip()
+        if not answer:
+            logger.warning("OpenAI вернул пустой ответ")
+            outcome.append(AIResult(success=False, answer="", source="ai"))
+            return
 
-    def _create_mock_ai_response(self, query: str, language: str) -> Dict:
+        logger.info("OpenAI успешно ответил на запрос (stream): %.50s...", user_query)
+        outcome.append(
+            AIResult(
+                success=True,
+                answer=answer,
+                confidence=0.95,  # Высокая уверенность для реального AI
+                source="ai",
+                context_used=context,
+                search_type="hybrid",
+                response_time_ms=(time.perf_counter_ns() - start_ns) // 1_000_000,
+            )
+        )
+
+    async def _read_openai_stream(self, messages: List[Dict], deltas: asyncio.Queue) -> None:
+        """Читает потоковый ответ OpenAI в очередь deltas под семафором (None - конец ответа)"""
+        try:
+            async with self._openai_semaphore:
+                stream = await self._openai_create(
+                    model=self._model,
+                    messages=messages,
+                    max_tokens=self._max_tokens,
+                    temperature=self._temperature,
+                    timeout=30.0,
+                    stream=True,
+                )
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        deltas.put_nowait(delta)
+        finally:
+            deltas.put_nowait(None)
+
+    @staticmethod
+    def _format_answer(answer: str) -> str:
+        """Добавляет эмодзи к ответу OpenAI, если в нем нет эмодзи форматирования"""
+        return f"🤖 {answer}" if _FORMATTING_EMOJI.isdisjoint(answer) else answer
+
+    async def _build_openai_messages(
+        self, user_query: str, user_id: int, language: Language, use_knowledge_base: bool
+    ) -> Tuple[List[Dict], str]:
+        """
+        Формирует сообщения для OpenAI
+
+        Returns:
+            (сообщения: системный промпт, история разговора и запрос; контекст из базы знаний)
+        """
+        context = ""
+        if use_knowledge_base:
+            context = await rag_service.get_context_for_query(user_query, language)
+
+        # Создаем системный промпт с контекстом из базы знаний
+        system_prompt = _build_system_prompt(language, context)
+
+        # Получаем историю разговора без последнего сообщения (это текущий запрос)
+        conversation_history = conversation_memory.get_conversation_context(
+            user_id, max_messages=6, exclude_last=True
+        )
+
+        # Формируем сообщения для OpenAI одним списком
+        messages = [
+            {"role": "system", "content": system_prompt},
+            *conversation_history,
+            {"role": "user", "content": user_query},
+        ]
+        return messages, context
+
+    def _create_mock_ai_response(self, query: str, language: Language) -> AIResult:
         """Временная заглушка для AI ответа"""
         # Простейшая логика для демонстрации
-        query_lower = query.lower()
-
-        # Расширенные ключевые слова для лучшего поиска
-        keywords_map = {
-            "ukr": {
-                "price": [
-                    "ціна",
-                    "цін",
-                    "коштує",
-                    "коштують",
-                    "стоїть",
-                    "стоять",
-                    "вартість",
-                    "тариф",
-                ],
-                "design": ["макет", "дизайн", "файл", "psd", "ai", "pdf", "png"],
-                "timeline": [
-                    "терміни",
-                    "термін",
-                    "час",
-                    "швидко",
-                    "скоро",
-                    "виготовлення",
-                    "готовий",
-                    "готові",
-                ],
-                "quality": ["якість", "матеріал", "друк", "поліграфія", "качество"],
-                "tshirts": ["футболка", "футболки", "майка", "майки", "одяг"],
-            },
-            "rus": {
-                "price": ["цена", "цен", "стоит", "стоят", "стоимость", "тариф"],
-                "design": ["макет", "дизайн", "файл", "psd", "ai", "pdf", "png"],
-                "timeline": [
-                    "сроки",
-                    "срок",
-                    "время",
-                    "быстро",
-                    "скоро",
-                    "изготовление",
-                    "готов",
-                    "готовы",
-                ],
-                "quality": ["качество", "материал", "печать", "полиграфия"],
-                "tshirts": ["футболка", "футболки", "майка", "майки", "одежда"],
-            },
-        }
-
-        mock_responses = {
-            "ukr": {
-                "price": "🔸 Ціни на нашу продукцію залежать від тиражу та складності.\n\n"
-                "📋 Візитки: від 50 грн за 100 шт\n"
-                "👕 Футболки: від 200 грн\n"
-                "📄 Листівки: від 80 грн за 100 шт\n\n"
-                "📞 Для точного розрахунку зверніться до менеджера!",
-                "design": "🎨 Щодо макетів:\n\n"
-                "✅ Приймаємо файли: AI, PSD, PDF, PNG (300+ dpi)\n"
-                "✅ Безкоштовна корекція макету\n"
-                "✅ Можемо створити макет з нуля\n\n"
-                "📞 Надішліть ваш макет менеджеру для перевірки!",
-                "timeline": "⏰ Терміни виготовлення:\n\n"
-                "📋 Візитки: 1-2 дні\n"
-                "👕 Футболки: 2-3 дні\n"
-                "📄 Листівки: 1-2 дні\n\n"
-                "⚡ Є експрес-виготовлення за доплату!",
-                "tshirts": "👕 Про футболки:\n\n"
-                "💰 Ціна: від 200 грн\n"
-                "⏰ Терміни: 2-3 дні\n"
-                "🎨 Друк: цифровий, шовкографія\n"
-                "📏 Розміри: XS-5XL\n\n"
-                "📞 Для детальної консультації зверніться до менеджера!",
-                "quality": "🏆 Якість нашої продукції:\n\n"
-                "✅ Преміум матеріали\n"
-                "✅ Професійне обладнання\n"
-                "✅ Контроль якості на всіх етапах\n"
-                "✅ Гарантія на всі роботи\n\n"
-                "📞 Маємо сертифікати якості - питайте у менеджера!",
-            },
-            "rus": {
-                "price": "🔸 Цены на нашу продукцию зависят от тиража и сложности.\n\n"
-                "📋 Визитки: от 50 грн за 100 шт\n"
-                "👕 Футболки: от 200 грн\n"
-                "📄 Листовки: от 80 грн за 100 шт\n\n"
-                "📞 Для точного расчета обратитесь к менеджеру!",
-                "design": "🎨 По макетам:\n\n"
-                "✅ Принимаем файлы: AI, PSD, PDF, PNG (300+ dpi)\n"
-                "✅ Бесплатная коррекция макета\n"
-                "✅ Можем создать макет с нуля\n\n"
-                "📞 Отправьте ваш макет менеджеру для проверки!",
-                "timeline": "⏰ Сроки изготовления:\n\n"
-                "📋 Визитки: 1-2 дня\n"
-                "👕 Футболки: 2-3 дня\n"
-                "📄 Листовки: 1-2 дня\n\n"
-                "⚡ Есть экспресс-изготовление за доплату!",
-                "tshirts": "👕 О футболках:\n\n"
-                "💰 Цена: от 200 грн\n"
-                "⏰ Сроки: 2-3 дня\n"
-                "🎨 Печать: цифровая, шелкография\n"
-                "📏 Размеры: XS-5XL\n\n"
-                "📞 Для детальной консультации обратитесь к менеджеру!",
-                "quality": "🏆 Качество нашей продукции:\n\n"
-                "✅ Премиум материалы\n"
-                "✅ Профессиональное оборудование\n"
-                "✅ Контроль качества на всех этапах\n"
-                "✅ Гарантия на все работы\n\n"
-                "📞 У нас есть сертификаты качества - спрашивайте у менеджера!",
-            },
-        }
+        query_lower: str = query.lower()
 
         # Ищем подходящий ответ с новой логикой
-        keywords = keywords_map.get(language, keywords_map["ukr"])
-        responses = mock_responses.get(language, mock_responses["ukr"])
-
-        # Проверяем по каждой категории ключевых слов
-        for response_type, word_list in keywords.items():
-            for word in word_list:
-                if word in query_lower:
-                    response = responses.get(response_type)
-                    if response:
-                        return {
-                            "success": True,
-                            "answer": response,
-                            "confidence": 0.90,  # Высокая уверенность для mock
-                            "source": "ai",
-                            "should_contact_manager": False,
-                        }
+        patterns = _MOCK_KEYWORD_PATTERNS.get(language, _MOCK_KEYWORD_PATTERNS["ukr"])
+        responses = _MOCK_RESPONSES.get(language, _MOCK_RESPONSES["ukr"])
+
+        # Проверяем категории по приоритету: один проход regex по запросу на категорию
+        for response_type, pattern in patterns:
+            if pattern.search(query_lower):
+                response = responses.get(response_type)
+                if response:
+                    return AIResult(
+                        success=True,
+                        answer=response,
+                        confidence=0.90,  # Высокая уверенность для mock
+                        source="ai",
+                    )
 
         # Если не нашли подходящий ответ
         return self._create_fallback_response(language)
 
-    def _create_fallback_response(self, language: str, error: bool = False) -> Dict:
+    def _create_fallback_response(self, language: Language, error: bool = False) -> AIResult:
         """Создает fallback ответ когда AI не может помочь"""
-        is_work_time = is_business_time()
-
-        if language == "ukr":
-            if error:
-                base_msg = "😔 Вибачте, сталася технічна помилка з AI-помічником.\n\n"
-            else:
-                base_msg = "🤔 На жаль, я не знайшов точної відповіді на ваше питання.\n\n"
-
-            if is_work_time:
-                msg = base_msg + "📞 Наш менеджер зараз онлайн і обов'язково вам допоможе!"
-            else:
-                msg = base_msg + "📞 Наш менеджер зв'яжеться з вами найближчим часом!"
-        else:
-            if error:
-                base_msg = "😔 Извините, произошла техническая ошибка с AI-помощником.\n\n"
-            else:
-                base_msg = "🤔 К сожалению, я не нашел точного ответа на ваш вопрос.\n\n"
-
-            if is_work_time:
-                msg = base_msg + "📞 Наш менеджер сейчас онлайн и обязательно вам поможет!"
-            else:
-                msg = base_msg + "📞 Наш менеджер свяжется с вами в ближайшее время!"
-
-        return {
-            "success": False,
-            "answer": msg,
-            "confidence": 0.0,
-            "source": "fallback",
-            "should_contact_manager": True,
-        }
-
-    def _log_response_analytics(self, query_id: Optional[int], result: Dict, start_time: float):
-        """Логирует аналитику ответа"""
+        msg = _FALLBACK_MESSAGES[
+            "ukr" if language == "ukr" else "rus", error, self._is_business_time()
+        ]
+        return AIResult(success=False, answer=msg, source="fallback", should_contact_manager=True)
+
+    def _is_business_time(self) -> bool:
+        """Рабочее ли сейчас время (значение кэшируется на _BUSINESS_TIME_TTL секунд)"""
+        now = time.monotonic()
+        checked_at, is_work_time = self._business_time_cache
+        if now - checked_at >= _BUSINESS_TIME_TTL:
+            is_work_time = is_business_time()
+            self._business_time_cache = (now, is_work_time)
+        return is_work_time
+
+    def _log_response_analytics(self, query_id: Optional[int], result: AIResult, start_ns: int):
+        """Логирует аналитику ответа, не задерживая ответ пользователю"""
         if not query_id:
             return
 
+        response_time_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
+        # log_ai_response только ставит запись в очередь фонового потока аналитики
         try:
-            response_time_ms = int((time.time() - start_time) * 1000)
-
             analytics_service.log_ai_response(
                 query_id=query_id,
-                ai_response=result.get("answer", ""),
-                confidence=result.get("confidence", 0.0),
-                source=result.get("source", "unknown"),
-                should_contact_manager=result.get("should_contact_manager", False),
-                context_used=result.get("context_used", ""),
-                search_type=result.get("search_type", ""),
-                relevance_scores=result.get("relevance_scores", []),
+                ai_response=result.answer,
+                confidence=result.confidence,
+                source=result.source,
+                should_contact_manager=result.should_contact_manager,
+                context_used=result.context_used,
+                search_type=result.search_type,
+                relevance_scores=result.relevance_scores,
                 response_time_ms=response_time_ms,
             )
-        except Exception as e:
-            logger.error(f"Ошибка при логировании аналитики: {e}")
+        except Exception:
+            logger.exception("Ошибка при логировании аналитики")
+
+    async def flush_analytics(self):
+        """Дожидается записи всей накопленной аналитики (например, при остановке бота)"""
+        # Записи ставятся в очередь фонового потока аналитики - дожидаемся ее
+        await asyncio.to_thread(analytics_service.flush)
+
+    async def aclose(self):
+        """Завершает работу сервиса: дописывает аналитику и закрывает HTTP соединения"""
+        await self.flush_analytics()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+
+
+@functools.cache
+def get_ai_service() -> AIService:
+    """Глобальный экземпляр для использования в приложении (создается при первом обращении)"""
+    return AIService()
+
+
+def invalidate_response_cache() -> None:
+    """Сбрасывает кэш ответов AI после изменения базы знаний (сервис ради этого не создается)"""
+    if get_ai_service.cache_info().currsize:
+        get_ai_service().response_cache.clear()
 
 
-# Глобальный экземпляр для использования в приложении
-ai_service = AIService()
+def __getattr__(name: str):
+    """Ленивый доступ к `ai_service`: `from src.ai.service import ai_service` работает как раньше"""
+    if name == "ai_service":
+        return get_ai_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-async def process_user_query(user_query: str, user_id: int, language: str = None) -> Dict:
+async def process_user_query(
+    user_query: str, user_id: int, language: Optional[Language] = None
+) -> AIResultDict:
     """Упрощенная функция для обработки запросов"""
-    return await ai_service.process_query(user_query, user_id, language)
+    return await get_ai_service().process_query(user_query, user_id, language)
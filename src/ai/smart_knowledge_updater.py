@@ -3,53 +3,187 @@
 Отслеживает изменения и обновляет только измененные записи
 """
 
+import functools
 import hashlib
 import json
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, List, Optional, Set, Tuple
 
-from src.ai.knowledge_base import knowledge_base
-from src.admin.knowledge_base_manager import knowledge_base_manager
+try:
+    import orjson
+
+    def _dumps(data: Dict) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+    _loads = orjson.loads
+except ImportError:
+    orjson = None
+
+    def _dumps(data: Dict) -> bytes:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+    _loads = json.loads
 
 logger = logging.getLogger(__name__)
 
+# Хеш контента - только отпечаток для обнаружения изменений, криптостойкость не нужна:
+# BLAKE2b быстрее MD5, а 64-битного дайджеста достаточно для сравнения версий записи
+_FAST_HASHER = hashlib.blake2b
+_CONTENT_HASH_DIGEST_SIZE = 8
+
+# Поля строки, входящие в хеш контента, и их значения по умолчанию
+# (subcategory остается для совместимости - внутренне используется)
+_HASH_FIELDS = (
+    ("category", ""),
+    ("subcategory", ""),
+    ("button_text", ""),
+    ("keywords", ""),
+    ("answer_ukr", ""),
+    ("answer_rus", ""),
+    ("sort_order", "999"),
+)
+
+# Символы, которые не попадают в стабильный ID: все, кроме букв, цифр и пробелов
+# (\w в str-шаблоне = isalnum() или "_", \s = isspace(), поэтому "_" удаляется отдельно)
+_ID_UNSAFE_CHARS_RE = re.compile(r"[^\w\s]|_")
+
+# Источники записей, добавленных администраторами (сохраняются при обновлении из CSV)
+_ADMIN_SOURCES = frozenset(["admin_correction", "admin_addition"])
+
+# С какого числа строк хеширование распределяется по потокам: hashlib отпускает GIL
+# на данных от 2 КБ, а на небольших наборах запуск пула дороже самого хеширования
+_PARALLEL_HASH_MIN_ROWS = 2000
+
+# Сколько документов отправляется в ChromaDB за один add: ограничивает пиковую память
+# (тексты и метаданные собираются только для текущей пачки)
+_CHROMADB_WRITE_BATCH_SIZE = 500
+
+# Поля строки, от которых зависят ID, хеш и документ в ChromaDB
+_CONTENT_FIELDS = (
+    "category",
+    "subcategory",
+    "button_text",
+    "keywords",
+    "answer_ukr",
+    "answer_rus",
+    "sort_order",
+)
+
+
+def _chunks(seq: List, size: int):
+    """Разбивает список на последовательные части не длиннее size"""
+    for start in range(0, len(seq), size):
+        yield seq[start : start + size]
+
+
+def _hash_contents(contents: List[str]) -> List[str]:
+    """Хеши контента для уже склеенных строк"""
+    return [
+        _FAST_HASHER(content.encode("utf-8"), digest_size=_CONTENT_HASH_DIGEST_SIZE).hexdigest()
+        for content in contents
+    ]
+
 
 class SmartKnowledgeUpdater:
     """Умное обновление базы знаний с отслеживанием изменений"""
 
+    # Поисковый документ ChromaDB (заполняется через format_map)
+    _SEARCH_TEMPLATE = (
+        "Категория: {category}\n"
+        "Ключевые слова: {keywords}\n"
+        "Украинский ответ: {answer_ukr}\n"
+        "Русский ответ: {answer_rus}"
+    )
+
     def __init__(self):
-        self.knowledge_base = knowledge_base
-        self.knowledge_manager = knowledge_base_manager
+        # База знаний и менеджер тянут ChromaDB - импортируются при первом обращении
+        self._knowledge_base = None
+        self._knowledge_manager = None
         self.changes_cache_file = "./data/knowledge_changes_cache.json"
+        # Кеш изменений в памяти и (путь, mtime, размер) файла, из которого он прочитан:
+        # JSON перечитывается только если файл изменился на диске
+        self._cache: Optional[Dict] = None
+        self._cache_stamp: Optional[Tuple[str, int, int]] = None
+        # Последний результат detect_changes: (отпечаток входных данных, изменения).
+        # detect_changes сразу записывает новые хеши в кеш, поэтому повторный вызов
+        # на тех же данных (анализ стратегии -> обновление) должен вернуть те же изменения
+        self._changes_memo: Optional[Tuple[bytes, Dict]] = None
+        # ID админских записей в ChromaDB (загружаются один раз, сбрасываются при их изменении)
+        self._admin_ids_cache: Optional[frozenset] = None
         logger.info("Smart Knowledge Updater инициализирован")
 
+    @property
+    def knowledge_base(self):
+        """База знаний ChromaDB"""
+        if self._knowledge_base is None:
+            from src.ai.knowledge_base import knowledge_base
+
+            self._knowledge_base = knowledge_base
+        return self._knowledge_base
+
+    @knowledge_base.setter
+    def knowledge_base(self, value) -> None:
+        self._knowledge_base = value
+
+    @property
+    def knowledge_manager(self):
+        """Менеджер базы знаний"""
+        if self._knowledge_manager is None:
+            from src.admin.knowledge_base_manager import knowledge_base_manager
+
+            self._knowledge_manager = knowledge_base_manager
+        return self._knowledge_manager
+
+    @knowledge_manager.setter
+    def knowledge_manager(self, value) -> None:
+        self._knowledge_manager = value
+
     def generate_content_hash(self, row: Dict) -> str:
         """Генерирует хеш контента для отслеживания изменений"""
-        # Используем только значимые поля для хеша
-        content_fields = [
-            row.get("category", ""),
-            row.get(
-                "subcategory", ""
-            ),  # Остается subcategory для совместимости (внутренне используется)
-            row.get("button_text", ""),
-            row.get("keywords", ""),
-            row.get("answer_ukr", ""),
-            row.get("answer_rus", ""),
-            row.get("sort_order", "999"),
-        ]
-        content_string = "|".join(content_fields)
-        return hashlib.md5(content_string.encode("utf-8"), usedforsecurity=False).hexdigest()
-
-    def generate_stable_id(self, row: Dict, row_index: int) -> str:
-        """Генерирует стабильный ID основанный на контенте, а не позиции"""
+        return self._compute_all_hashes([row])[0]
+
+    def _compute_all_hashes(self, rows: List[Dict]) -> List[str]:
+        """
+        Хеши контента для всех строк за один проход
+
+        Значимые поля извлекаются по колонкам, строки склеиваются через map
+        на уровне C, затем каждая строка кодируется и хешируется один раз.
+        Большие наборы хешируются частями в пуле потоков
+        """
+        columns = [[row.get(field, default) for row in rows] for field, default in _HASH_FIELDS]
+        contents = list(map("|".join, zip(*columns)))
+
+        workers = os.cpu_count() or 1
+        if len(contents) <= _PARALLEL_HASH_MIN_ROWS or workers < 2:
+            return _hash_contents(contents)
+
+        chunk_size = -(-len(contents) // workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map сохраняет порядок частей, поэтому хеши совпадают с порядком строк
+            parts = executor.map(_hash_contents, _chunks(contents, chunk_size))
+            return [content_hash for part in parts for content_hash in part]
+
+    def generate_stable_id(
+        self, row: Dict, row_index: int, content_hash: Optional[str] = None
+    ) -> str:
+        """
+        Генерирует стабильный ID основанный на контенте, а не позиции
+
+        Args:
+            row: Строка данных
+            row_index: Позиция строки (для строк без button_text)
+            content_hash: Уже вычисленный хеш контента строки (чтобы не считать его повторно)
+        """
         # Используем первые слова button_text + category для стабильного ID
         button_words = row.get("button_text", "").strip()[:50]  # Первые 50 символов
         category = row.get("category", "unknown")
 
         # Очищаем от специальных символов
-        clean_text = "".join(c for c in button_words if c.isalnum() or c.isspace())
+        clean_text = _ID_UNSAFE_CHARS_RE.sub("", button_words)
         clean_text = "_".join(clean_text.split())[:30]  # Максимум 30 символов
 
         if not clean_text:
@@ -58,43 +192,89 @@ class SmartKnowledgeUpdater:
 
         stable_id = f"{category}_{clean_text}"
 
+        if content_hash is None:
+            content_hash = self.generate_content_hash(row)
+
         # Проверяем уникальность и добавляем суффикс если нужно
-        return self._ensure_unique_id(stable_id, row)
+        return self._ensure_unique_id(stable_id, content_hash)
 
-    def _ensure_unique_id(self, base_id: str, row: Dict) -> str:
+    def _ensure_unique_id(self, base_id: str, content_hash: str) -> str:
         """Обеспечивает уникальность ID"""
         # Добавляем хеш первых 8 символов для гарантии уникальности
-        content_hash = self.generate_content_hash(row)[:8]
-        return f"{base_id}_{content_hash}"
+        return f"{base_id}_{content_hash[:8]}"
 
     def load_changes_cache(self) -> Dict:
-        """Загружает кеш изменений"""
-        if not os.path.exists(self.changes_cache_file):
-            return {"hashes": {}, "last_update": None}
-
+        """Загружает кеш изменений (из памяти, если файл не менялся)"""
         try:
-            with open(self.changes_cache_file, "r", encoding="utf-8") as f:
-                return json.load(f)
+            stamp = self._file_stamp()
+            if self._cache is not None and stamp == self._cache_stamp:
+                return self._cache
+
+            with open(self.changes_cache_file, "rb") as f:
+                cache = _loads(f.read())
+        except FileNotFoundError:
+            # Первый запуск - кеша еще нет, это не ошибка
+            return {"hashes": {}, "last_update": None}
         except Exception as e:
             logger.error(f"Ошибка загрузки кеша изменений: {e}")
             return {"hashes": {}, "last_update": None}
 
+        self._cache = cache
+        self._cache_stamp = stamp
+        return cache
+
+    def _file_stamp(self) -> Tuple[str, int, int]:
+        """Путь, mtime и размер файла кеша изменений"""
+        st = os.stat(self.changes_cache_file)
+        return self.changes_cache_file, st.st_mtime_ns, st.st_size
+
     def save_changes_cache(self, cache: Dict) -> None:
-        """Сохраняет кеш изменений"""
+        """Сохраняет кеш изменений (атомарно: через временный файл и os.replace)"""
+        temp_file = f"{self.changes_cache_file}.tmp"
         try:
             os.makedirs(os.path.dirname(self.changes_cache_file), exist_ok=True)
             cache["last_update"] = datetime.now().isoformat()
 
-            with open(self.changes_cache_file, "w", encoding="utf-8") as f:
-                json.dump(cache, f, ensure_ascii=False, indent=2)
+            with open(temp_file, "wb") as f:
+                f.write(_dumps(cache))
+            os.replace(temp_file, self.changes_cache_file)
+
+            self._cache = cache
+            self._cache_stamp = self._file_stamp()
         except Exception as e:
             logger.error(f"Ошибка сохранения кеша изменений: {e}")
+            # Копия в памяти могла разойтись с файлом - при следующей загрузке читаем с диска
+            self._cache = None
+            # Удаляем временный файл в случае ошибки
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
 
-    def detect_changes(self, new_data: List[Dict]) -> Dict:
-        """Обнаруживает изменения в данных"""
+    def detect_changes(self, new_data: List[Dict], fingerprint: Optional[bytes] = None) -> Dict:
+        """
+        Обнаруживает изменения в данных
+
+        Args:
+            new_data: Новые данные
+            fingerprint: Уже вычисленный отпечаток new_data (_data_fingerprint)
+        """
         cache = self.load_changes_cache()
         old_hashes = cache.get("hashes", {})
 
+        # Данные совпадают с прошлым анализом - построчное сравнение и запись кеша не нужны.
+        # ID в кеше идут в порядке строк, поэтому при отсутствии дублей их можно сопоставить
+        total_fingerprint = (fingerprint or self._data_fingerprint(new_data)).hex()
+        if total_fingerprint == cache.get("total_fingerprint") and len(old_hashes) == len(new_data):
+            return {
+                "added": [],
+                "modified": [],
+                "deleted": [],
+                "unchanged": [
+                    {"id": stable_id, "data": row, "hash": content_hash}
+                    for (stable_id, content_hash), row in zip(old_hashes.items(), new_data)
+                ],
+                "admin_kept": [],
+            }
+
         changes = {
             "added": [],  # Новые записи
             "modified": [],  # Измененные записи
@@ -104,48 +284,105 @@ class SmartKnowledgeUpdater:
         }
 
         new_hashes = {}
-        new_ids = set()
+        # Локальные ссылки на методы: в цикле по всем строкам без повторного поиска атрибутов
+        add_added = changes["added"].append
+        add_modified = changes["modified"].append
+        add_unchanged = changes["unchanged"].append
+        get_old_hash = old_hashes.get
 
         # Анализируем новые данные
-        for i, row in enumerate(new_data):
-            stable_id = self.generate_stable_id(row, i)
-            content_hash = self.generate_content_hash(row)
-
+        content_hashes = self._compute_all_hashes(new_data)
+        for i, (row, content_hash) in enumerate(zip(new_data, content_hashes)):
+            stable_id = self.generate_stable_id(row, i, content_hash)
             new_hashes[stable_id] = content_hash
-            new_ids.add(stable_id)
 
-            if stable_id not in old_hashes:
+            old_hash = get_old_hash(stable_id)
+            if old_hash is None:
                 # Новая запись
-                changes["added"].append({"id": stable_id, "data": row, "hash": content_hash})
-            elif old_hashes[stable_id] != content_hash:
+                add_added({"id": stable_id, "data": row, "hash": content_hash})
+            elif old_hash != content_hash:
                 # Измененная запись
-                changes["modified"].append(
-                    {
-                        "id": stable_id,
-                        "data": row,
-                        "old_hash": old_hashes[stable_id],
-                        "new_hash": content_hash,
-                    }
+                add_modified(
+                    {"id": stable_id, "data": row, "old_hash": old_hash, "new_hash": content_hash}
                 )
             else:
                 # Неизмененная запись
-                changes["unchanged"].append({"id": stable_id, "data": row, "hash": content_hash})
-
-        # Находим удаленные записи (были в кеше, но нет в новых данных)
-        deleted_ids = set(old_hashes.keys()) - new_ids
-        for deleted_id in deleted_ids:
-            # Проверяем, не админская ли это запись
-            if self._is_admin_record(deleted_id):
-                changes["admin_kept"].append(deleted_id)
-            else:
-                changes["deleted"].append(deleted_id)
+                add_unchanged({"id": stable_id, "data": row, "hash": content_hash})
+
+        # Находим удаленные записи (были в кеше, но нет в новых данных):
+        # разность представлений ключей, без промежуточных копий множеств
+        deleted_ids = old_hashes.keys() - new_hashes.keys()
+        if deleted_ids:
+            # Админские записи сохраняются, остальные удаляются
+            admin_ids = self._load_admin_ids()
+            changes["admin_kept"] = list(deleted_ids & admin_ids)
+            changes["deleted"] = list(deleted_ids - admin_ids)
 
         # Обновляем кеш
         cache["hashes"] = new_hashes
+        cache["total_fingerprint"] = total_fingerprint
         self.save_changes_cache(cache)
 
         return changes
 
+    def _data_fingerprint(self, data: List[Dict]) -> bytes:
+        """Отпечаток всего набора данных (с учетом порядка строк)"""
+        hasher = _FAST_HASHER(digest_size=16)
+        for row in data:
+            for field in _CONTENT_FIELDS:
+                value = row.get(field)
+                # Отсутствующее поле отличаем от пустого: от этого зависят значения по умолчанию
+                hasher.update(b"\x1d" if value is None else str(value).encode("utf-8"))
+                hasher.update(b"\x1f")
+            hasher.update(b"\x1e")
+        return hasher.digest()
+
+    def _detect_changes_cached(self, data: List[Dict]) -> Dict:
+        """detect_changes с запоминанием результата для тех же входных данных"""
+        fingerprint = self._data_fingerprint(data)
+        if self._changes_memo is not None and self._changes_memo[0] == fingerprint:
+            return self._changes_memo[1]
+
+        changes = self.detect_changes(data, fingerprint)
+        self._changes_memo = (fingerprint, changes)
+        return changes
+
+    def _invalidate_changes_memo(self) -> None:
+        """Сбрасывает запомненные изменения (после их применения к базе знаний)"""
+        self._changes_memo = None
+
+    def _invalidate_upsell_cache(self) -> None:
+        """
+        Сбрасывает кеш категорий upselling движка и кэш ответов AI
+        (записи в ChromaDB изменились, сохраненные ответы могут содержать старые цены)
+        """
+        from src.ai.service import invalidate_response_cache
+        from src.ai.upselling_engine import upsell_engine
+
+        upsell_engine.invalidate_category_cache()
+        invalidate_response_cache()
+
+    def _load_admin_ids(self) -> frozenset:
+        """Возвращает ID всех админских записей (один запрос к ChromaDB на процесс)"""
+        if self._admin_ids_cache is not None:
+            return self._admin_ids_cache
+
+        try:
+            if not self.knowledge_base.is_initialized:
+                return frozenset()
+
+            results = self.knowledge_base.collection.get(
+                where={"source": {"$in": list(_ADMIN_SOURCES)}}, include=[]
+            )
+            self._admin_ids_cache = frozenset(results["ids"])
+            return self._admin_ids_cache
+        except Exception:
+            return frozenset()
+
+    def invalidate_admin_ids_cache(self) -> None:
+        """Сбрасывает кеш ID админских записей (после добавления или удаления таких записей)"""
+        self._admin_ids_cache = None
+
     def _is_admin_record(self, record_id: str) -> bool:
         """Проверяет, является ли запись админской"""
         try:
@@ -158,7 +395,7 @@ class SmartKnowledgeUpdater:
             if results["metadatas"]:
                 metadata = results["metadatas"][0]
                 source = metadata.get("source", "")
-                return source in ["admin_correction", "admin_addition"]
+                return source in _ADMIN_SOURCES
 
             return False
         except Exception:
@@ -189,7 +426,7 @@ class SmartKnowledgeUpdater:
                 return {"success": False, "error": "Нет данных для обновления"}
 
             # Обнаруживаем изменения
-            changes = self.detect_changes(csv_data)
+            changes = self._detect_changes_cached(csv_data)
 
             # Статистика изменений
             stats = {
@@ -203,7 +440,8 @@ class SmartKnowledgeUpdater:
             logger.info(f"Обнаружены изменения: {stats}")
 
             # Если нет изменений - не делаем ничего
-            if stats["added"] == 0 and stats["modified"] == 0 and stats["deleted"] == 0:
+            has_changes = bool(changes["added"] or changes["modified"] or changes["deleted"])
+            if not has_changes:
                 return {
                     "success": True,
                     "message": "Изменений не обнаружено",
@@ -215,6 +453,8 @@ class SmartKnowledgeUpdater:
             update_result = self._apply_changes_to_chromadb(changes)
 
             if update_result["success"]:
+                self._invalidate_changes_memo()
+                self._invalidate_upsell_cache()
                 return {
                     "success": True,
                     "message": f"База знаний обновлена: +{stats['added']} ~{stats['modified']} -{stats['deleted']}",
@@ -236,61 +476,43 @@ class SmartKnowledgeUpdater:
                 return {"success": False, "error": "ChromaDB не инициализирован"}
 
             operations_count = 0
+            modified_ids = [item["id"] for item in changes["modified"]]
 
-            # 1. Удаляем устаревшие записи
-            if changes["deleted"]:
+            # 1. Одним запросом удаляем устаревшие записи и старые версии измененных
+            # (ChromaDB не поддерживает update, поэтому измененные удаляем и добавляем заново)
+            ids_to_delete = changes["deleted"] + modified_ids
+            if ids_to_delete:
                 try:
-                    self.knowledge_base.collection.delete(ids=changes["deleted"])
+                    self.knowledge_base.collection.delete(ids=ids_to_delete)
                     operations_count += len(changes["deleted"])
                     logger.info(f"Удалено {len(changes['deleted'])} записей")
                 except Exception as e:
                     logger.warning(f"Ошибка удаления записей: {e}")
 
-            # 2. Добавляем новые записи
-            if changes["added"]:
-                new_docs = []
-                for item in changes["added"]:
-                    doc = self._create_chromadb_document(item["id"], item["data"])
-                    new_docs.append(doc)
-
-                if new_docs:
-                    ids = [doc["id"] for doc in new_docs]
-                    texts = [doc["text"] for doc in new_docs]
-                    metadatas = [doc["metadata"] for doc in new_docs]
-
-                    self.knowledge_base.collection.add(
-                        ids=ids, documents=texts, metadatas=metadatas
-                    )
-                    operations_count += len(new_docs)
-                    logger.info(f"Добавлено {len(new_docs)} новых записей")
-
-            # 3. Обновляем измененные записи
-            if changes["modified"]:
-                # ChromaDB не поддерживает update, поэтому удаляем и добавляем заново
-                modified_ids = [item["id"] for item in changes["modified"]]
-
-                # Удаляем старые версии
-                try:
-                    self.knowledge_base.collection.delete(ids=modified_ids)
-                except Exception as e:
-                    logger.warning(f"Ошибка удаления старых версий: {e}")
-
-                # Добавляем новые версии
-                modified_docs = []
-                for item in changes["modified"]:
-                    doc = self._create_chromadb_document(item["id"], item["data"])
-                    modified_docs.append(doc)
-
-                if modified_docs:
-                    ids = [doc["id"] for doc in modified_docs]
-                    texts = [doc["text"] for doc in modified_docs]
-                    metadatas = [doc["metadata"] for doc in modified_docs]
-
-                    self.knowledge_base.collection.add(
-                        ids=ids, documents=texts, metadatas=metadatas
-                    )
-                    operations_count += len(modified_docs)
-                    logger.info(f"Обновлено {len(modified_docs)} записей")
+            # 2. Добавляем новые записи и новые версии измененных пачками
+            items = changes["added"] + changes["modified"]
+            if items:
+                # Одна метка времени на все обновление
+                now_iso = datetime.now().isoformat()
+                batches = list(_chunks(items, _CHROMADB_WRITE_BATCH_SIZE))
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    # Следующая пачка документов собирается в фоне, пока текущая пишется в ChromaDB
+                    pending = executor.submit(self._build_chromadb_batch, batches[0], now_iso)
+                    for next_batch in batches[1:] + [None]:
+                        ids, texts, metadatas = pending.result()
+                        if next_batch is not None:
+                            pending = executor.submit(
+                                self._build_chromadb_batch, next_batch, now_iso
+                            )
+                        self.knowledge_base.collection.add(
+                            ids=ids, documents=texts, metadatas=metadatas
+                        )
+                        operations_count += len(ids)
+
+                logger.info(
+                    f"Добавлено {len(changes['added'])} новых записей, "
+                    f"обновлено {len(changes['modified'])} записей"
+                )
 
             return {
                 "success": True,
@@ -302,19 +524,41 @@ class SmartKnowledgeUpdater:
             logger.error(f"Ошибка применения изменений к ChromaDB: {e}")
             return {"success": False, "error": str(e)}
 
-    def _create_chromadb_document(self, doc_id: str, data: Dict) -> Dict:
-        """Создает документ для ChromaDB"""
+    def _build_chromadb_batch(
+        self, batch: List[Dict], now_iso: str
+    ) -> Tuple[List[str], List[str], List[Dict]]:
+        """Собирает ID, тексты и метаданные пачки документов для collection.add"""
+        docs = [self._create_chromadb_document(item["id"], item["data"], now_iso) for item in batch]
+        return (
+            [doc["id"] for doc in docs],
+            [doc["text"] for doc in docs],
+            [doc["metadata"] for doc in docs],
+        )
+
+    def _create_chromadb_document(
+        self, doc_id: str, data: Dict, now_iso: Optional[str] = None
+    ) -> Dict:
+        """
+        Создает документ для ChromaDB
+
+        Args:
+            doc_id: ID документа
+            data: Строка данных
+            now_iso: Метка времени обновления (общая для пачки документов)
+        """
         keywords = data.get("keywords", "").strip()
         answer_ukr = data.get("answer_ukr", "")[:200].strip()
         answer_rus = data.get("answer_rus", "")[:200].strip()
 
         # Объединяем все в один поисковый документ
-        search_text = f"""
-        Категория: {data.get('category', '')}
-        Ключевые слова: {keywords}
-        Украинский ответ: {answer_ukr}
-        Русский ответ: {answer_rus}
-        """.strip()
+        search_text = self._SEARCH_TEMPLATE.format_map(
+            {
+                "category": data.get("category", ""),
+                "keywords": keywords,
+                "answer_ukr": answer_ukr,
+                "answer_rus": answer_rus,
+            }
+        )
 
         return {
             "id": doc_id,
@@ -330,7 +574,7 @@ class SmartKnowledgeUpdater:
                 "answer_rus": data.get("answer_rus", ""),
                 "sort_order": data.get("sort_order", "999"),
                 "source": "csv",
-                "updated_at": datetime.now().isoformat(),
+                "updated_at": now_iso or datetime.now().isoformat(),
             },
         }
 
@@ -341,7 +585,7 @@ class SmartKnowledgeUpdater:
             csv_data = self.knowledge_base.load_csv_data()
 
             # Обнаруживаем изменения
-            changes = self.detect_changes(csv_data)
+            changes = self._detect_changes_cached(csv_data)
 
             recommendations = []
 
@@ -399,6 +643,7 @@ class SmartKnowledgeUpdater:
         """Полная перезагрузка базы знаний (принудительная)"""
         try:
             logger.info("Выполняется полная перезагрузка базы знаний...")
+            self._invalidate_changes_memo()
 
             # Сохраняем админские записи перед очисткой
             admin_records = self._preserve_admin_records()
@@ -411,14 +656,16 @@ class SmartKnowledgeUpdater:
 
             # Восстанавливаем админские записи
             restored_count = self._restore_admin_records(admin_records)
+            self._invalidate_upsell_cache()
 
             # Обновляем кеш (очищаем старый)
             cache = {"hashes": {}, "last_update": None}
             if csv_data:
+                cache["total_fingerprint"] = self._data_fingerprint(csv_data).hex()
                 # Создаем новый кеш для текущих данных
-                for i, row in enumerate(csv_data):
-                    stable_id = self.generate_stable_id(row, i)
-                    content_hash = self.generate_content_hash(row)
+                content_hashes = self._compute_all_hashes(csv_data)
+                for i, (row, content_hash) in enumerate(zip(csv_data, content_hashes)):
+                    stable_id = self.generate_stable_id(row, i, content_hash)
                     cache["hashes"][stable_id] = content_hash
             self.save_changes_cache(cache)
 
@@ -435,6 +682,7 @@ class SmartKnowledgeUpdater:
     def _preserve_admin_records(self) -> List[Dict]:
         """Сохраняет админские записи перед полной перезагрузкой"""
         admin_records = []
+        self.invalidate_admin_ids_cache()
 
         try:
             if not self.knowledge_base.is_initialized:
@@ -446,7 +694,7 @@ class SmartKnowledgeUpdater:
             if all_docs["metadatas"]:
                 for i, metadata in enumerate(all_docs["metadatas"]):
                     source = metadata.get("source", "")
-                    if source in ["admin_correction", "admin_addition"]:
+                    if source in _ADMIN_SOURCES:
                         admin_record = {
                             "id": all_docs["ids"][i],
                             "document": all_docs["documents"][i],
@@ -464,6 +712,7 @@ class SmartKnowledgeUpdater:
     def _restore_admin_records(self, admin_records: List[Dict]) -> int:
         """Восстанавливает админские записи после перезагрузки"""
         restored_count = 0
+        self.invalidate_admin_ids_cache()
 
         try:
             if not admin_records or not self.knowledge_base.is_initialized:
@@ -494,7 +743,7 @@ class SmartKnowledgeUpdater:
                 return {"strategy": "no_data", "reason": "Нет данных для анализа"}
 
             # Анализируем изменения
-            changes = self.detect_changes(csv_data)
+            changes = self._detect_changes_cached(csv_data)
 
             total_changes = (
                 len(changes["added"]) + len(changes["modified"]) + len(changes["deleted"])
@@ -530,5 +779,14 @@ class SmartKnowledgeUpdater:
             return {"strategy": "error", "reason": f"Ошибка анализа: {str(e)}"}
 
 
-# Глобальный экземпляр
-smart_updater = SmartKnowledgeUpdater()
+@functools.cache
+def get_smart_updater() -> SmartKnowledgeUpdater:
+    """Глобальный экземпляр (создается при первом обращении)"""
+    return SmartKnowledgeUpdater()
+
+
+def __getattr__(name: str):
+    """Ленивый доступ к `smart_updater`: `from ... import smart_updater` работает как раньше"""
+    if name == "smart_updater":
+        return get_smart_updater()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
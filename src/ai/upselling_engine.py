@@ -3,15 +3,65 @@
 Интегрируется с Google Sheets для управления ценами
 """
 
+import asyncio
+import functools
+import heapq
 import logging
+import math
+import operator
 import re
+import threading
+import time
+from dataclasses import dataclass
 from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 
+import numpy as np
+
 from src.ai.knowledge_base import knowledge_base
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 logger = logging.getLogger(__name__)
 
+# Сколько секунд живут записи категории в кеше (каталог меняется при синхронизации, а не на запрос)
+_CATEGORY_TTL = 300.0
+
+
+@functools.lru_cache(maxsize=2048)
+def _parse_triggers(upsell_triggers: str) -> frozenset:
+    """Триггеры upselling опции из строки через запятую (строки повторяются в каталоге)"""
+    return frozenset(t.strip() for t in upsell_triggers.split(","))
+
+
+def _trie_pattern(words) -> str:
+    """
+    Регулярное выражение по префиксному дереву слов
+
+    Общие префиксы проверяются один раз, поэтому в позиции без ключевого слова
+    поиск обрывается на первом символе, а не перебирает все альтернативы.
+    Жадные необязательные группы дают самое длинное слово в позиции
+    """
+    trie: Dict[str, dict] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: Dict[str, dict]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in node.items() if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Слово может закончиться здесь - продолжение необязательно
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
 
 class UpsellTriggerAnalyzer:
     """Анализатор триггеров для upselling"""
@@ -112,65 +162,150 @@ class UpsellTriggerAnalyzer:
             "base": 0.1,
         }
 
+        # Слова, определяющие фокус клиента (цена или качество)
+        self.focus_keywords = {
+            "price_sensitive": [
+                "дешево",
+                "недорого",
+                "бюджет",
+                "экономия",
+                "скидка",
+                "дешевле",
+                "выгодно",
+                "акция",
+                "минимальная цена",
+            ],
+            "quality_focused": [
+                "качество",
+                "лучший",
+                "премиум",
+                "элитный",
+                "статусный",
+                "престижный",
+                "эксклюзивный",
+                "люкс",
+                "высококачественный",
+            ],
+        }
+
+        # Все триггеры определяются за один проход по запросу: автоматом Ахо-Корасик,
+        # а без pyahocorasick - одним скомпилированным регулярным выражением
+        self._labels_by_keyword = self._collect_keyword_labels()
+        if ahocorasick is not None:
+            self._automaton = self._build_automaton()
+            self._keyword_re = None
+        else:
+            self._automaton = None
+            self._keyword_re = self._build_keyword_re()
+
+        # Запросы и наборы триггеров повторяются - результаты кешируются (LRU на экземпляр)
+        self._analyze_cached = functools.lru_cache(maxsize=4096)(self._analyze_triggers)
+
+        # Плотные целочисленные ID триггеров: набор триггеров - битовая маска,
+        # совпадения опции с запросом - побитовое И двух чисел
+        self._trigger_ids: Dict[str, int] = {}
+        self._weights_by_id: List[float] = []
+        # Анализатор общий для движков, вызывается и из потоков (asyncio.to_thread):
+        # новые ID выдаются под блокировкой, чтобы два триггера не получили один бит
+        self._trigger_id_lock = threading.Lock()
+        for trigger in self.trigger_weights:
+            self._trigger_id(trigger)
+        self._option_mask = functools.lru_cache(maxsize=2048)(self._parse_option_mask)
+        self._mask_relevance = functools.lru_cache(maxsize=4096)(self._sum_mask_weights)
+
+    def _collect_keyword_labels(self) -> Dict[str, frozenset]:
+        """
+        Ключевое слово -> триггеры и фокусы, которые срабатывают при его вхождении
+
+        Слово получает и метки всех ключевых слов, входящих в него как подстрока
+        ("очень быстро" -> urgent и time): регулярное выражение находит в каждой
+        позиции только самое длинное совпадение
+        """
+        labels_by_keyword: Dict[str, set] = {}
+        for groups in (self.trigger_keywords, self.focus_keywords):
+            for label, keywords in groups.items():
+                for keyword in keywords:
+                    labels_by_keyword.setdefault(keyword, set()).add(label)
+
+        return {
+            keyword: frozenset().union(
+                *(labels for other, labels in labels_by_keyword.items() if other in keyword)
+            )
+            for keyword in labels_by_keyword
+        }
+
+    def _build_automaton(self):
+        """Строит автомат Ахо-Корасик по всем ключевым словам"""
+        automaton = ahocorasick.Automaton()
+        for keyword, labels in self._labels_by_keyword.items():
+            automaton.add_word(keyword, labels)
+        automaton.make_automaton()
+        return automaton
+
+    def _build_keyword_re(self) -> re.Pattern:
+        """Компилирует одно выражение по всем ключевым словам (самое длинное совпадение)"""
+        # Lookahead не поглощает текст, поэтому совпадения ищутся в каждой позиции запроса
+        return re.compile("(?=(" + _trie_pattern(self._labels_by_keyword) + "))")
+
+    def _match_labels(self, query_lower: str) -> set:
+        """Все триггеры и фокусы, ключевые слова которых встречаются в запросе"""
+        matched = set()
+        if self._automaton is not None:
+            for _, labels in self._automaton.iter(query_lower):
+                matched |= labels
+        else:
+            labels_by_keyword = self._labels_by_keyword
+            for match in self._keyword_re.finditer(query_lower):
+                matched |= labels_by_keyword[match.group(1)]
+        return matched
+
     def analyze_query_triggers(self, query: str, user_context: Dict = None) -> List[str]:
         """Анализирует запрос и определяет активные триггеры"""
 
         if user_context is None:
             user_context = {}
 
-        active_triggers = []
-        query_lower = query.lower()
+        active_triggers = list(
+            self._analyze_cached(
+                query.lower().strip(),
+                bool(user_context.get("is_first_time", False)),
+                user_context.get("previous_orders", 0) > 0,
+            )
+        )
+
+        logger.info(f"Определены триггеры для запроса '{query[:50]}...': {active_triggers}")
+        return active_triggers
 
+    def _analyze_triggers(
+        self, query_lower: str, is_first_time: bool, is_returning: bool
+    ) -> Tuple[str, ...]:
+        """Определяет триггеры по нормализованному запросу и признакам клиента"""
         # Анализируем контекстные триггеры
-        for trigger, keywords in self.trigger_keywords.items():
-            if any(keyword in query_lower for keyword in keywords):
-                active_triggers.append(trigger)
+        matched = self._match_labels(query_lower)
+        active_triggers = [t for t in self.trigger_keywords if t in matched]
 
         # Поведенческие триггеры
-        if user_context.get("is_first_time", False):
+        if is_first_time:
             active_triggers.append("first_time")
 
-        if user_context.get("previous_orders", 0) > 0:
+        if is_returning:
             active_triggers.append("returning")
 
         # Определяем специальные фокусы клиента
-        if self._is_price_sensitive(query_lower):
+        if "price_sensitive" in matched:
             active_triggers.append("price_sensitive")
-        elif self._is_quality_focused(query_lower):
+        elif "quality_focused" in matched:
             active_triggers.append("quality_focused")
 
-        logger.info(f"Определены триггеры для запроса '{query[:50]}...': {active_triggers}")
-        return active_triggers
+        return tuple(active_triggers)
 
     def _is_price_sensitive(self, query_lower: str) -> bool:
         """Определяет, чувствителен ли клиент к цене"""
-        price_sensitive_words = [
-            "дешево",
-            "недорого",
-            "бюджет",
-            "экономия",
-            "скидка",
-            "дешевле",
-            "выгодно",
-            "акция",
-            "минимальная цена",
-        ]
-        return any(word in query_lower for word in price_sensitive_words)
+        return "price_sensitive" in self._match_labels(query_lower)
 
     def _is_quality_focused(self, query_lower: str) -> bool:
         """Определяет, фокусируется ли клиент на качестве"""
-        quality_words = [
-            "качество",
-            "лучший",
-            "премиум",
-            "элитный",
-            "статусный",
-            "престижный",
-            "эксклюзивный",
-            "люкс",
-            "высококачественный",
-        ]
-        return any(word in query_lower for word in quality_words)
+        return "quality_focused" in self._match_labels(query_lower)
 
     def calculate_trigger_relevance(
         self, upsell_triggers: str, active_triggers: List[str]
@@ -180,52 +315,149 @@ class UpsellTriggerAnalyzer:
         if not upsell_triggers or not active_triggers:
             return 0.0
 
-        # Парсим триггеры из строки (могут быть через запятую)
-        option_triggers = [t.strip() for t in upsell_triggers.split(",")]
-
-        relevance_score = 0.0
-
-        # Считаем совпадения триггеров
-        for option_trigger in option_triggers:
-            if option_trigger in active_triggers:
-                weight = self.trigger_weights.get(option_trigger, 0.5)
-                relevance_score += weight
-
-        return relevance_score
+        return self.option_relevance(upsell_triggers, self.trigger_mask(active_triggers))
+
+    def option_relevance(self, upsell_triggers: str, active_mask: int) -> float:
+        """Релевантность опции для маски активных триггеров (см. trigger_mask)"""
+        return self._mask_relevance(self._option_mask(upsell_triggers) & active_mask)
+
+    def option_mask(self, upsell_triggers: str) -> int:
+        """Битовая маска триггеров опции (строка триггеров через запятую)"""
+        return self._option_mask(upsell_triggers)
+
+    def mask_relevance(self, matched_mask: int) -> float:
+        """Сумма весов совпавших триггеров (маска опции И маска активных триггеров)"""
+        return self._mask_relevance(matched_mask)
+
+    def trigger_mask(self, triggers) -> int:
+        """Битовая маска набора триггеров"""
+        mask = 0
+        for trigger in triggers:
+            mask |= 1 << self._trigger_id(trigger)
+        return mask
+
+    def _trigger_id(self, trigger: str) -> int:
+        """ID триггера; триггеры не из trigger_weights получают новый ID (вес 0.5)"""
+        trigger_id = self._trigger_ids.get(trigger)
+        if trigger_id is None:
+            with self._trigger_id_lock:
+                trigger_id = self._trigger_ids.get(trigger)
+                if trigger_id is None:
+                    # Вес добавляется до публикации ID: бит маски всегда имеет вес
+                    trigger_id = len(self._weights_by_id)
+                    self._weights_by_id.append(self.trigger_weights.get(trigger, 0.5))
+                    self._trigger_ids[trigger] = trigger_id
+        return trigger_id
+
+    def _parse_option_mask(self, upsell_triggers: str) -> int:
+        """Маска триггеров опции из строки через запятую"""
+        return self.trigger_mask(_parse_triggers(upsell_triggers))
+
+    def _sum_mask_weights(self, mask: int) -> float:
+        """Сумма весов триггеров маски (fsum не зависит от порядка слагаемых)"""
+        weights = self._weights_by_id
+        return math.fsum(weights[i] for i in range(mask.bit_length()) if mask >> i & 1)
+
+
+@functools.cache
+def get_trigger_analyzer() -> UpsellTriggerAnalyzer:
+    """Общий анализатор триггеров: словари, автомат и кеши строятся один раз на процесс"""
+    return UpsellTriggerAnalyzer()
+
+
+# Плейсхолдеры цен в шаблонах ответов
+_PRICE_KEYS = ("base_price", "upsell_price", "total_price")
+_PRICE_TOKENS = tuple("{" + key + "}" for key in _PRICE_KEYS)
+
+# Заголовки блока upselling в финальном ответе (для остальных языков - русский)
+_UPSELL_HEADERS = {
+    "ukr": "\n\n✨ Додаткові можливості:",
+    "rus": "\n\n✨ Дополнительные возможности:",
+}
+
+
+def _split_upselling(results: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """Разделяет результаты на базовые и upselling за один проход"""
+    base_results, upsell_results = [], []
+    for result in results:
+        if result.get("metadata", {}).get("is_upselling", False):
+            upsell_results.append(result)
+        else:
+            base_results.append(result)
+    return base_results, upsell_results
+
+
+def _safe_price(price_value) -> Optional[float]:
+    """Цена как число или None, если значение не приводится к конечному числу"""
+    try:
+        price = float(price_value)
+    except (TypeError, ValueError):
+        return None
+    return price if math.isfinite(price) else None
+
+
+def _price_to_str(price_value) -> str:
+    """Цена в виде строки: числа - без дробной части"""
+    if isinstance(price_value, (int, float)):
+        return str(int(price_value))
+    return str(price_value)
 
 
 class PriceFormatter:
     """Форматировщик цен с поддержкой динамических значений из Google Sheets"""
 
     def __init__(self):
-        self.price_pattern = re.compile(r"\{(base_price|upsell_price|total_price)\}")
+        # Одни и те же шаблоны с одними и теми же ценами повторяются от запроса к запросу
+        self._format_cached = functools.lru_cache(maxsize=2048)(self._format_prices)
 
     def format_answer_with_prices(self, answer_template: str, price_data: Dict) -> str:
         """Форматирует ответ, подставляя актуальные цены"""
 
-        def replace_price(match):
-            price_key = match.group(1)
-            price_value = price_data.get(price_key, 0)
+        if "{" not in answer_template:
+            return answer_template
 
-            if isinstance(price_value, (int, float)):
-                return str(int(price_value))
-            return str(price_value)
+        # Результат зависит только от шаблона и трех цен (отсутствующая цена = 0)
+        return self._format_cached(
+            answer_template, *(price_data.get(key, 0) for key in _PRICE_KEYS)
+        )
 
-        formatted_answer = self.price_pattern.sub(replace_price, answer_template)
-        return formatted_answer
+    def _format_prices(self, answer_template: str, base_price, upsell_price, total_price) -> str:
+        """Подставляет цены в шаблон (прочие фигурные скобки в тексте остаются как есть)"""
+        formatted = answer_template
+        for token, price_value in zip(_PRICE_TOKENS, (base_price, upsell_price, total_price)):
+            if token in formatted:
+                formatted = formatted.replace(token, _price_to_str(price_value))
+        return formatted
 
     def calculate_total_price(self, base_price: float, upsell_price: float) -> float:
         """Вычисляет общую стоимость с upselling"""
         return base_price + upsell_price
 
 
+@dataclass(slots=True)
+class _CategoryIndex:
+    """Записи категории и их поля для отбора upselling опций в виде параллельных массивов"""
+
+    results: List[Dict]
+    priorities: np.ndarray
+    trigger_masks: np.ndarray
+    # Объединение масок триггеров всех upselling записей категории
+    trigger_union: int
+
+
 class UpsellEngine:
     """Основной движок upselling"""
 
     def __init__(self):
-        self.trigger_analyzer = UpsellTriggerAnalyzer()
+        self.trigger_analyzer = get_trigger_analyzer()
         self.price_formatter = PriceFormatter()
         self.knowledge_base = knowledge_base
+        # (категория, язык) -> (время загрузки, записи категории)
+        self._category_cache: Dict[Tuple[str, str], Tuple[float, _CategoryIndex]] = {}
+
+    def invalidate_category_cache(self) -> None:
+        """Сбрасывает кеш записей категорий (после обновления базы знаний)"""
+        self._category_cache.clear()
 
     def search_with_upselling(
         self, query: str, user_context: Dict = None, language: str = "ukr", max_upsell: int = 2
@@ -248,30 +480,94 @@ class UpsellEngine:
             # 2. Анализируем триггеры из запроса
             active_triggers = self.trigger_analyzer.analyze_query_triggers(query, user_context)
 
-            # 3. Находим релевантные upselling опции
-            upsell_options = self._find_upselling_options(base_results, active_triggers, language)
+            return self._complete_with_upselling(
+                base_results, active_triggers, language, max_upsell
+            )
 
-            # 4. Форматируем цены в ответах
-            formatted_results = self._format_results_with_prices(base_results + upsell_options)
+        except Exception as e:
+            logger.error(f"Ошибка в upselling движке: {e}")
+            # В случае ошибки возвращаем базовые результаты
+            return self.knowledge_base.search_knowledge(query, language)
 
-            # 5. Сортируем и ограничиваем количество upsell предложений
-            final_results = self._organize_results(formatted_results, max_upsell)
+    async def search_with_upselling_async(
+        self, query: str, user_context: Dict = None, language: str = "ukr", max_upsell: int = 2
+    ) -> List[Dict]:
+        """
+        Асинхронный search_with_upselling: запросы к ChromaDB выполняются в потоках,
+        не блокируя event loop, а триггеры анализируются во время базового поиска
+        """
+
+        if user_context is None:
+            user_context = {}
+
+        try:
+            logger.info(f"Начинаем поиск с upselling для запроса: {query[:50]}...")
 
-            logger.info(
-                f"Найдено {len(base_results)} базовых результатов и {len(upsell_options)} upselling опций"
+            # 1-2. Базовый поиск в потоке, параллельно - анализ триггеров
+            search_task = asyncio.ensure_future(
+                asyncio.to_thread(self.knowledge_base.search_knowledge, query, language)
             )
+            try:
+                active_triggers = self.trigger_analyzer.analyze_query_triggers(query, user_context)
+            finally:
+                base_results = await search_task
+
+            if not base_results:
+                logger.info("Базовые результаты не найдены")
+                return base_results
+
+            # Если записей категории нет в кеше, подбор опций идет в потоке (запрос к ChromaDB)
+            category = base_results[0].get("metadata", {}).get("category", "")
+            if category and active_triggers and not self._has_cached_category(category, language):
+                return await asyncio.to_thread(
+                    self._complete_with_upselling,
+                    base_results,
+                    active_triggers,
+                    language,
+                    max_upsell,
+                )
 
-            return final_results
+            return self._complete_with_upselling(
+                base_results, active_triggers, language, max_upsell
+            )
 
         except Exception as e:
             logger.error(f"Ошибка в upselling движке: {e}")
             # В случае ошибки возвращаем базовые результаты
-            return self.knowledge_base.search_knowledge(query, language)
+            return await asyncio.to_thread(self.knowledge_base.search_knowledge, query, language)
+
+    def _complete_with_upselling(
+        self,
+        base_results: List[Dict],
+        active_triggers: List[str],
+        language: str,
+        max_upsell: int,
+    ) -> List[Dict]:
+        """Добавляет к базовым результатам upselling опции и подставляет цены"""
+        # 3. Находим лучшие upselling опции (уже отсортированы и ограничены max_upsell)
+        upsell_options = self._find_upselling_options(
+            base_results, active_triggers, language, max_upsell
+        )
+
+        # 4. Форматируем цены в ответах: списки остаются раздельными до самого конца
+        formatted_base = self._format_results_with_prices(base_results)
+        formatted_upsell = self._format_results_with_prices(upsell_options)
+        final_results = formatted_base + formatted_upsell
+
+        logger.info(
+            f"Найдено {len(base_results)} базовых результатов и {len(upsell_options)} upselling опций"
+        )
+
+        return final_results
 
     def _find_upselling_options(
-        self, base_results: List[Dict], active_triggers: List[str], language: str
+        self,
+        base_results: List[Dict],
+        active_triggers: List[str],
+        language: str,
+        max_upsell: Optional[int] = None,
     ) -> List[Dict]:
-        """Находит подходящие upselling опции"""
+        """Находит подходящие upselling опции (не больше max_upsell, лучшие первыми)"""
 
         if not base_results or not active_triggers:
             return []
@@ -283,47 +579,85 @@ class UpsellEngine:
             return []
 
         # Получаем все записи для данной категории
-        all_category_results = self._get_category_results(main_category, language)
+        index = self._get_category_index(main_category, language)
+        if index is None:
+            return []
 
-        # Фильтруем потенциальные upselling опции
-        upsell_candidates = []
+        # Маска строится один раз, а не для каждой опции
+        analyzer = self.trigger_analyzer
+        active_mask = analyzer.trigger_mask(active_triggers)
 
-        for result in all_category_results:
-            metadata = result.get("metadata", {})
-            priority = int(metadata.get("priority", 10))
-            upsell_trigger = metadata.get("upsell_trigger", "")
+        # Ни один активный триггер не встречается в upselling записях категории
+        if not active_mask & index.trigger_union:
+            return []
 
-            # Пропускаем базовые ответы (priority 10) и записи без триггеров
-            if priority >= 10 or not upsell_trigger:
-                continue
+        trigger_masks = index.trigger_masks
+        if active_mask.bit_length() > 64 and trigger_masks.dtype != object:
+            trigger_masks = trigger_masks.astype(object)
 
+        # Одним векторным выражением пропускаем базовые ответы (priority 10)
+        # и записи без общих с запросом триггеров
+        matched_masks = trigger_masks & active_mask
+        candidate_rows = np.flatnonzero((index.priorities < 10) & (matched_masks != 0))
+
+        # Фильтруем потенциальные upselling опции: (финальный скор, релевантность,
+        # скор приоритета, результат) - результаты копируются только для отобранных
+        scored_candidates = []
+        for row in candidate_rows.tolist():
             # Вычисляем релевантность триггеров
-            trigger_relevance = self.trigger_analyzer.calculate_trigger_relevance(
-                upsell_trigger, active_triggers
-            )
+            trigger_relevance = analyzer.mask_relevance(int(matched_masks[row]))
 
             if trigger_relevance > 0.3:  # Минимальный порог релевантности
-                # Добавляем метаданные для upselling
-                result["metadata"]["is_upselling"] = True
-                result["metadata"]["trigger_relevance"] = trigger_relevance
-                result["metadata"]["priority_score"] = (11 - priority) / 10.0
-                result["metadata"]["final_score"] = (
-                    trigger_relevance + result["metadata"]["priority_score"]
+                priority = int(index.priorities[row])
+                result = index.results[row]
+                priority_score = (11 - priority) / 10.0
+                scored_candidates.append(
+                    (trigger_relevance + priority_score, trigger_relevance, priority_score, result)
                 )
 
-                upsell_candidates.append(result)
-
-        # Сортируем по финальному скору
-        upsell_candidates.sort(key=lambda x: x["metadata"]["final_score"], reverse=True)
+        # Сортируем по финальному скору: полная сортировка не нужна, если нужны лишь лучшие
+        final_score = operator.itemgetter(0)
+        if max_upsell is None:
+            best = sorted(scored_candidates, key=final_score, reverse=True)
+        else:
+            best = heapq.nlargest(max_upsell, scored_candidates, key=final_score)
+
+        # Добавляем метаданные для upselling (в копию: записи категории кешируются)
+        return [
+            {
+                **result,
+                "metadata": {
+                    **result.get("metadata", {}),
+                    "is_upselling": True,
+                    "trigger_relevance": trigger_relevance,
+                    "priority_score": priority_score,
+                    "final_score": score,
+                },
+            }
+            for score, trigger_relevance, priority_score, result in best
+        ]
 
-        return upsell_candidates
+    def _has_cached_category(self, category: str, language: str) -> bool:
+        """Есть ли в кеше неустаревшие записи категории"""
+        entry = self._category_cache.get((category, language))
+        return entry is not None and time.monotonic() - entry[0] < _CATEGORY_TTL
 
     def _get_category_results(self, category: str, language: str) -> List[Dict]:
-        """Получает все результаты для определенной категории"""
+        """Получает все результаты для определенной категории (кешируются на _CATEGORY_TTL)"""
+        index = self._get_category_index(category, language)
+        return index.results if index is not None else []
+
+    def _get_category_index(self, category: str, language: str) -> Optional[_CategoryIndex]:
+        """Записи категории с массивами приоритетов и масок триггеров (из кеша или ChromaDB)"""
+
+        cache_key = (category, language)
+        entry = self._category_cache.get(cache_key)
+        if entry is not None and time.monotonic() - entry[0] < _CATEGORY_TTL:
+            return entry[1]
 
         try:
             if not self.knowledge_base.is_initialized:
-                return []
+                return None
 
             # Получаем все документы категории
             all_docs = self.knowledge_base.collection.get(
@@ -345,117 +679,157 @@ class UpsellEngine:
                     }
                     results.append(result)
 
-            return results
+            index = self._build_category_index(results)
+            self._category_cache[cache_key] = (time.monotonic(), index)
+            return index
 
         except Exception as e:
             logger.error(f"Ошибка получения результатов категории {category}: {e}")
-            return []
+            return None
+
+    def _build_category_index(self, results: List[Dict]) -> _CategoryIndex:
+        """Строит массивы приоритетов и масок триггеров для записей категории"""
+        analyzer = self.trigger_analyzer
+        priorities = []
+        masks = []
+        trigger_union = 0
+        for result in results:
+            metadata = result["metadata"]
+            priority = int(metadata.get("priority", 10))
+            upsell_trigger = metadata.get("upsell_trigger", "")
+            mask = analyzer.option_mask(upsell_trigger) if upsell_trigger else 0
+            priorities.append(priority)
+            masks.append(mask)
+            if priority < 10:
+                trigger_union |= mask
+
+        # Маски до 64 триггеров - uint64, иначе (много нестандартных триггеров) - int Python
+        fits_uint64 = max(masks, default=0).bit_length() <= 64
+        return _CategoryIndex(
+            results=results,
+            priorities=np.array(priorities, dtype=np.int64),
+            trigger_masks=np.array(masks, dtype=np.uint64 if fits_uint64 else object),
+            trigger_union=trigger_union,
+        )
 
     def _format_results_with_prices(self, results: List[Dict]) -> List[Dict]:
         """Форматирует результаты, подставляя актуальные цены"""
 
         formatted_results = []
+        invalid_prices = 0
 
         for result in results:
-            try:
-                metadata = result.get("metadata", {})
+            answer = result.get("answer", "")
 
-                # Собираем данные о ценах
-                price_data = {
-                    "base_price": metadata.get("base_price", 0),
-                    "upsell_price": metadata.get("upsell_price", 0),
-                }
+            # В ответе нет плейсхолдеров - подставлять нечего
+            if "{" not in answer:
+                formatted_results.append(result)
+                continue
+
+            metadata = result.get("metadata", {})
 
-                # Вычисляем общую цену
-                if price_data["base_price"] and price_data["upsell_price"]:
+            # Собираем данные о ценах
+            price_data = {
+                "base_price": metadata.get("base_price", 0),
+                "upsell_price": metadata.get("upsell_price", 0),
+            }
+
+            # Вычисляем общую цену
+            if price_data["base_price"] and price_data["upsell_price"]:
+                base_price = _safe_price(price_data["base_price"])
+                upsell_price = _safe_price(price_data["upsell_price"])
+                if base_price is not None and upsell_price is not None:
                     price_data["total_price"] = self.price_formatter.calculate_total_price(
-                        float(price_data["base_price"]), float(price_data["upsell_price"])
+                        base_price, upsell_price
                     )
+                else:
+                    invalid_prices += 1
+
+            # Форматируем ответ с ценами
+            formatted_answer = self.price_formatter.format_answer_with_prices(answer, price_data)
+
+            # Новый результат с собственными метаданными: исходный не изменяется
+            formatted_results.append(
+                {
+                    **result,
+                    "answer": formatted_answer,
+                    "metadata": {**metadata, "formatted_prices": price_data},
+                }
+            )
 
-                # Форматируем ответ с ценами
-                formatted_answer = self.price_formatter.format_answer_with_prices(
-                    result["answer"], price_data
-                )
-
-                formatted_result = result.copy()
-                formatted_result["answer"] = formatted_answer
-                formatted_result["metadata"]["formatted_prices"] = price_data
-
-                formatted_results.append(formatted_result)
-
-            except Exception as e:
-                logger.error(f"Ошибка форматирования цен для результата: {e}")
-                # В случае ошибки добавляем результат без форматирования
-                formatted_results.append(result)
+        if invalid_prices:
+            logger.warning(
+                f"Нечисловые цены в {invalid_prices} результатах, общая цена не посчитана"
+            )
 
         return formatted_results
 
-    def _organize_results(self, all_results: List[Dict], max_upsell: int) -> List[Dict]:
-        """Организует результаты: базовые + ограниченное количество upselling"""
-
-        base_results = [
-            r for r in all_results if not r.get("metadata", {}).get("is_upselling", False)
-        ]
-        upsell_results = [
-            r for r in all_results if r.get("metadata", {}).get("is_upselling", False)
-        ]
-
-        # Ограничиваем количество upselling предложений
-        limited_upsell = upsell_results[:max_upsell]
-
-        # Объединяем: сначала базовые, потом upselling
-        final_results = base_results + limited_upsell
-
-        return final_results
-
-    def format_final_answer(self, results: List[Dict], language: str = "ukr") -> str:
-        """Форматирует финальный ответ с upselling предложениями"""
-
-        if not results:
+    def format_final_answer(
+        self,
+        results: List[Dict],
+        language: str = "ukr",
+        upsell_results: Optional[List[Dict]] = None,
+    ) -> str:
+        """
+        Форматирует финальный ответ с upselling предложениями
+
+        Args:
+            results: Результаты search_with_upselling или, если передан upsell_results,
+                только базовые результаты
+            language: Язык ответа
+            upsell_results: Upselling результаты отдельным списком (без разделения results)
+        """
+
+        if upsell_results is None:
+            base_results, upsell_results = _split_upselling(results)
+        else:
+            base_results = results
+
+        if not base_results and not upsell_results:
             return ""
 
-        base_results = [r for r in results if not r.get("metadata", {}).get("is_upselling", False)]
-        upsell_results = [r for r in results if r.get("metadata", {}).get("is_upselling", False)]
-
         # Основной ответ
         main_answer = base_results[0]["answer"] if base_results else ""
 
         # Добавляем upselling предложения
         if upsell_results:
-            upsell_header = (
-                "\n\n✨ Додаткові можливості:"
-                if language == "ukr"
-                else "\n\n✨ Дополнительные возможности:"
-            )
-
-            upsell_text = upsell_header
-            for i, option in enumerate(upsell_results, 1):
-                upsell_text += f"\n• {option['answer']}"
-
-            main_answer += upsell_text
+            parts = [main_answer, _UPSELL_HEADERS.get(language, _UPSELL_HEADERS["rus"])]
+            parts.extend(f"\n• {option['answer']}" for option in upsell_results)
+            main_answer = "".join(parts)
 
         return main_answer
 
-    def get_upselling_analytics(self, results: List[Dict]) -> Dict:
-        """Возвращает аналитику по upselling для мониторинга"""
-
-        base_count = len(
-            [r for r in results if not r.get("metadata", {}).get("is_upselling", False)]
-        )
-        upsell_count = len([r for r in results if r.get("metadata", {}).get("is_upselling", False)])
+    def get_upselling_analytics(
+        self, results: List[Dict], upsell_results: Optional[List[Dict]] = None
+    ) -> Dict:
+        """
+        Возвращает аналитику по upselling для мониторинга
+
+        Args:
+            results: Результаты search_with_upselling или, если передан upsell_results,
+                только базовые результаты
+            upsell_results: Upselling результаты отдельным списком (без разделения results)
+        """
+
+        if upsell_results is None:
+            base_results, upsell_results = _split_upselling(results)
+        else:
+            base_results = results
+        base_count = len(base_results)
+        upsell_count = len(upsell_results)
+        total_count = base_count + upsell_count
 
         upsell_triggers = []
-        for result in results:
-            if result.get("metadata", {}).get("is_upselling", False):
-                trigger = result.get("metadata", {}).get("upsell_trigger", "")
-                if trigger:
-                    upsell_triggers.extend(trigger.split(","))
+        for result in upsell_results:
+            trigger = result["metadata"].get("upsell_trigger", "")
+            if trigger:
+                upsell_triggers.extend(trigger.split(","))
 
         return {
-            "total_results": len(results),
+            "total_results": total_count,
             "base_results": base_count,
             "upsell_results": upsell_count,
-            "upsell_ratio": upsell_count / len(results) if results else 0,
+            "upsell_ratio": upsell_count / total_count if total_count else 0,
             "active_triggers": list(set(upsell_triggers)),
             "timestamp": datetime.now().isoformat(),
         }
@@ -4,15 +4,23 @@
 """
 
 from .analytics_service import analytics_service
-from .models import analytics_db, UserQuery, FeedbackEntry, KnowledgeGap
+from .models import get_analytics_db, UserQuery, FeedbackEntry, KnowledgeGap
 from .dashboard import dashboard, create_simple_report
 
 __all__ = [
     "analytics_service",
     "analytics_db",
+    "get_analytics_db",
     "UserQuery",
     "FeedbackEntry",
     "KnowledgeGap",
     "dashboard",
     "create_simple_report",
 ]
+
+
+def __getattr__(name: str):
+    """Ленивый доступ к `analytics_db` (база открывается при первом обращении)"""
+    if name == "analytics_db":
+        return get_analytics_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
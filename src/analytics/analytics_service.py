@@ -3,26 +3,312 @@
 Собирает данные о запросах пользователей, ответах системы и пробелах в знаниях
 """
 
+import atexit
+import functools
 import json
 import logging
+import queue
+import threading
 import time
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 import re
 
-from .models import UserQuery, FeedbackEntry, KnowledgeGap, analytics_db
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+from .models import (
+    SQLITE_HAS_MATERIALIZED_CTE,
+    SQLITE_HAS_RETURNING,
+    UserQuery,
+    FeedbackEntry,
+    AnalyticsDatabase,
+    get_analytics_db,
+)
 
 logger = logging.getLogger(__name__)
 
+# Фоновая запись: сколько операций объединяется в одну транзакцию
+# и сколько ждать следующих операций после первой (секунды)
+_WRITE_BATCH_SIZE = 200
+_WRITE_BATCH_WAIT = 0.05
+# ID запросов и фидбека выдаются сразу из блока, зарезервированного в базе (см. reserve_ids)
+_ID_BLOCK_SIZE = 64
+
+# Сколько секунд отдается сохраненная сводка для дашборда (страница обновляется каждые 30 с)
+_SUMMARY_TTL = 20.0
+# Сколько последних периодов (days) хранит кеш сводки: days приходит из запроса дашборда
+_SUMMARY_CACHE_SIZE = 8
+
+# Ключевые слова категорий пробелов в знаниях (при совпадении нескольких - первая категория)
+_CATEGORY_KEYWORDS = {
+    "визитки": ["визитк", "визитни", "business card"],
+    "футболки": ["футболк", "майк", "t-shirt", "tshirt"],
+    "листовки": ["листовк", "листівк", "flyer"],
+    "наклейки": ["наклейк", "наклійк", "sticker"],
+    "блокноты": ["блокнот", "блокнот", "notebook"],
+    "цены": ["цена", "ціна", "стоимость", "вартість", "коштує", "стоит"],
+    "сроки": ["срок", "термін", "время", "час", "быстро", "швидко"],
+    "качество": ["качество", "якість", "материал", "матеріал"],
+}
+_CATEGORIES = list(_CATEGORY_KEYWORDS)
+
+# Приоритет пробела: ключевые слова ищутся как подстроки (ловят и словоформы:
+# "срочное", "какой"), каждая группа - одним проходом регулярного выражения
+_HIGH_PRIORITY_KEYWORDS = ("цена", "ціна", "стоимость", "купить", "заказать", "срочно")
+_MEDIUM_PRIORITY_KEYWORDS = ("как", "что", "когда", "где", "почему")
+_HIGH_PRIORITY_RE = re.compile("|".join(map(re.escape, _HIGH_PRIORITY_KEYWORDS)))
+_MEDIUM_PRIORITY_RE = re.compile("|".join(map(re.escape, _MEDIUM_PRIORITY_KEYWORDS)))
+
+# Нормализация запроса в паттерн пробела в знаниях
+_PUNCT_RE = re.compile(r"[^\w\s]")
+_DIGITS_RE = re.compile(r"\d+")
+
+_INSERT_QUERY_SQL = """
+    INSERT INTO user_queries (
+        id, user_id, query_text, language, timestamp,
+        ai_response, confidence, source, should_contact_manager,
+        context_used, search_type, relevance_scores,
+        is_answered, response_time_ms
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_UPDATE_RESPONSE_SQL = """
+    UPDATE user_queries SET
+        ai_response = ?,
+        confidence = ?,
+        source = ?,
+        should_contact_manager = ?,
+        context_hash = ?,
+        search_type = ?,
+        relevance_scores = ?,
+        is_answered = ?,
+        response_time_ms = ?
+    WHERE id = ?
+"""
+# Текст и язык обновленного запроса нужны для пробела в знаниях
+_UPDATE_RESPONSE_RETURNING_SQL = _UPDATE_RESPONSE_SQL + "RETURNING query_text, language"
+_SELECT_QUERY_TEXT_SQL = "SELECT query_text, language FROM user_queries WHERE id = ?"
+
+_INSERT_FEEDBACK_SQL = """
+    INSERT INTO feedback_entries (
+        id, user_id, query_id, feedback_type, feedback_text, timestamp
+    ) VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+_INSERT_CONTEXT_SQL = "INSERT OR IGNORE INTO context_blobs (hash, text) VALUES (?, ?)"
+
+# Повторный пробел в знаниях увеличивает частоту существующей записи (уникальный ключ -
+# паттерн и язык), первый - создает запись с частотой 1
+_UPSERT_GAP_SQL = """
+    INSERT INTO knowledge_gaps (
+        query_pattern, frequency, category, language,
+        priority, status, first_seen, last_seen
+    ) VALUES (?, 1, ?, ?, ?, 'new', ?, ?)
+    ON CONFLICT (query_pattern, language) DO UPDATE SET
+        frequency = frequency + 1,
+        last_seen = excluded.last_seen,
+        status = excluded.status
+"""
+
+# Выборка за период читается сводкой трижды - просим SQLite вычислить ее один раз
+_MATERIALIZED = "MATERIALIZED" if SQLITE_HAS_MATERIALIZED_CTE else ""
+
 
 class AnalyticsService:
     """Сервис для сбора и анализа данных о работе AI бота"""
 
     def __init__(self):
-        self.db = analytics_db
+        self._db: Optional[AnalyticsDatabase] = None
         self.confidence_threshold = 0.7  # Порог для определения "хорошего" ответа
+        # Счетчики запросов, отклоненных до обработки (по причинам)
+        self.rejected_counts: Counter = Counter()
+
+        # Запросы, ответы и фидбек пишутся фоновым потоком пачками:
+        # ("query" | "response" | "feedback", параметры)
+        self._write_queue: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        # Зарезервированные в базе ID, выдаваемые до записи: {таблица: итератор блока}
+        self._reserved_ids: Dict[str, Iterator[int]] = {}
+        self._id_lock = threading.Lock()
+
+        # Паттерн, категория и приоритет пробела зависят только от текста запроса,
+        # а неотвеченные запросы повторяются - результаты кешируются
+        self._gap_fields = functools.lru_cache(maxsize=1024)(self._derive_gap_fields)
+
+        # Сводка по days и предложения: (время расчета, результат)
+        self._summary_cache: Dict[int, Tuple[float, Dict]] = {}
+        self._suggestions_cache: Optional[Tuple[float, List[Dict]]] = None
+
+        # Все ключевые слова категорий ищутся за один проход автомата Ахо-Корасик
+        self._category_automaton = (
+            self._build_category_automaton() if ahocorasick is not None else None
+        )
         logger.info("Analytics Service инициализирован")
 
+    @property
+    def db(self) -> AnalyticsDatabase:
+        """База данных аналитики (открывается при первом обращении)"""
+        if self._db is None:
+            self._db = get_analytics_db()
+        return self._db
+
+    @db.setter
+    def db(self, value: AnalyticsDatabase) -> None:
+        self._db = value
+        self._reserved_ids = {}
+
+    def _next_id(self, table: str) -> int:
+        """Выдает следующий зарезервированный ID таблицы (новый блок - когда блок исчерпан)"""
+        with self._id_lock:
+            next_id = next(self._reserved_ids.get(table, iter(())), None)
+            if next_id is None:
+                ids = iter(self.db.reserve_ids(table, _ID_BLOCK_SIZE))
+                self._reserved_ids[table] = ids
+                next_id = next(ids)
+            return next_id
+
+    def _start_writer(self):
+        """Запускает поток записи (при первой записи)"""
+        with self._writer_lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(
+                target=self._write_loop, name="analytics-writer", daemon=True
+            )
+            self._writer.start()
+            atexit.register(self.flush)
+
+    def _enqueue_write(self, kind: str, params: tuple):
+        """Ставит операцию в очередь фоновой записи"""
+        if self._writer is None:
+            self._start_writer()
+        self._write_queue.put((kind, params))
+
+    def flush(self):
+        """Дожидается записи всех поставленных в очередь операций"""
+        if self._writer is not None:
+            self._write_queue.join()
+
+    def close(self):
+        """Дописывает очередь и останавливает поток записи"""
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._write_queue.put(None)
+            writer.join()
+            atexit.unregister(self.flush)
+
+    def _write_loop(self):
+        """Поток записи: собирает до _WRITE_BATCH_SIZE операций и пишет их одной транзакцией"""
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                self._write_queue.task_done()
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + _WRITE_BATCH_WAIT
+            while len(batch) < _WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Остановка: дописываем пачку, признак вернется в очередь
+                    self._write_queue.task_done()
+                    self._write_queue.put(None)
+                    break
+                batch.append(item)
+
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.warning(f"Пачка аналитики ({len(batch)} операций) не записана: {e}")
+                self._write_each(batch)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+
+    def _write_each(self, batch: List[Tuple[str, tuple]]):
+        """
+        Пишет операции пачки по одной, чтобы ошибка одной не теряла остальные
+
+        Ответ на запрос, который не записался, пропускается, а фидбек к нему пишется
+        без ссылки на запрос: запись с тем же ID может принадлежать другому писателю
+        """
+        failed_queries = set()
+        for kind, params in batch:
+            # params[-1] ответа и params[2] фидбека - ID запроса
+            if kind == "response" and params[-1] in failed_queries:
+                logger.error(f"Ответ на незаписанный запрос {params[-1]} пропущен")
+                continue
+            if kind == "feedback" and params[2] in failed_queries:
+                params = params[:2] + (None,) + params[3:]
+            try:
+                self._write_batch([(kind, params)])
+            except Exception as e:
+                logger.error(f"Ошибка при записи аналитики ({kind}): {e}")
+                if kind == "query":
+                    failed_queries.add(params[0])
+
+    def _write_batch(self, batch: List[Tuple[str, tuple]]):
+        """Пишет пачку операций и пробелы в знаниях по плохим ответам одной транзакцией"""
+        # Вставки идут первыми одним executemany: ответ в пачке может ссылаться
+        # на запрос из той же пачки, но не наоборот
+        inserts = [params for kind, params in batch if kind == "query"]
+        updates = [params for kind, params in batch if kind == "response"]
+        feedback = [params for kind, params in batch if kind == "feedback"]
+        gaps = []
+        now = int(time.time())
+
+        # Контекст ответа (params[4]) пишется один раз на текст, в запись - только его хеш
+        contexts = {}
+        for index, params in enumerate(updates):
+            context_used = params[4]
+            context_hash = None
+            if context_used:
+                context_hash = self.db.context_digest(context_used)
+                contexts[context_hash] = context_used
+            updates[index] = params[:4] + (context_hash,) + params[5:]
+
+        with self.db._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if inserts:
+                conn.executemany(_INSERT_QUERY_SQL, inserts)
+            if feedback:
+                conn.executemany(_INSERT_FEEDBACK_SQL, feedback)
+            if contexts:
+                conn.executemany(_INSERT_CONTEXT_SQL, contexts.items())
+            for params in updates:
+                query_row = self._update_response(conn, params)
+                # Если ответ плохой (params[7] - is_answered) - это пробел в знаниях
+                if query_row and not params[7]:
+                    pattern, category, priority = self._gap_fields(query_row["query_text"])
+                    gaps.append((pattern, category, query_row["language"], priority, now, now))
+            if gaps:
+                conn.executemany(_UPSERT_GAP_SQL, gaps)
+
+        for gap in gaps:
+            logger.info(f"Пробел в знаниях залогирован: {gap[0]}")
+
+    @staticmethod
+    def _update_response(conn, params: tuple):
+        """Записывает ответ в запрос, возвращает (query_text, language) запроса или None"""
+        if SQLITE_HAS_RETURNING:
+            return conn.execute(_UPDATE_RESPONSE_RETURNING_SQL, params).fetchone()
+        # SQLite до 3.35: UPDATE и отдельный SELECT (params[-1] - ID запроса)
+        if not conn.execute(_UPDATE_RESPONSE_SQL, params).rowcount:
+            return None
+        return conn.execute(_SELECT_QUERY_TEXT_SQL, (params[-1],)).fetchone()
+
     def log_user_query(self, user_id: int, query_text: str, language: str = "ukr") -> int:
         """
         Логирует пользовательский запрос (вызывается в начале обработки)
@@ -33,16 +319,51 @@ class AnalyticsService:
             language: Язык запроса
 
         Returns:
-            ID записи в базе данных
+            ID записи в базе данных (выдается сразу из зарезервированного блока,
+            запись выполняется в фоне)
         """
         query = UserQuery(
-            user_id=user_id, query_text=query_text, language=language, timestamp=datetime.now()
+            id=self._next_id("user_queries"),
+            user_id=user_id,
+            query_text=query_text,
+            language=language,
+            timestamp=datetime.now(),
+        )
+        query_id = query.id
+
+        self._enqueue_write(
+            "query",
+            (
+                query.id,
+                query.user_id,
+                query.query_text,
+                query.language,
+                int(query.timestamp.timestamp()),
+                query.ai_response,
+                query.confidence,
+                query.source,
+                query.should_contact_manager,
+                query.context_used,
+                query.search_type,
+                query.relevance_scores,
+                query.is_answered,
+                query.response_time_ms,
+            ),
         )
-
-        query_id = self.db.save_user_query(query)
         logger.debug(f"Запрос пользователя {user_id} залогирован с ID {query_id}")
         return query_id
 
+    def log_rejected(self, user_id: int, reason: str):
+        """
+        Учитывает запрос, отклоненный без обработки (пустой, без текста и т.п.)
+
+        Args:
+            user_id: ID пользователя
+            reason: Причина отклонения ("empty", "too_short", "no_text")
+        """
+        self.rejected_counts[reason] += 1
+        logger.debug(f"Запрос пользователя {user_id} отклонен: {reason}")
+
     def log_ai_response(
         self,
         query_id: int,
@@ -69,58 +390,26 @@ class AnalyticsService:
             relevance_scores: Скоры релевантности найденных документов
             response_time_ms: Время ответа в миллисекундах
         """
-        try:
-            # Обновляем существующую запись
-            with self.db._get_connection() as conn:
-                is_answered = confidence >= self.confidence_threshold
-                relevance_json = json.dumps(relevance_scores or [])
-
-                conn.execute(
-                    """
-                    UPDATE user_queries SET
-                        ai_response = ?,
-                        confidence = ?,
-                        source = ?,
-                        should_contact_manager = ?,
-                        context_used = ?,
-                        search_type = ?,
-                        relevance_scores = ?,
-                        is_answered = ?,
-                        response_time_ms = ?
-                    WHERE id = ?
-                """,
-                    (
-                        ai_response,
-                        confidence,
-                        source,
-                        should_contact_manager,
-                        context_used,
-                        search_type,
-                        relevance_json,
-                        is_answered,
-                        response_time_ms,
-                        query_id,
-                    ),
-                )
-                conn.commit()
-
-            # Если ответ плохой - логируем как пробел в знаниях
-            if not is_answered:
-                # Получаем информацию о запросе
-                with self.db._get_connection() as conn:
-                    query_row = conn.execute(
-                        "SELECT query_text, language FROM user_queries WHERE id = ?", (query_id,)
-                    ).fetchone()
-
-                    if query_row:
-                        self._log_knowledge_gap(query_row["query_text"], query_row["language"])
-
-            logger.debug(
-                f"AI ответ для запроса {query_id} залогирован (confidence: {confidence:.3f})"
-            )
-
-        except Exception as e:
-            logger.error(f"Ошибка при логировании AI ответа: {e}")
+        is_answered = confidence >= self.confidence_threshold
+        relevance_json = json.dumps(relevance_scores or [])
+
+        # Обновление записи и пробел в знаниях (если ответ плохой) пишутся в фоне
+        self._enqueue_write(
+            "response",
+            (
+                ai_response,
+                confidence,
+                source,
+                should_contact_manager,
+                context_used,
+                search_type,
+                relevance_json,
+                is_answered,
+                response_time_ms,
+                query_id,
+            ),
+        )
+        logger.debug(f"AI ответ для запроса {query_id} залогирован (confidence: {confidence:.3f})")
 
     def log_feedback(
         self, user_id: int, query_id: Optional[int], feedback_type: str, feedback_text: str = ""
@@ -135,94 +424,113 @@ class AnalyticsService:
             feedback_text: Дополнительный текст фидбека
 
         Returns:
-            ID записи фидбека
+            ID записи фидбека (выдается сразу из зарезервированного блока,
+            запись выполняется в фоне)
         """
         feedback = FeedbackEntry(
+            id=self._next_id("feedback_entries"),
             user_id=user_id,
             query_id=query_id,
             feedback_type=feedback_type,
             feedback_text=feedback_text,
         )
 
-        feedback_id = self.db.save_feedback(feedback)
+        self._enqueue_write(
+            "feedback",
+            (
+                feedback.id,
+                feedback.user_id,
+                feedback.query_id,
+                feedback.feedback_type,
+                feedback.feedback_text,
+                int(feedback.timestamp.timestamp()),
+            ),
+        )
         logger.info(f"Фидбек от пользователя {user_id} залогирован: {feedback_type}")
-        return feedback_id
-
-    def _log_knowledge_gap(self, query_text: str, language: str):
-        """Логирует пробел в знаниях на основе неотвеченного запроса"""
-        try:
-            # Нормализуем запрос для создания паттерна
-            pattern = self._normalize_query_pattern(query_text)
-            category = self._classify_query_category(query_text)
-            priority = self._calculate_gap_priority(query_text)
-
-            gap = KnowledgeGap(
-                query_pattern=pattern,
-                category=category,
-                language=language,
-                priority=priority,
-                status="new",
-            )
-
-            self.db.save_knowledge_gap(gap)
-            logger.info(f"Пробел в знаниях залогирован: {pattern}")
-
-        except Exception as e:
-            logger.error(f"Ошибка при логировании пробела в знаниях: {e}")
+        return feedback.id
+
+    def _derive_gap_fields(self, query_text: str) -> Tuple[str, str, str]:
+        """Паттерн, категория и приоритет пробела в знаниях для неотвеченного запроса"""
+        return (
+            self._normalize_query_pattern(query_text),
+            self._classify_query_category(query_text),
+            self._calculate_gap_priority(query_text),
+        )
 
     def _normalize_query_pattern(self, query: str) -> str:
         """Нормализует запрос для создания паттерна поиска"""
         # Убираем лишние символы и приводим к нижнему регистру
-        pattern = re.sub(r"[^\w\s]", "", query.lower().strip())
+        # (пробелы по краям уйдут при схлопывании пробелов ниже)
+        pattern = _PUNCT_RE.sub("", query.lower())
 
         # Заменяем числа на плейсхолдеры
-        pattern = re.sub(r"\d+", "[ЧИСЛО]", pattern)
-
-        # Убираем лишние пробелы
-        pattern = re.sub(r"\s+", " ", pattern).strip()
-
-        return pattern
+        pattern = _DIGITS_RE.sub("[ЧИСЛО]", pattern)
+
+        # Убираем лишние пробелы: split() делит по тем же символам, что и \s
+        return " ".join(pattern.split())
+
+    @staticmethod
+    def _build_category_automaton() -> "ahocorasick.Automaton":
+        """Строит автомат: ключевое слово -> номер первой категории, в которой оно есть"""
+        automaton = ahocorasick.Automaton()
+        for rank, keywords in enumerate(_CATEGORY_KEYWORDS.values()):
+            for keyword in keywords:
+                if keyword not in automaton:
+                    automaton.add_word(keyword, rank)
+        automaton.make_automaton()
+        return automaton
 
     def _classify_query_category(self, query: str) -> str:
         """Классифицирует запрос по категории"""
         query_lower = query.lower()
 
-        category_keywords = {
-            "визитки": ["визитк", "визитни", "business card"],
-            "футболки": ["футболк", "майк", "t-shirt", "tshirt"],
-            "листовки": ["листовк", "листівк", "flyer"],
-            "наклейки": ["наклейк", "наклійк", "sticker"],
-            "блокноты": ["блокнот", "блокнот", "notebook"],
-            "цены": ["цена", "ціна", "стоимость", "вартість", "коштує", "стоит"],
-            "сроки": ["срок", "термін", "время", "час", "быстро", "швидко"],
-            "качество": ["качество", "якість", "материал", "матеріал"],
-        }
-
-        for category, keywords in category_keywords.items():
+        if self._category_automaton is not None:
+            ranks = [rank for _, rank in self._category_automaton.iter(query_lower)]
+            return _CATEGORIES[min(ranks)] if ranks else "общее"
+
+        for category, keywords in _CATEGORY_KEYWORDS.items():
             if any(keyword in query_lower for keyword in keywords):
                 return category
 
         return "общее"
 
+    def classify_query_category(self, query: str) -> str:
+        """Категория запроса (товар или тема) по ключевым словам, "общее" без совпадений"""
+        return self._classify_query_category(query)
+
+    def reclassify_batch(self, queries: List[str]) -> List[str]:
+        """
+        Категории для пакета запросов (офлайн-переклассификация истории)
+
+        Запросы в истории сильно повторяются - каждый уникальный текст
+        классифицируется один раз
+
+        Args:
+            queries: Тексты запросов
+
+        Returns:
+            Категории в порядке запросов
+        """
+        categories = {query: self._classify_query_category(query) for query in set(queries)}
+        return [categories[query] for query in queries]
+
     def _calculate_gap_priority(self, query: str) -> str:
         """Рассчитывает приоритет пробела в знаниях"""
         query_lower = query.lower()
 
         # Высокий приоритет - частые коммерческие запросы
-        high_priority_keywords = ["цена", "ціна", "стоимость", "купить", "заказать", "срочно"]
-        if any(keyword in query_lower for keyword in high_priority_keywords):
+        if _HIGH_PRIORITY_RE.search(query_lower):
             return "high"
 
         # Средний приоритет - информационные запросы
-        medium_priority_keywords = ["как", "что", "когда", "где", "почему"]
-        if any(keyword in query_lower for keyword in medium_priority_keywords):
+        if _MEDIUM_PRIORITY_RE.search(query_lower):
             return "medium"
 
         return "low"
 
     def get_analytics_summary(self, days: int = 7) -> Dict:
         """
-        Получает сводку аналитики за указанный период
+        Получает сводку аналитики за указанный период (сохраняется на _SUMMARY_TTL секунд)
 
         Args:
             days: Количество дней для анализа
@@ -230,50 +538,69 @@ class AnalyticsService:
         Returns:
             Словарь с аналитическими данными
         """
+        entry = self._summary_cache.get(days)
+        if entry is not None and time.monotonic() - entry[0] < _SUMMARY_TTL:
+            return entry[1]
+
+        summary = self._build_analytics_summary(days)
+        if "error" not in summary:
+            # Новый период - в конец, самый давно рассчитанный вытесняется
+            self._summary_cache.pop(days, None)
+            self._summary_cache[days] = (time.monotonic(), summary)
+            while len(self._summary_cache) > _SUMMARY_CACHE_SIZE:
+                self._summary_cache.pop(next(iter(self._summary_cache)), None)
+        return summary
+
+    def _build_analytics_summary(self, days: int) -> Dict:
+        """Считает сводку аналитики за период по базе данных"""
         try:
             # Общая статистика
             stats = self.db.get_stats()
 
-            # Статистика за период
-            with self.db._get_connection() as conn:
-                # Запросы за период
-                period_stats = conn.execute(
-                    """
+            # Статистика за период: выборка за период читается один раз, по ней считаются
+            # агрегаты, топ неотвеченных запросов и распределение по источникам (JSON)
+            with self.db._conn() as conn:
+                (
+                    total_queries,
+                    answered_queries,
+                    avg_confidence,
+                    avg_response_time,
+                    unanswered_json,
+                    sources_json,
+                ) = conn.execute(
+                    f"""
+                    WITH period AS {_MATERIALIZED} (
+                        SELECT query_text, source, is_answered, confidence, response_time_ms
+                        FROM user_queries
+                        WHERE timestamp >= CAST(strftime('%s', 'now') AS INTEGER) - ? * 86400
+                    )
                     SELECT
                         COUNT(*) as total_queries,
                         COUNT(CASE WHEN is_answered = 1 THEN 1 END) as answered_queries,
                         AVG(confidence) as avg_confidence,
-                        AVG(response_time_ms) as avg_response_time
-                    FROM user_queries
-                    WHERE timestamp >= datetime('now', '-' || ? || ' days')
+                        AVG(response_time_ms) as avg_response_time,
+                        (
+                            SELECT json_group_array(json_array(query_text, frequency))
+                            FROM (
+                                SELECT query_text, COUNT(*) as frequency
+                                FROM period
+                                WHERE is_answered = 0
+                                GROUP BY query_text
+                                ORDER BY frequency DESC
+                                LIMIT 10
+                            )
+                        ) as unanswered,
+                        (
+                            SELECT json_group_array(json_array(source, count))
+                            FROM (SELECT source, COUNT(*) as count FROM period GROUP BY source)
+                        ) as sources
+                    FROM period
                 """,
                     (days,),
                 ).fetchone()
 
-                # Топ неотвеченных запросов
-                unanswered = conn.execute(
-                    """
-                    SELECT query_text, COUNT(*) as frequency
-                    FROM user_queries
-                    WHERE is_answered = 0
-                    AND timestamp >= datetime('now', '-' || ? || ' days')
-                    GROUP BY query_text
-                    ORDER BY frequency DESC
-                    LIMIT 10
-                """,
-                    (days,),
-                ).fetchall()
-
-                # Распределение по источникам
-                sources = conn.execute(
-                    """
-                    SELECT source, COUNT(*) as count
-                    FROM user_queries
-                    WHERE timestamp >= datetime('now', '-' || ? || ' days')
-                    GROUP BY source
-                """,
-                    (days,),
-                ).fetchall()
+            unanswered = json.loads(unanswered_json)
+            sources = json.loads(sources_json)
 
             # Топ пробелов в знаниях
             top_gaps = self.db.get_knowledge_gaps(limit=10)
@@ -282,22 +609,21 @@ class AnalyticsService:
                 "period_days": days,
                 "overall_stats": stats,
                 "period_stats": {
-                    "total_queries": period_stats["total_queries"] or 0,
-                    "answered_queries": period_stats["answered_queries"] or 0,
+                    "total_queries": total_queries or 0,
+                    "answered_queries": answered_queries or 0,
                     "answer_rate": (
-                        (period_stats["answered_queries"] / period_stats["total_queries"] * 100)
-                        if period_stats["total_queries"] > 0
-                        else 0
+                        (answered_queries / total_queries * 100) if total_queries > 0 else 0
                     ),
-                    "avg_confidence": round(period_stats["avg_confidence"] or 0, 3),
-                    "avg_response_time_ms": round(period_stats["avg_response_time"] or 0, 1),
+                    "avg_confidence": round(avg_confidence or 0, 3),
+                    "avg_response_time_ms": round(avg_response_time or 0, 1),
                 },
                 "top_unanswered": [
-                    {"query": row["query_text"], "frequency": row["frequency"]}
-                    for row in unanswered
+                    {"query": query_text, "frequency": frequency}
+                    for query_text, frequency in unanswered
                 ],
+                "rejected_queries": dict(self.rejected_counts),
                 "source_distribution": [
-                    {"source": row["source"], "count": row["count"]} for row in sources
+                    {"source": source, "count": count} for source, count in sources
                 ],
                 "knowledge_gaps": [
                     {
@@ -315,24 +641,24 @@ class AnalyticsService:
             return {"error": str(e)}
 
     def get_improvement_suggestions(self) -> List[Dict]:
-        """Получает предложения по улучшению на основе аналитики"""
-        suggestions = []
+        """Получает предложения по улучшению на основе аналитики (сохраняются на _SUMMARY_TTL)"""
+        entry = self._suggestions_cache
+        if entry is not None and time.monotonic() - entry[0] < _SUMMARY_TTL:
+            return entry[1]
 
-        try:
-            # Анализируем топ пробелы в знаниях
-            gaps = self.db.get_knowledge_gaps(limit=20)
+        suggestions = self._build_improvement_suggestions()
+        self._suggestions_cache = (time.monotonic(), suggestions)
+        return suggestions
 
-            # Группируем по категориям
-            category_gaps = {}
-            for gap in gaps:
-                category = gap.category or "общее"
-                if category not in category_gaps:
-                    category_gaps[category] = []
-                category_gaps[category].append(gap)
+    def _build_improvement_suggestions(self) -> List[Dict]:
+        """Формирует предложения по улучшению по пробелам в знаниях и общей статистике"""
+        suggestions = []
 
-            # Генерируем предложения
-            for category, category_gaps_list in category_gaps.items():
-                total_frequency = sum(gap.frequency for gap in category_gaps_list)
+        try:
+            # Анализируем топ пробелы в знаниях, сгруппированные по категориям
+            for rollup in self.db.get_knowledge_gap_category_rollup(limit=20):
+                category = rollup["category"]
+                total_frequency = rollup["total_frequency"]
 
                 if total_frequency >= 5:  # Если категория проблемная
                     suggestions.append(
@@ -341,8 +667,8 @@ class AnalyticsService:
                             "category": category,
                             "priority": "high" if total_frequency >= 15 else "medium",
                             "description": f"Добавить больше информации по категории '{category}' "
-                            f"(найдено {len(category_gaps_list)} паттернов с {total_frequency} запросами)",
-                            "examples": [gap.query_pattern for gap in category_gaps_list[:3]],
+                            f"(найдено {rollup['patterns']} паттернов с {total_frequency} запросами)",
+                            "examples": rollup["examples"][:3],
                         }
                     )
 
@@ -9,18 +9,23 @@ from datetime import datetime, timedelta
 from typing import Dict, List
 
 try:
-    from flask import Flask, render_template_string, jsonify, request
+    from flask import Flask, Response, jsonify, request
 
     FLASK_AVAILABLE = True
 except ImportError:
     FLASK_AVAILABLE = False
 
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+
 from .analytics_service import analytics_service
 
 logger = logging.getLogger(__name__)
 
 
-# HTML шаблон для dashboard
+# Статическая страница dashboard: данные загружаются скриптом из /api/analytics
 DASHBOARD_HTML = """
 <!DOCTYPE html>
 <html>
@@ -55,19 +60,86 @@ DASHBOARD_HTML = """
                 .catch(error => console.error('Error:', error));
         }
 
+        function setText(id, value) {
+            document.getElementById(id).textContent = value;
+        }
+
+        // Заполняет список элементами из renderItem, или сообщением, если список пуст
+        function fillList(id, items, renderItem, emptyText) {
+            const list = document.getElementById(id);
+            list.replaceChildren();
+            if (!items || items.length === 0) {
+                if (emptyText) {
+                    list.appendChild(createItem('query-item', [emptyText]));
+                }
+                return;
+            }
+            items.forEach(item => list.appendChild(renderItem(item)));
+        }
+
+        // Строка списка: текст и элементы добавляются как узлы (без разбора HTML)
+        function createItem(className, children) {
+            const div = document.createElement('div');
+            div.className = className;
+            children.forEach(child => div.append(child));
+            return div;
+        }
+
+        function createElement(tag, text, style) {
+            const element = document.createElement(tag);
+            element.textContent = text;
+            if (style) {
+                element.style.cssText = style;
+            }
+            return element;
+        }
+
         function updateStats(data) {
+            if (data.error) {
+                setText('last-updated', 'Ошибка: ' + data.error);
+                return;
+            }
+
             // Обновляем статистику
             if (data.period_stats) {
-                document.getElementById('total-queries').textContent = data.period_stats.total_queries;
-                document.getElementById('answer-rate').textContent = data.period_stats.answer_rate.toFixed(1) + '%';
-                document.getElementById('avg-confidence').textContent = data.period_stats.avg_confidence.toFixed(3);
-                document.getElementById('response-time').textContent = data.period_stats.avg_response_time_ms.toFixed(0) + 'ms';
+                setText('period-days', data.period_days);
+                setText('total-queries', data.period_stats.total_queries);
+                setText('answer-rate', data.period_stats.answer_rate.toFixed(1) + '%');
+                setText('avg-confidence', data.period_stats.avg_confidence.toFixed(3));
+                setText('response-time', data.period_stats.avg_response_time_ms.toFixed(0) + 'ms');
             }
 
+            if (data.overall_stats) {
+                setText('overall-total-queries', data.overall_stats.total_queries);
+                setText('overall-knowledge-gaps', data.overall_stats.knowledge_gaps);
+                setText('overall-answer-rate', data.overall_stats.answer_rate.toFixed(1) + '%');
+                setText('overall-avg-confidence', data.overall_stats.avg_confidence.toFixed(3));
+            }
+
+            fillList('top-unanswered', data.top_unanswered, query => createItem('query-item', [
+                createElement('strong', query.query),
+                createElement('span', query.frequency + ' раз', 'float: right; color: #f44336;'),
+            ]), '✅ Нет неотвеченных запросов');
+
+            fillList('knowledge-gaps', data.knowledge_gaps, gap => createItem('query-item priority-' + gap.priority, [
+                createElement('strong', gap.pattern),
+                ' (' + gap.category + ')',
+                createElement('span', gap.frequency + ' раз', 'float: right;'),
+                createElement('div', 'Приоритет: ' + gap.priority, 'font-size: 0.9em; color: #666;'),
+            ]), '✅ Пробелы в знаниях не найдены');
+
+            fillList('source-distribution', data.source_distribution, source => createItem('query-item', [
+                createElement('strong', source.source || 'Неизвестно'),
+                createElement('span', source.count + ' запросов', 'float: right;'),
+            ]));
+
             // Обновляем timestamp
-            document.getElementById('last-updated').textContent = 'Обновлено: ' + new Date().toLocaleString();
+            setText('last-updated', 'Обновлено: ' + new Date().toLocaleString());
         }
 
+        // Данные загружаются сразу после загрузки страницы
+        document.addEventListener('DOMContentLoaded', refreshData);
+
         // Автообновление каждые 30 секунд
         setInterval(refreshData, 30000);
     </script>
@@ -75,28 +147,28 @@ DASHBOARD_HTML = """
 <body>
     <div class="container">
         <h1>🤖 AI Bot Analytics Dashboard</h1>
-        <p class="timestamp" id="last-updated">Обновлено: {{ timestamp }}</p>
+        <p class="timestamp" id="last-updated">Загрузка...</p>
 
         <button class="refresh-btn" onclick="refreshData()">🔄 Обновить данные</button>
 
         <!-- Основная статистика -->
         <div class="card">
-            <h2>📊 Статистика за {{ data.period_days }} дней</h2>
+            <h2>📊 Статистика за <span id="period-days">…</span> дней</h2>
             <div class="stats-grid">
                 <div class="stat-item">
-                    <div class="stat-value" id="total-queries">{{ data.period_stats.total_queries }}</div>
+                    <div class="stat-value" id="total-queries">–</div>
                     <div class="stat-label">Всего запросов</div>
                 </div>
                 <div class="stat-item">
-                    <div class="stat-value" id="answer-rate">{{ "%.1f"|format(data.period_stats.answer_rate) }}%</div>
+                    <div class="stat-value" id="answer-rate">–</div>
                     <div class="stat-label">Процент ответов</div>
                 </div>
                 <div class="stat-item">
-                    <div class="stat-value" id="avg-confidence">{{ "%.3f"|format(data.period_stats.avg_confidence) }}</div>
+                    <div class="stat-value" id="avg-confidence">–</div>
                     <div class="stat-label">Средняя уверенность</div>
                 </div>
                 <div class="stat-item">
-                    <div class="stat-value" id="response-time">{{ "%.0f"|format(data.period_stats.avg_response_time_ms) }}ms</div>
+                    <div class="stat-value" id="response-time">–</div>
                     <div class="stat-label">Время ответа</div>
                 </div>
             </div>
@@ -107,19 +179,19 @@ DASHBOARD_HTML = """
             <h2>📈 Общая статистика</h2>
             <div class="stats-grid">
                 <div class="stat-item">
-                    <div class="stat-value">{{ data.overall_stats.total_queries }}</div>
+                    <div class="stat-value" id="overall-total-queries">–</div>
                     <div class="stat-label">Всего запросов</div>
                 </div>
                 <div class="stat-item">
-                    <div class="stat-value">{{ data.overall_stats.knowledge_gaps }}</div>
+                    <div class="stat-value" id="overall-knowledge-gaps">–</div>
                     <div class="stat-label">Пробелы в знаниях</div>
                 </div>
                 <div class="stat-item">
-                    <div class="stat-value">{{ "%.1f"|format(data.overall_stats.answer_rate) }}%</div>
+                    <div class="stat-value" id="overall-answer-rate">–</div>
                     <div class="stat-label">Общий % ответов</div>
                 </div>
                 <div class="stat-item">
-                    <div class="stat-value">{{ "%.3f"|format(data.overall_stats.avg_confidence) }}</div>
+                    <div class="stat-value" id="overall-avg-confidence">–</div>
                     <div class="stat-label">Общая уверенность</div>
                 </div>
             </div>
@@ -128,45 +200,19 @@ DASHBOARD_HTML = """
         <!-- Топ неотвеченных запросов -->
         <div class="card">
             <h2>❓ Топ неотвеченных запросов</h2>
-            <div class="query-list">
-                {% for query in data.top_unanswered %}
-                <div class="query-item">
-                    <strong>{{ query.query }}</strong>
-                    <span style="float: right; color: #f44336;">{{ query.frequency }} раз</span>
-                </div>
-                {% endfor %}
-                {% if not data.top_unanswered %}
-                <div class="query-item">✅ Нет неотвеченных запросов</div>
-                {% endif %}
-            </div>
+            <div class="query-list" id="top-unanswered"></div>
         </div>
 
         <!-- Пробелы в знаниях -->
         <div class="card">
             <h2>🔍 Пробелы в знаниях</h2>
-            <div class="query-list">
-                {% for gap in data.knowledge_gaps %}
-                <div class="query-item priority-{{ gap.priority }}">
-                    <strong>{{ gap.pattern }}</strong> ({{ gap.category }})
-                    <span style="float: right;">{{ gap.frequency }} раз</span>
-                    <div style="font-size: 0.9em; color: #666;">Приоритет: {{ gap.priority }}</div>
-                </div>
-                {% endfor %}
-                {% if not data.knowledge_gaps %}
-                <div class="query-item">✅ Пробелы в знаниях не найдены</div>
-                {% endif %}
-            </div>
+            <div class="query-list" id="knowledge-gaps"></div>
         </div>
 
         <!-- Распределение по источникам -->
         <div class="card">
             <h2>📚 Источники ответов</h2>
-            {% for source in data.source_distribution %}
-            <div class="query-item">
-                <strong>{{ source.source or 'Неизвестно' }}</strong>
-                <span style="float: right;">{{ source.count }} запросов</span>
-            </div>
-            {% endfor %}
+            <div id="source-distribution"></div>
         </div>
     </div>
 </body>
@@ -187,6 +233,10 @@ class AnalyticsDashboard:
             return
 
         self.app = Flask(__name__)
+        # JSON ответов API (списки запросов и пробелов) хорошо сжимается gzip/br
+        if Compress is not None:
+            self.app.config["COMPRESS_MIN_SIZE"] = 512
+            Compress(self.app)
         self._setup_routes()
         logger.info(f"Analytics Dashboard инициализирован на {host}:{port}")
 
@@ -195,15 +245,8 @@ class AnalyticsDashboard:
 
         @self.app.route("/")
         def dashboard():
-            """Главная страница dashboard"""
-            try:
-                data = analytics_service.get_analytics_summary(days=7)
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                return render_template_string(DASHBOARD_HTML, data=data, timestamp=timestamp)
-            except Exception as e:
-                logger.error(f"Ошибка при получении данных для dashboard: {e}")
-                return f"Ошибка: {e}", 500
+            """Главная страница dashboard (статическая, данные загружает скрипт страницы)"""
+            return Response(DASHBOARD_HTML, mimetype="text/html")
 
         @self.app.route("/api/analytics")
         def api_analytics():
@@ -245,7 +288,7 @@ def create_simple_report() -> str:
         data = analytics_service.get_analytics_summary(days=7)
         suggestions = analytics_service.get_improvement_suggestions()
 
-        report = f"""
+        parts = [f"""
 📊 ОТЧЕТ ПО АНАЛИТИКЕ AI БОТА
 Дата: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
@@ -262,29 +305,31 @@ def create_simple_report() -> str:
 • Среднее время ответа: {data['period_stats']['avg_response_time_ms']:.0f}ms
 
 ❓ ТОП НЕОТВЕЧЕННЫХ ЗАПРОСОВ:
-"""
+"""]
 
         for i, query in enumerate(data["top_unanswered"][:5], 1):
-            report += f"{i}. {query['query']} ({query['frequency']} раз)\n"
+            parts.append(f"{i}. {query['query']} ({query['frequency']} раз)\n")
 
         if not data["top_unanswered"]:
-            report += "✅ Нет неотвеченных запросов\n"
+            parts.append("✅ Нет неотвеченных запросов\n")
 
-        report += "\n🔍 ПРОБЕЛЫ В ЗНАНИЯХ:\n"
+        parts.append("\n🔍 ПРОБЕЛЫ В ЗНАНИЯХ:\n")
         for i, gap in enumerate(data["knowledge_gaps"][:5], 1):
-            report += f"{i}. {gap['pattern']} (категория: {gap['category']}, приоритет: {gap['priority']}) - {gap['frequency']} раз\n"
+            parts.append(
+                f"{i}. {gap['pattern']} (категория: {gap['category']}, приоритет: {gap['priority']}) - {gap['frequency']} раз\n"
+            )
 
         if not data["knowledge_gaps"]:
-            report += "✅ Пробелы в знаниях не найдены\n"
+            parts.append("✅ Пробелы в знаниях не найдены\n")
 
-        report += "\n💡 ПРЕДЛОЖЕНИЯ ПО УЛУЧШЕНИЮ:\n"
+        parts.append("\n💡 ПРЕДЛОЖЕНИЯ ПО УЛУЧШЕНИЮ:\n")
         for i, suggestion in enumerate(suggestions[:3], 1):
-            report += f"{i}. [{suggestion['priority'].upper()}] {suggestion['description']}\n"
+            parts.append(f"{i}. [{suggestion['priority'].upper()}] {suggestion['description']}\n")
 
         if not suggestions:
-            report += "✅ Все работает отлично - предложений нет\n"
+            parts.append("✅ Все работает отлично - предложений нет\n")
 
-        return report
+        return "".join(parts)
 
     except Exception as e:
         logger.error(f"Ошибка при создании отчета: {e}")
@@ -3,17 +3,95 @@
 Определяет структуры для хранения информации о запросах пользователей
 """
 
+import functools
+import hashlib
+import json
+import queue
 import sqlite3
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Iterator, Optional, List, Dict, Tuple
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Сколько подключений к базе держит пул (потоки бота, поток записи аналитики, дашборд)
+_POOL_SIZE = 8
 
-@dataclass
+# Подготовленные запросы кешируются в подключении по тексту SQL; подключения пула
+# живут весь процесс, так что запросы аналитики компилируются по одному разу
+_CACHED_STATEMENTS = 128
+
+# Колонки, которые читают _row_to_user_query и _row_to_knowledge_gap (без SELECT *:
+# служебный context_hash не декодируется, текст контекста берется из context_blobs)
+_USER_QUERY_COLUMNS = """
+    q.id, q.user_id, q.query_text, q.language, q.timestamp,
+    q.ai_response, q.confidence, q.source, q.should_contact_manager,
+    q.context_used, q.search_type, q.relevance_scores,
+    q.is_answered, q.response_time_ms, b.text as context_text
+"""
+_KNOWLEDGE_GAP_COLUMNS = """
+    id, query_pattern, frequency, category, language,
+    priority, status, first_seen, last_seen
+"""
+
+# Таблицы, ID которых сервис аналитики резервирует для фоновой записи (reserve_ids)
+_RESERVABLE_TABLES = ("user_queries", "feedback_entries")
+
+# Как часто (секунды) обновлять статистику планировщика через PRAGMA optimize
+_OPTIMIZE_INTERVAL = 900.0
+
+# Сколько секунд отдается сохраненная общая статистика (сводка и предложения дашборда)
+_STATS_TTL = 30.0
+
+# Настройки каждого подключения: synchronous=NORMAL в режиме WAL синхронизирует диск
+# только на checkpoint, файл базы читается через mmap (до 256 МБ)
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+)
+
+# RETURNING поддерживается с SQLite 3.35; в более старых сборках запись и чтение
+# ее результата выполняются отдельными запросами
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+# Подсказка MATERIALIZED для CTE - тоже с SQLite 3.35
+SQLITE_HAS_MATERIALIZED_CTE = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Повтор пробела (паттерн и язык - уникальный ключ) увеличивает частоту существующей записи
+_SAVE_GAP_SQL = """
+    INSERT INTO knowledge_gaps (
+        query_pattern, frequency, category, language,
+        priority, status, first_seen, last_seen
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (query_pattern, language) DO UPDATE SET
+        frequency = frequency + 1,
+        last_seen = excluded.last_seen,
+        status = excluded.status
+"""
+_SAVE_GAP_RETURNING_SQL = _SAVE_GAP_SQL + "RETURNING id"
+
+# Версия схемы (PRAGMA user_version): 1 - время запросов в секундах Unix,
+# 2 - контекст ответа хранится в context_blobs по хешу,
+# 3 - время отзывов и пробелов в знаниях в секундах Unix
+_SCHEMA_VERSION = 3
+
+_CREATE_GAPS_UNIQUE_INDEX_SQL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_gaps_pattern_lang
+    ON knowledge_gaps(query_pattern, language)
+"""
+
+# Модели - dataclass со слотами (без __dict__ у экземпляров); slots=True требует Python 3.10+,
+# минимальная версия задана в requires-python (pyproject.toml)
+
+
+@dataclass(slots=True)
 class UserQuery:
     """Модель пользовательского запроса"""
 
@@ -43,7 +121,7 @@ class UserQuery:
             self.timestamp = datetime.now()
 
 
-@dataclass
+@dataclass(slots=True)
 class FeedbackEntry:
     """Модель пользовательского фидбека"""
 
@@ -59,7 +137,7 @@ class FeedbackEntry:
             self.timestamp = datetime.now()
 
 
-@dataclass
+@dataclass(slots=True)
 class KnowledgeGap:
     """Модель пробела в знаниях"""
 
@@ -86,20 +164,87 @@ class AnalyticsDatabase:
     def __init__(self, db_path: str = "./data/analytics.db"):
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Пул открытых подключений: PRAGMA применяются один раз при открытии,
+        # подключение используется одним потоком, пока оно взято из пула
+        self._pool: queue.Queue = queue.Queue()
+        self._pool_lock = threading.Lock()
+        self._opened = 0
+        # Время последнего PRAGMA optimize (выполняется при выдаче подключения из пула)
+        self._last_optimize = time.monotonic()
+        # Общая статистика: (время расчета, результат); сбрасывается записью через save_*,
+        # пачки фонового писателя сервиса аналитики отражаются в ней по истечении TTL
+        self._stats_cache: Optional[Tuple[float, Dict]] = None
 
         # Создаем таблицы при инициализации
         self._create_tables()
         logger.info(f"Analytics database инициализирована: {db_path}")
 
-    def _get_connection(self) -> sqlite3.Connection:
-        """Получает подключение к базе данных"""
-        conn = sqlite3.connect(self.db_path)
+    def _open_connection(self) -> sqlite3.Connection:
+        """Открывает подключение к базе данных"""
+        conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, cached_statements=_CACHED_STATEMENTS
+        )
         conn.row_factory = sqlite3.Row
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
         return conn
 
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        """
+        Берет подключение из пула на время транзакции (открывает новое, пока их
+        меньше _POOL_SIZE, иначе ждет свободное); при ошибке транзакция откатывается
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._opened < _POOL_SIZE
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._open_connection()
+                except Exception:
+                    with self._pool_lock:
+                        self._opened -= 1
+                    raise
+            else:
+                conn = self._pool.get()
+
+        now = time.monotonic()
+        if now - self._last_optimize > _OPTIMIZE_INTERVAL:
+            self._last_optimize = now
+            try:
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                logger.warning(f"PRAGMA optimize не выполнен: {e}")
+
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.put(conn)
+
+    def close(self):
+        """Закрывает свободные подключения пула"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self._pool_lock:
+                self._opened -= 1
+
     def _create_tables(self):
         """Создает таблицы в базе данных"""
-        with self._get_connection() as conn:
+        with self._conn() as conn:
+            # Режим WAL хранится в файле базы - достаточно включить один раз;
+            # WAL не блокирует чтение дашборда во время записи бота
+            if str(self.db_path) != ":memory:":
+                conn.execute("PRAGMA journal_mode=WAL")
+
             # Таблица пользовательских запросов
             conn.execute(
                 """
@@ -108,7 +253,7 @@ class AnalyticsDatabase:
                     user_id INTEGER NOT NULL,
                     query_text TEXT NOT NULL,
                     language VARCHAR(10) DEFAULT 'ukr',
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
 
                     ai_response TEXT,
                     confidence REAL DEFAULT 0.0,
@@ -116,6 +261,7 @@ class AnalyticsDatabase:
                     should_contact_manager BOOLEAN DEFAULT FALSE,
 
                     context_used TEXT,
+                    context_hash BLOB,
                     search_type VARCHAR(20),
                     relevance_scores TEXT,
 
@@ -134,13 +280,23 @@ class AnalyticsDatabase:
                     query_id INTEGER,
                     feedback_type VARCHAR(20) NOT NULL,
                     feedback_text TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
 
                     FOREIGN KEY (query_id) REFERENCES user_queries (id)
                 )
             """
             )
 
+            # Контекст ответов AI: один текст на хеш (контекст повторяется между ответами)
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS context_blobs (
+                    hash BLOB PRIMARY KEY,
+                    text TEXT NOT NULL
+                ) WITHOUT ROWID
+            """
+            )
+
             # Таблица пробелов в знаниях
             conn.execute(
                 """
@@ -152,8 +308,8 @@ class AnalyticsDatabase:
                     language VARCHAR(10) DEFAULT 'ukr',
                     priority VARCHAR(10) DEFAULT 'medium',
                     status VARCHAR(20) DEFAULT 'new',
-                    first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
+                    first_seen INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                    last_seen INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
                 )
             """
             )
@@ -166,15 +322,136 @@ class AnalyticsDatabase:
             conn.execute(
                 "CREATE INDEX IF NOT EXISTS idx_queries_is_answered ON user_queries(is_answered)"
             )
+            # Неотвеченные запросы за период (частичный индекс: только is_answered = 0).
+            # С равенством по is_answered в ключе планировщик выбирает его и без статистики,
+            # а не индекс по is_answered с сортировкой; прежний индекс по времени заменен им
+            conn.execute("DROP INDEX IF EXISTS idx_queries_unanswered_timestamp")
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_queries_unanswered
+                ON user_queries(is_answered, timestamp DESC) WHERE is_answered = 0
+            """
+            )
             conn.execute(
                 "CREATE INDEX IF NOT EXISTS idx_gaps_frequency ON knowledge_gaps(frequency)"
             )
+            # Уникальный паттерн на язык - ключ UPSERT пробелов в знаниях
+            try:
+                conn.execute(_CREATE_GAPS_UNIQUE_INDEX_SQL)
+            except sqlite3.IntegrityError:
+                self._merge_duplicate_gaps(conn)
+                conn.execute(_CREATE_GAPS_UNIQUE_INDEX_SQL)
+
+            self._migrate_schema(conn)
+
+            # Статистика для планировщика (собирается один раз, если ее еще нет), без нее SQLite
+            # выбирает индекс по is_answered вместо индексов по времени
+            has_stats = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+            ).fetchone()
+            if not has_stats:
+                conn.execute("ANALYZE")
+            # Обновляет статистику таблиц, заметно изменившихся с прошлого анализа
+            conn.execute("PRAGMA optimize")
 
             conn.commit()
 
+    def _migrate_schema(self, conn: sqlite3.Connection):
+        """Переводит базу старой версии на текущую схему"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            # Время запросов: ISO строки локального времени -> секунды Unix (UTC)
+            conn.execute(
+                """
+                UPDATE user_queries
+                SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                WHERE typeof(timestamp) = 'text'
+            """
+            )
+        if version < 2:
+            # Хеш контекста (в новых базах колонка уже создана в CREATE TABLE)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(user_queries)")}
+            if "context_hash" not in columns:
+                conn.execute("ALTER TABLE user_queries ADD COLUMN context_hash BLOB")
+        if version < 3:
+            # Время фидбека и пробелов в знаниях: ISO строки локального времени -> секунды Unix
+            conn.execute(
+                """
+                UPDATE feedback_entries
+                SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                WHERE typeof(timestamp) = 'text'
+            """
+            )
+            for column in ("first_seen", "last_seen"):
+                conn.execute(
+                    f"""
+                    UPDATE knowledge_gaps
+                    SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+                    WHERE typeof({column}) = 'text'
+                """
+                )
+        if version < _SCHEMA_VERSION:
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    @staticmethod
+    def context_digest(context_used: str) -> bytes:
+        """Хеш контекста ответа - ключ context_blobs (16 байт BLAKE2b)"""
+        return hashlib.blake2b(context_used.encode("utf-8"), digest_size=16).digest()
+
+    def _merge_duplicate_gaps(self, conn: sqlite3.Connection):
+        """Объединяет повторы пробелов (паттерн, язык) в первую запись, суммируя частоту"""
+        conn.execute(
+            """
+            UPDATE knowledge_gaps SET frequency = (
+                SELECT SUM(g.frequency) FROM knowledge_gaps g
+                WHERE g.query_pattern = knowledge_gaps.query_pattern
+                AND g.language = knowledge_gaps.language
+            )
+            WHERE id IN (
+                SELECT MIN(id) FROM knowledge_gaps
+                GROUP BY query_pattern, language
+                HAVING COUNT(*) > 1
+            )
+        """
+        )
+        deleted = conn.execute(
+            """
+            DELETE FROM knowledge_gaps WHERE id NOT IN (
+                SELECT MIN(id) FROM knowledge_gaps GROUP BY query_pattern, language
+            )
+        """
+        ).rowcount
+        logger.warning(f"Объединены повторяющиеся пробелы в знаниях: {deleted}")
+
+    def reserve_ids(self, table: str, count: int) -> range:
+        """
+        Резервирует count следующих ID таблицы с AUTOINCREMENT для записи с явным ID
+
+        Счетчик sqlite_sequence сдвигается в транзакции BEGIN IMMEDIATE, поэтому
+        зарезервированные ID не выдаст ни INSERT без ID (save_*), ни другой процесс
+        """
+        if table not in _RESERVABLE_TABLES:
+            raise ValueError(f"Таблица {table} не поддерживает резервирование ID")
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)
+            ).fetchone()
+            last_id = row["seq"] if row else 0
+            if row:
+                conn.execute(
+                    "UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (last_id + count, table)
+                )
+            else:
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, count)
+                )
+        return range(last_id + 1, last_id + count + 1)
+
     def save_user_query(self, query: UserQuery) -> int:
         """Сохраняет пользовательский запрос в базу данных"""
-        with self._get_connection() as conn:
+        self._stats_cache = None
+        with self._conn() as conn:
             cursor = conn.execute(
                 """
                 INSERT INTO user_queries (
@@ -188,7 +465,7 @@ class AnalyticsDatabase:
                     query.user_id,
                     query.query_text,
                     query.language,
-                    query.timestamp,
+                    int(query.timestamp.timestamp()),
                     query.ai_response,
                     query.confidence,
                     query.source,
@@ -205,7 +482,8 @@ class AnalyticsDatabase:
 
     def save_feedback(self, feedback: FeedbackEntry) -> int:
         """Сохраняет пользовательский фидбек"""
-        with self._get_connection() as conn:
+        self._stats_cache = None
+        with self._conn() as conn:
             cursor = conn.execute(
                 """
                 INSERT INTO feedback_entries (
@@ -217,66 +495,46 @@ class AnalyticsDatabase:
                     feedback.query_id,
                     feedback.feedback_type,
                     feedback.feedback_text,
-                    feedback.timestamp,
+                    int(feedback.timestamp.timestamp()),
                 ),
             )
             conn.commit()
             return cursor.lastrowid
 
     def save_knowledge_gap(self, gap: KnowledgeGap) -> int:
-        """Сохраняет или обновляет пробел в знаниях"""
-        with self._get_connection() as conn:
-            # Проверяем, есть ли уже такой паттерн
-            existing = conn.execute(
-                """
-                SELECT id, frequency FROM knowledge_gaps
-                WHERE query_pattern = ? AND language = ?
-            """,
+        """Сохраняет или обновляет пробел в знаниях (одним UPSERT по паттерну и языку)"""
+        self._stats_cache = None
+        with self._conn() as conn:
+            cursor = conn.execute(
+                _SAVE_GAP_RETURNING_SQL if SQLITE_HAS_RETURNING else _SAVE_GAP_SQL,
+                (
+                    gap.query_pattern,
+                    # Новая запись - первое появление пробела (частота по умолчанию в модели 0)
+                    max(gap.frequency, 1),
+                    gap.category,
+                    gap.language,
+                    gap.priority,
+                    gap.status,
+                    int(gap.first_seen.timestamp()),
+                    int(gap.last_seen.timestamp()),
+                ),
+            )
+            if SQLITE_HAS_RETURNING:
+                return cursor.fetchone()[0]
+            return conn.execute(
+                "SELECT id FROM knowledge_gaps WHERE query_pattern = ? AND language = ?",
                 (gap.query_pattern, gap.language),
-            ).fetchone()
-
-            if existing:
-                # Обновляем существующий
-                conn.execute(
-                    """
-                    UPDATE knowledge_gaps
-                    SET frequency = frequency + 1, last_seen = ?, status = ?
-                    WHERE id = ?
-                """,
-                    (gap.last_seen, gap.status, existing["id"]),
-                )
-                conn.commit()
-                return existing["id"]
-            else:
-                # Создаем новый
-                cursor = conn.execute(
-                    """
-                    INSERT INTO knowledge_gaps (
-                        query_pattern, frequency, category, language,
-                        priority, status, first_seen, last_seen
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                    (
-                        gap.query_pattern,
-                        gap.frequency,
-                        gap.category,
-                        gap.language,
-                        gap.priority,
-                        gap.status,
-                        gap.first_seen,
-                        gap.last_seen,
-                    ),
-                )
-                conn.commit()
-                return cursor.lastrowid
+            ).fetchone()[0]
 
     def get_recent_queries(self, limit: int = 100) -> List[UserQuery]:
         """Получает последние запросы"""
-        with self._get_connection() as conn:
+        with self._conn() as conn:
             rows = conn.execute(
-                """
-                SELECT * FROM user_queries
-                ORDER BY timestamp DESC
+                f"""
+                SELECT {_USER_QUERY_COLUMNS}
+                FROM user_queries q
+                LEFT JOIN context_blobs b ON b.hash = q.context_hash
+                ORDER BY q.timestamp DESC, q.id DESC
                 LIMIT ?
             """,
                 (limit,),
@@ -286,13 +544,15 @@ class AnalyticsDatabase:
 
     def get_unanswered_queries(self, days: int = 7) -> List[UserQuery]:
         """Получает неотвеченные запросы за последние N дней"""
-        with self._get_connection() as conn:
+        with self._conn() as conn:
             rows = conn.execute(
-                """
-                SELECT * FROM user_queries
-                WHERE is_answered = FALSE
-                AND timestamp >= datetime('now', '-' || ? || ' days')
-                ORDER BY timestamp DESC
+                f"""
+                SELECT {_USER_QUERY_COLUMNS}
+                FROM user_queries q
+                LEFT JOIN context_blobs b ON b.hash = q.context_hash
+                WHERE q.is_answered = 0
+                AND q.timestamp >= CAST(strftime('%s', 'now') AS INTEGER) - ? * 86400
+                ORDER BY q.timestamp DESC
             """,
                 (days,),
             ).fetchall()
@@ -301,10 +561,11 @@ class AnalyticsDatabase:
 
     def get_knowledge_gaps(self, limit: int = 50) -> List[KnowledgeGap]:
         """Получает топ пробелов в знаниях по частоте"""
-        with self._get_connection() as conn:
+        with self._conn() as conn:
             rows = conn.execute(
-                """
-                SELECT * FROM knowledge_gaps
+                f"""
+                SELECT {_KNOWLEDGE_GAP_COLUMNS}
+                FROM knowledge_gaps
                 ORDER BY frequency DESC
                 LIMIT ?
             """,
@@ -313,21 +574,78 @@ class AnalyticsDatabase:
 
             return [self._row_to_knowledge_gap(row) for row in rows]
 
+    def get_knowledge_gap_category_rollup(self, limit: int = 20) -> List[Dict]:
+        """
+        Сводка топ пробелов в знаниях по категориям (без категории - "общее"):
+        число паттернов, суммарная частота и паттерны по убыванию частоты.
+        Категории идут по убыванию частоты своего самого частого паттерна
+        """
+        with self._conn() as conn:
+            rows = conn.execute(
+                """
+                WITH top_gaps AS (
+                    SELECT query_pattern, frequency,
+                           COALESCE(NULLIF(category, ''), 'общее') as category
+                    FROM knowledge_gaps
+                    ORDER BY frequency DESC
+                    LIMIT ?
+                )
+                SELECT
+                    category,
+                    COUNT(*) as patterns,
+                    SUM(frequency) as total_frequency,
+                    json_group_array(json_array(frequency, query_pattern)) as examples
+                FROM top_gaps
+                GROUP BY category
+                ORDER BY MAX(frequency) DESC
+            """,
+                (limit,),
+            ).fetchall()
+
+        rollup = []
+        for category, patterns, total_frequency, examples_json in rows:
+            # Порядок внутри json_group_array не гарантирован - сортируем по частоте
+            examples = sorted(json.loads(examples_json), key=lambda item: -item[0])
+            rollup.append(
+                {
+                    "category": category,
+                    "patterns": patterns,
+                    "total_frequency": total_frequency,
+                    "examples": [pattern for _, pattern in examples],
+                }
+            )
+        return rollup
+
     def get_stats(self) -> Dict:
-        """Получает общую статистику"""
-        with self._get_connection() as conn:
-            total_queries = conn.execute("SELECT COUNT(*) as count FROM user_queries").fetchone()[
-                "count"
-            ]
-            answered_queries = conn.execute(
-                "SELECT COUNT(*) as count FROM user_queries WHERE is_answered = TRUE"
-            ).fetchone()["count"]
-            avg_confidence = conn.execute(
-                "SELECT AVG(confidence) as avg FROM user_queries WHERE confidence > 0"
-            ).fetchone()["avg"]
-            total_gaps = conn.execute("SELECT COUNT(*) as count FROM knowledge_gaps").fetchone()[
-                "count"
-            ]
+        """
+        Получает общую статистику (один проход по запросам и число пробелов);
+        результат сохраняется на _STATS_TTL секунд
+        """
+        entry = self._stats_cache
+        if entry is not None and time.monotonic() - entry[0] < _STATS_TTL:
+            return entry[1]
+
+        stats = self._build_stats()
+        self._stats_cache = (time.monotonic(), stats)
+        return stats
+
+    def _build_stats(self) -> Dict:
+        """Считает общую статистику"""
+        with self._conn() as conn:
+            row = conn.execute(
+                """
+                SELECT
+                    COUNT(*) as total_queries,
+                    COUNT(CASE WHEN is_answered = TRUE THEN 1 END) as answered_queries,
+                    AVG(CASE WHEN confidence > 0 THEN confidence END) as avg_confidence,
+                    (SELECT COUNT(*) FROM knowledge_gaps) as total_gaps
+                FROM user_queries
+            """
+            ).fetchone()
+            total_queries = row["total_queries"]
+            answered_queries = row["answered_queries"]
+            avg_confidence = row["avg_confidence"]
+            total_gaps = row["total_gaps"]
 
             return {
                 "total_queries": total_queries,
@@ -345,12 +663,13 @@ class AnalyticsDatabase:
             user_id=row["user_id"],
             query_text=row["query_text"],
             language=row["language"],
-            timestamp=datetime.fromisoformat(row["timestamp"]),
+            timestamp=datetime.fromtimestamp(row["timestamp"]),
             ai_response=row["ai_response"] or "",
             confidence=row["confidence"],
             source=row["source"] or "",
             should_contact_manager=bool(row["should_contact_manager"]),
-            context_used=row["context_used"] or "",
+            # Контекст по хешу, в записях до версии 2 схемы - в самой строке
+            context_used=row["context_text"] or row["context_used"] or "",
             search_type=row["search_type"] or "",
             relevance_scores=row["relevance_scores"] or "",
             is_answered=bool(row["is_answered"]),
@@ -367,10 +686,19 @@ class AnalyticsDatabase:
             language=row["language"],
             priority=row["priority"],
             status=row["status"],
-            first_seen=datetime.fromisoformat(row["first_seen"]),
-            last_seen=datetime.fromisoformat(row["last_seen"]),
+            first_seen=datetime.fromtimestamp(row["first_seen"]),
+            last_seen=datetime.fromtimestamp(row["last_seen"]),
         )
 
 
-# Глобальный экземпляр базы данных
-analytics_db = AnalyticsDatabase()
+@functools.cache
+def get_analytics_db() -> AnalyticsDatabase:
+    """Глобальный экземпляр базы данных (создается при первом обращении, не при импорте)"""
+    return AnalyticsDatabase()
+
+
+def __getattr__(name: str):
+    """Ленивый доступ к `analytics_db`: `from ... import analytics_db` работает как раньше"""
+    if name == "analytics_db":
+        return get_analytics_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
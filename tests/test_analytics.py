@@ -0,0 +1,531 @@
+"""
+Тесты для analytics
+Тестирование логирования запросов и ответов AI во временную базу данных
+"""
+
+import importlib
+from datetime import datetime
+
+import pytest
+
+from src.analytics.analytics_service import AnalyticsService
+from src.analytics.models import AnalyticsDatabase, FeedbackEntry, KnowledgeGap, UserQuery
+
+# Пакет src.analytics экспортирует экземпляр analytics_service под именем модуля
+analytics_service_module = importlib.import_module("src.analytics.analytics_service")
+models_module = importlib.import_module("src.analytics.models")
+
+
+class TestAnalyticsService:
+    """Тесты для сервиса аналитики"""
+
+    @pytest.fixture
+    def service(self, tmp_path) -> AnalyticsService:
+        """Fixture для сервиса с временной базой данных"""
+        service = AnalyticsService()
+        service.db = AnalyticsDatabase(str(tmp_path / "analytics.db"))
+        yield service
+        service.close()
+        service.db.close()
+
+    def test_connection_reused_with_wal(self, service) -> None:
+        """Тест пула подключений: подключение возвращается в пул, журнал в режиме WAL"""
+        with service.db._conn() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        with service.db._conn() as reused:
+            assert reused is conn
+            with service.db._conn() as other:
+                assert other is not conn
+
+    def test_log_answered_response(self, service) -> None:
+        """Тест ответа с высокой уверенностью: запрос отвечен, пробела в знаниях нет"""
+        query_id = service.log_user_query(1, "Ціна візиток?")
+        service.log_ai_response(query_id, "Від 200 грн", 0.9, "ai", relevance_scores=[0.9])
+        service.flush()
+
+        query = service.db.get_recent_queries()[0]
+        assert query.ai_response == "Від 200 грн"
+        assert query.is_answered
+        assert query.relevance_scores == "[0.9]"
+        assert service.db.get_knowledge_gaps() == []
+
+    def test_log_unanswered_response_creates_gap(self, service) -> None:
+        """Тест ответа с низкой уверенностью: запрос попадает в пробелы в знаниях"""
+        for _ in range(2):
+            query_id = service.log_user_query(1, "Скільки коштують 100 наклейки?")
+            service.log_ai_response(query_id, "", 0.2, "fallback")
+        service.flush()
+
+        gaps = service.db.get_knowledge_gaps()
+        assert len(gaps) == 1
+        assert gaps[0].query_pattern == "скільки коштують [ЧИСЛО] наклейки"
+        assert gaps[0].category == "наклейки"
+        assert gaps[0].frequency == 2
+
+    def test_writes_without_returning_support(self, service, monkeypatch) -> None:
+        """Тест SQLite до 3.35 (без RETURNING): ответы и пробелы пишутся отдельными запросами"""
+        monkeypatch.setattr(analytics_service_module, "SQLITE_HAS_RETURNING", False)
+        monkeypatch.setattr(models_module, "SQLITE_HAS_RETURNING", False)
+
+        for _ in range(2):
+            query_id = service.log_user_query(1, "Скільки коштують 100 наклейки?")
+            service.log_ai_response(query_id, "", 0.2, "fallback")
+        service.log_ai_response(999, "", 0.1, "fallback")
+        service.flush()
+
+        gaps = service.db.get_knowledge_gaps()
+        assert [(gap.query_pattern, gap.frequency) for gap in gaps] == [
+            ("скільки коштують [ЧИСЛО] наклейки", 2)
+        ]
+        assert service.db.save_knowledge_gap(KnowledgeGap(query_pattern=gaps[0].query_pattern)) == (
+            gaps[0].id
+        )
+
+    def test_response_context_stored_once(self, service) -> None:
+        """Тест контекста ответа: текст хранится один раз, в запросах - только хеш"""
+        for _ in range(2):
+            query_id = service.log_user_query(1, "ціна візиток")
+            service.log_ai_response(query_id, "Від 200 грн", 0.9, "ai", context_used="Прайс")
+        service.flush()
+
+        with service.db._conn() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM context_blobs").fetchone()[0] == 1
+            assert (
+                conn.execute(
+                    "SELECT COUNT(*) FROM user_queries"
+                    " WHERE context_used IS NOT NULL AND context_used != ''"
+                ).fetchone()[0]
+                == 0
+            )
+        assert [query.context_used for query in service.db.get_recent_queries()] == [
+            "Прайс",
+            "Прайс",
+        ]
+
+    def test_log_response_for_unknown_query(self, service) -> None:
+        """Тест ответа на несуществующий запрос: без ошибок и без пробелов"""
+        service.log_ai_response(999, "", 0.1, "fallback")
+        service.flush()
+
+        assert service.db.get_knowledge_gaps() == []
+
+    def test_query_ids_continue_after_restart(self, service) -> None:
+        """Тест ID запросов: выдаются сразу и продолжают последовательность после перезапуска"""
+        first_ids = [service.log_user_query(1, f"запит {i}") for i in range(3)]
+        service.close()
+
+        next_id = service.log_user_query(2, "новий запит")
+        service.flush()
+
+        assert first_ids == [1, 2, 3]
+        assert next_id == 4
+        assert [query.id for query in service.db.get_recent_queries()] == [4, 3, 2, 1]
+
+    def test_failed_batch_written_one_by_one(self, service) -> None:
+        """Тест ошибки в пачке: занятый ID теряет свой запрос и ответ, остальные пишутся"""
+        first_id = service.log_user_query(1, "перший")
+        service.flush()
+        # Запись с явным ID в обход резервирования занимает следующий ID блока сервиса
+        with service.db._conn() as conn:
+            conn.execute(
+                "INSERT INTO user_queries (id, user_id, query_text) VALUES (?, 2, 'напряму')",
+                (first_id + 1,),
+            )
+
+        taken_id = service.log_user_query(3, "другий")
+        service.log_ai_response(taken_id, "Відповідь для другого", 0.9, "ai")
+        next_id = service.log_user_query(3, "третій")
+        service.log_ai_response(next_id, "Відповідь", 0.9, "ai")
+        service.flush()
+
+        queries = {query.id: query for query in service.db.get_recent_queries()}
+        assert queries[taken_id].query_text == "напряму"
+        assert not queries[taken_id].ai_response
+        assert queries[next_id].query_text == "третій"
+        assert queries[next_id].ai_response == "Відповідь"
+
+    def test_two_services_share_database(self, service) -> None:
+        """Тест двух писателей одной базы: ID не пересекаются, ответы попадают в свои запросы"""
+        other = AnalyticsService()
+        other.db = AnalyticsDatabase(str(service.db.db_path))
+        try:
+            first_id = service.log_user_query(1, "запит A")
+            other_id = other.log_user_query(2, "запит B")
+            direct_id = service.db.save_user_query(UserQuery(user_id=3, query_text="напряму"))
+            service.log_ai_response(first_id, "відповідь для A", 0.9, "ai")
+            other.log_ai_response(other_id, "відповідь для B", 0.2, "fallback")
+            service.flush()
+            other.flush()
+        finally:
+            other.close()
+            other.db.close()
+
+        assert len({first_id, other_id, direct_id}) == 3
+        queries = {query.id: query for query in service.db.get_recent_queries()}
+        assert (queries[first_id].query_text, queries[first_id].ai_response) == (
+            "запит A",
+            "відповідь для A",
+        )
+        assert (queries[other_id].query_text, queries[other_id].ai_response) == (
+            "запит B",
+            "відповідь для B",
+        )
+        assert queries[direct_id].query_text == "напряму"
+        assert [gap.query_pattern for gap in service.db.get_knowledge_gaps()] == ["запит b"]
+
+    def test_feedback_written_in_background(self, service) -> None:
+        """Тест фидбека: ID выдается сразу, записи пишутся пачкой фонового потока"""
+        query_id = service.log_user_query(1, "ціна візиток")
+        feedback_ids = [
+            service.log_feedback(1, query_id, "helpful"),
+            service.log_feedback(2, None, "suggestion", "Додайте ціни на банери"),
+        ]
+        service.flush()
+
+        with service.db._conn() as conn:
+            rows = conn.execute(
+                "SELECT id, user_id, query_id, feedback_type, feedback_text"
+                " FROM feedback_entries ORDER BY id"
+            ).fetchall()
+
+        assert feedback_ids == [1, 2]
+        assert [tuple(row) for row in rows] == [
+            (1, 1, query_id, "helpful", ""),
+            (2, 2, None, "suggestion", "Додайте ціни на банери"),
+        ]
+
+    def test_feedback_ids_shared_with_other_writers(self, service) -> None:
+        """Тест фидбека двух писателей одной базы: каждая запись сохраняется под своим ID"""
+        other = AnalyticsService()
+        other.db = AnalyticsDatabase(str(service.db.db_path))
+        try:
+            query_id = service.log_user_query(1, "ціна візиток")
+            feedback_id = service.log_feedback(1, query_id, "helpful")
+            other_id = other.log_feedback(2, None, "not_helpful")
+            direct_id = service.db.save_feedback(
+                FeedbackEntry(user_id=3, feedback_type="suggestion")
+            )
+            service.flush()
+            other.flush()
+        finally:
+            other.close()
+            other.db.close()
+
+        with service.db._conn() as conn:
+            rows = conn.execute("SELECT id, user_id, query_id FROM feedback_entries").fetchall()
+
+        assert sorted(tuple(row) for row in rows) == sorted(
+            [(feedback_id, 1, query_id), (other_id, 2, None), (direct_id, 3, None)]
+        )
+
+    def test_feedback_for_failed_query_unlinked(self, service) -> None:
+        """Тест фидбека к незаписанному запросу: фидбек пишется без ссылки на чужую запись"""
+        first_id = service.log_user_query(1, "перший")
+        service.flush()
+        with service.db._conn() as conn:
+            conn.execute(
+                "INSERT INTO user_queries (id, user_id, query_text) VALUES (?, 2, 'напряму')",
+                (first_id + 1,),
+            )
+
+        taken_id = service.log_user_query(1, "ціна візиток")
+        feedback_id = service.log_feedback(1, taken_id, "helpful")
+        service.flush()
+
+        with service.db._conn() as conn:
+            row = conn.execute(
+                "SELECT user_id, query_id FROM feedback_entries WHERE id = ?", (feedback_id,)
+            ).fetchone()
+
+        assert tuple(row) == (1, None)
+
+    @pytest.mark.parametrize("use_automaton", [True, False])
+    def test_classify_query_category(self, use_automaton, monkeypatch) -> None:
+        """Тест категории запроса: при нескольких совпадениях - первая по порядку"""
+        if not use_automaton:
+            monkeypatch.setattr(analytics_service_module, "ahocorasick", None)
+        elif analytics_service_module.ahocorasick is None:
+            pytest.skip("pyahocorasick не установлен")
+        service = AnalyticsService()
+
+        assert service._classify_query_category("Яка ціна на ФУТБОЛКИ?") == "футболки"
+        assert service._classify_query_category("скільки коштує, швидко") == "цены"
+        assert service._classify_query_category("добрий день") == "общее"
+
+    def test_analytics_summary(self, service) -> None:
+        """Тест сводки за период: агрегаты, топ неотвеченных и распределение по источникам"""
+        for text, confidence, source in [
+            ("ціна візиток", 0.9, "ai"),
+            ("дизайн наклейок", 0.1, "fallback"),
+            ("дизайн наклейок", 0.2, "fallback"),
+        ]:
+            query_id = service.log_user_query(1, text)
+            service.log_ai_response(query_id, "", confidence, source)
+        service.flush()
+
+        summary = service.get_analytics_summary(days=7)
+
+        assert summary["period_stats"]["total_queries"] == 3
+        assert summary["period_stats"]["answered_queries"] == 1
+        assert summary["top_unanswered"] == [{"query": "дизайн наклейок", "frequency": 2}]
+        assert sorted(summary["source_distribution"], key=lambda item: item["source"]) == [
+            {"source": "ai", "count": 1},
+            {"source": "fallback", "count": 2},
+        ]
+
+    def test_analytics_summary_cached(self, service, monkeypatch) -> None:
+        """Тест кеша сводки: повторный запрос в пределах TTL не обращается к базе"""
+        first = service.get_analytics_summary(days=7)
+        service.log_user_query(1, "ціна візиток")
+        service.flush()
+
+        assert service.get_analytics_summary(days=7) is first
+        assert service.get_analytics_summary(days=1)["period_stats"]["total_queries"] == 1
+
+        monkeypatch.setattr(analytics_service_module, "_SUMMARY_TTL", 0.0)
+        assert service.get_analytics_summary(days=7)["period_stats"]["total_queries"] == 1
+
+    def test_analytics_summary_cache_bounded(self, service, monkeypatch) -> None:
+        """Тест кеша сводки: хранятся только последние _SUMMARY_CACHE_SIZE периодов"""
+        monkeypatch.setattr(analytics_service_module, "_SUMMARY_CACHE_SIZE", 2)
+        for days in (1, 2, 3):
+            service.get_analytics_summary(days=days)
+
+        assert list(service._summary_cache) == [2, 3]
+
+    def test_gap_priority_matches_word_forms(self, service) -> None:
+        """Тест приоритета пробела: ключевые слова находятся и в словоформах"""
+        assert service._calculate_gap_priority("Срочное оформление") == "high"
+        assert service._calculate_gap_priority("Какой формат?") == "medium"
+        assert service._calculate_gap_priority("добрий день") == "low"
+
+    def test_reclassify_batch(self, service) -> None:
+        """Тест пакетной классификации: порядок запросов сохраняется, повторы - та же категория"""
+        queries = ["ціна футболки", "привіт", "ціна футболки", "наклейки"]
+
+        assert service.reclassify_batch(queries) == ["футболки", "общее", "футболки", "наклейки"]
+        assert service.reclassify_batch([]) == []
+
+
+class TestAnalyticsDatabase:
+    """Тесты для базы данных аналитики"""
+
+    @pytest.mark.parametrize("model", [UserQuery, FeedbackEntry, KnowledgeGap])
+    def test_models_have_no_instance_dict(self, model) -> None:
+        """Тест моделей: поля в слотах, без __dict__ у каждого экземпляра"""
+        assert not hasattr(model(), "__dict__")
+
+    def test_global_database_opened_lazily(self, tmp_path, monkeypatch) -> None:
+        """Тест глобальной базы: создается при первом обращении, затем переиспользуется"""
+        monkeypatch.chdir(tmp_path)
+        models_module.get_analytics_db.cache_clear()
+        try:
+            service = AnalyticsService()
+            assert not (tmp_path / "data" / "analytics.db").exists()
+
+            db = service.db
+            assert (tmp_path / "data" / "analytics.db").exists()
+            assert models_module.analytics_db is db
+            assert models_module.get_analytics_db() is db
+            db.close()
+        finally:
+            models_module.get_analytics_db.cache_clear()
+
+    def test_periodic_optimize_on_checkout(self, tmp_path, monkeypatch) -> None:
+        """Тест PRAGMA optimize: выполняется при выдаче подключения раз в интервал"""
+        db = AnalyticsDatabase(str(tmp_path / "analytics.db"))
+        statements = []
+        with db._conn() as conn:
+            conn.set_trace_callback(statements.append)
+
+        with db._conn():
+            pass
+        assert "PRAGMA optimize" not in statements
+
+        monkeypatch.setattr(models_module, "_OPTIMIZE_INTERVAL", 0.0)
+        with db._conn():
+            pass
+        conn.set_trace_callback(None)
+        db.close()
+
+        assert statements.count("PRAGMA optimize") == 1
+
+    def test_duplicate_gaps_merged_on_open(self, tmp_path) -> None:
+        """Тест старой базы с повторами пробелов: повторы объединяются с суммой частот"""
+        db_path = str(tmp_path / "analytics.db")
+        db = AnalyticsDatabase(db_path)
+        with db._conn() as conn:
+            conn.execute("DROP INDEX idx_gaps_pattern_lang")
+            conn.executemany(
+                "INSERT INTO knowledge_gaps (query_pattern, frequency, language) VALUES (?, ?, ?)",
+                [("ціна", 2, "ukr"), ("ціна", 3, "ukr"), ("ціна", 1, "rus")],
+            )
+        db.close()
+
+        db = AnalyticsDatabase(db_path)
+        gaps = {(gap.language, gap.frequency) for gap in db.get_knowledge_gaps()}
+        db.close()
+
+        assert gaps == {("ukr", 5), ("rus", 1)}
+
+    def test_unanswered_queries_use_partial_index(self, tmp_path) -> None:
+        """Тест плана запроса неотвеченных: поиск по частичному индексу без сортировки"""
+        db = AnalyticsDatabase(str(tmp_path / "analytics.db"))
+        with db._conn() as conn:
+            plan = [
+                row["detail"]
+                for row in conn.execute(
+                    """
+                    EXPLAIN QUERY PLAN
+                    SELECT id FROM user_queries
+                    WHERE is_answered = 0
+                    AND timestamp >= CAST(strftime('%s', 'now') AS INTEGER) - ? * 86400
+                    ORDER BY timestamp DESC
+                """,
+                    (7,),
+                )
+            ]
+        db.close()
+
+        assert any("idx_queries_unanswered" in detail for detail in plan)
+        assert not any("TEMP B-TREE" in detail for detail in plan)
+
+    def test_save_knowledge_gap_upsert(self, tmp_path) -> None:
+        """Тест сохранения пробела: повтор паттерна на том же языке увеличивает частоту"""
+        db = AnalyticsDatabase(str(tmp_path / "analytics.db"))
+        gap = KnowledgeGap(query_pattern="ціна", category="цены")
+
+        first_id = db.save_knowledge_gap(gap)
+        assert db.save_knowledge_gap(gap) == first_id
+        other_id = db.save_knowledge_gap(KnowledgeGap(query_pattern="ціна", language="rus"))
+        gaps = {(gap.id, gap.language): gap.frequency for gap in db.get_knowledge_gaps()}
+        db.close()
+
+        assert other_id != first_id
+        assert gaps == {(first_id, "ukr"): 2, (other_id, "rus"): 1}
+
+    def test_get_stats(self, tmp_path) -> None:
+        """Тест общей статистики: доля ответов, средняя уверенность без нулевых, пробелы"""
+        db = AnalyticsDatabase(str(tmp_path / "analytics.db"))
+        assert db.get_stats() == {
+            "total_queries": 0,
+            "answered_queries": 0,
+            "unanswered_queries": 0,
+            "answer_rate": 0,
+            "avg_confidence": 0,
+            "knowledge_gaps": 0,
+        }
+
+        with db._conn() as conn:
+            conn.executemany(
+                "INSERT INTO user_queries (user_id, query_text, confidence, is_answered)"
+                " VALUES (1, ?, ?, ?)",
+                [("ціна", 0.9, True), ("дизайн", 0.3, False), ("привіт", 0.0, False)],
+            )
+        db.save_knowledge_gap(KnowledgeGap(query_pattern="дизайн", frequency=1))
+        stats = db.get_stats()
+        db.close()
+
+        assert stats == {
+            "total_queries": 3,
+            "answered_queries": 1,
+            "unanswered_queries": 2,
+            "answer_rate": pytest.approx(100 / 3),
+            "avg_confidence": 0.6,
+            "knowledge_gaps": 1,
+        }
+
+    def test_get_stats_cached(self, tmp_path, monkeypatch) -> None:
+        """Тест кеша статистики: повтор в пределах TTL без запроса, save_* сбрасывает кеш"""
+        db = AnalyticsDatabase(str(tmp_path / "analytics.db"))
+        first = db.get_stats()
+        with db._conn() as conn:
+            conn.execute("INSERT INTO user_queries (user_id, query_text) VALUES (1, 'ціна')")
+
+        assert db.get_stats() is first
+
+        db.save_knowledge_gap(KnowledgeGap(query_pattern="ціна", frequency=1))
+        stats = db.get_stats()
+        assert (stats["total_queries"], stats["knowledge_gaps"]) == (1, 1)
+
+        monkeypatch.setattr(models_module, "_STATS_TTL", 0.0)
+        with db._conn() as conn:
+            conn.execute("DELETE FROM knowledge_gaps")
+        assert db.get_stats()["knowledge_gaps"] == 0
+        db.close()
+
+    def test_knowledge_gap_category_rollup(self, tmp_path) -> None:
+        """Тест сводки пробелов по категориям: без категории - "общее", паттерны по частоте"""
+        db = AnalyticsDatabase(str(tmp_path / "analytics.db"))
+        with db._conn() as conn:
+            conn.executemany(
+                "INSERT INTO knowledge_gaps (query_pattern, frequency, category) VALUES (?, ?, ?)",
+                [("ціна", 2, "цены"), ("вартість", 7, "цены"), ("привіт", 4, "")],
+            )
+
+        rollup = db.get_knowledge_gap_category_rollup()
+        db.close()
+
+        assert rollup == [
+            {
+                "category": "цены",
+                "patterns": 2,
+                "total_frequency": 9,
+                "examples": ["вартість", "ціна"],
+            },
+            {"category": "общее", "patterns": 1, "total_frequency": 4, "examples": ["привіт"]},
+        ]
+
+    def test_text_timestamps_migrated_to_epoch(self, tmp_path) -> None:
+        """Тест старой базы: время запросов в ISO строках переводится в секунды Unix"""
+        db_path = str(tmp_path / "analytics.db")
+        db = AnalyticsDatabase(db_path)
+        with db._conn() as conn:
+            conn.execute(
+                "INSERT INTO user_queries (user_id, query_text, timestamp) VALUES (1, 'ціна', ?)",
+                ("2025-07-28 16:05:49.332038",),
+            )
+            conn.execute("PRAGMA user_version = 0")
+        db.close()
+
+        db = AnalyticsDatabase(db_path)
+        query = db.get_recent_queries()[0]
+        with db._conn() as conn:
+            stored = conn.execute("SELECT timestamp FROM user_queries").fetchone()[0]
+        db.close()
+
+        assert isinstance(stored, int)
+        assert query.timestamp == datetime(2025, 7, 28, 16, 5, 49)
+
+    def test_gap_and_feedback_timestamps_migrated_to_epoch(self, tmp_path) -> None:
+        """Тест старой базы: время фидбека и пробелов в ISO строках - в секунды Unix"""
+        db_path = str(tmp_path / "analytics.db")
+        db = AnalyticsDatabase(db_path)
+        with db._conn() as conn:
+            conn.execute(
+                "INSERT INTO knowledge_gaps (query_pattern, first_seen, last_seen)"
+                " VALUES ('ціна', ?, ?)",
+                ("2025-07-28 16:05:49.332038", "2025-07-29 10:00:00"),
+            )
+            conn.execute(
+                "INSERT INTO feedback_entries (user_id, feedback_type, timestamp)"
+                " VALUES (1, 'helpful', ?)",
+                ("2025-07-28 16:05:49",),
+            )
+            conn.execute("PRAGMA user_version = 2")
+        db.close()
+
+        db = AnalyticsDatabase(db_path)
+        gap = db.get_knowledge_gaps()[0]
+        with db._conn() as conn:
+            stored = conn.execute(
+                "SELECT typeof(first_seen), typeof(last_seen),"
+                " (SELECT typeof(timestamp) FROM feedback_entries)"
+                " FROM knowledge_gaps"
+            ).fetchone()
+        db.close()
+
+        assert tuple(stored) == ("integer", "integer", "integer")
+        assert gap.first_seen == datetime(2025, 7, 28, 16, 5, 49)
+        assert gap.last_seen == datetime(2025, 7, 29, 10, 0, 0)
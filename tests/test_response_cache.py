@@ -0,0 +1,119 @@
+"""
+Тесты для response_cache
+Тестирование точного и семантического кэша ответов AI
+"""
+
+import pytest
+
+from src.ai.response_cache import ResponseCache, normalize_query
+from src.analytics.analytics_service import AnalyticsService
+
+
+def fake_embedding_function(texts):
+    """Эмбеддинг по наличию ключевых слов - достаточно для проверки близости"""
+    vocabulary = ["візитки", "футболки", "ціна", "терміни"]
+    return [[1.0 if word in text else 0.0 for word in vocabulary] + [0.1] for text in texts]
+
+
+class TestResponseCache:
+    """Тесты для кэша ответов"""
+
+    def test_normalize_query(self) -> None:
+        """Тест нормализации регистра и пробелов"""
+        assert normalize_query("  Скільки   КОШТУЮТЬ\tвізитки ") == "скільки коштують візитки"
+
+    def test_exact_hit_ignores_case_and_spaces(self) -> None:
+        """Тест точного совпадения после нормализации"""
+        cache = ResponseCache()
+        cache.put(cache.make_key("Ціна візитки", "ukr"), {"answer": "50 грн"})
+
+        assert cache.get(cache.make_key("  ціна   ВІЗИТКИ", "ukr")) == {"answer": "50 грн"}
+        assert cache.get(cache.make_key("Ціна візитки", "rus")) is None
+
+    def test_exact_lru_eviction(self) -> None:
+        """Тест вытеснения наименее используемого ответа"""
+        cache = ResponseCache(max_size=2)
+        first = cache.make_key("перший", "ukr")
+        second = cache.make_key("другий", "ukr")
+        third = cache.make_key("третій", "ukr")
+
+        cache.put(first, {"answer": "1"})
+        cache.put(second, {"answer": "2"})
+        cache.get(first)
+        cache.put(third, {"answer": "3"})
+
+        assert cache.get(first) is not None
+        assert cache.get(second) is None
+        assert cache.get(third) is not None
+
+    @pytest.mark.asyncio
+    async def test_expired_answers_not_returned(self) -> None:
+        """Тест TTL: устаревший ответ не отдается ни точным, ни семантическим уровнем"""
+        cache = ResponseCache(ttl=0.0, embedding_function=fake_embedding_function)
+        key = cache.make_key("ціна візитки", "ukr")
+
+        _, embedding = await cache.get_similar("ціна візитки", "ukr")
+        cache.put(key, {"answer": "50 грн"}, embedding)
+
+        assert cache.get(key) is None
+        assert (await cache.get_similar("ціна візитки", "ukr"))[0] is None
+        assert cache.get_stats()["size"] == 0
+
+    @pytest.mark.asyncio
+    async def test_clear_drops_both_tiers(self) -> None:
+        """Тест очистки после обновления базы знаний"""
+        cache = ResponseCache(embedding_function=fake_embedding_function)
+        key = cache.make_key("ціна візитки", "ukr")
+        _, embedding = await cache.get_similar("ціна візитки", "ukr")
+        cache.put(key, {"answer": "50 грн"}, embedding)
+
+        cache.clear()
+
+        assert cache.get(key) is None
+        assert (await cache.get_similar("ціна візитки", "ukr"))[0] is None
+
+    @pytest.mark.asyncio
+    async def test_semantic_hit(self) -> None:
+        """Тест семантического совпадения близких формулировок"""
+        cache = ResponseCache(similarity_threshold=0.95, embedding_function=fake_embedding_function)
+
+        result, embedding = await cache.get_similar("ціна візитки", "ukr")
+        assert result is None
+        cache.put(cache.make_key("ціна візитки", "ukr"), {"answer": "50 грн"}, embedding)
+
+        result, _ = await cache.get_similar("яка ціна на візитки?", "ukr")
+        assert result == {"answer": "50 грн"}
+
+        result, _ = await cache.get_similar("терміни футболки", "ukr")
+        assert result is None
+
+    @pytest.mark.asyncio
+    async def test_semantic_match_only_within_product(self) -> None:
+        """Тест почти одинаковых вопросов о разных товарах: чужой ответ не отдается"""
+        cache = ResponseCache(
+            similarity_threshold=0.95,
+            embedding_function=fake_embedding_function,
+            scope_function=AnalyticsService().classify_query_category,
+        )
+
+        # Названия товаров не входят в словарь эмбеддинга - векторы запросов совпадают
+        _, probe = await cache.get_similar("ціна наклейки", "ukr")
+        cache.put(cache.make_key("ціна наклейки", "ukr"), {"answer": "Наклейки 30 грн"}, probe)
+
+        result, _ = await cache.get_similar("ціна блокноти", "ukr")
+        assert result is None
+
+        result, _ = await cache.get_similar("яка ціна наклейки?", "ukr")
+        assert result == {"answer": "Наклейки 30 грн"}
+
+    @pytest.mark.asyncio
+    async def test_semantic_disabled_on_embedding_error(self) -> None:
+        """Тест отключения семантического уровня при ошибке эмбеддинга"""
+
+        def broken_embedding_function(texts):
+            raise RuntimeError("model not available")
+
+        cache = ResponseCache(embedding_function=broken_embedding_function)
+
+        assert await cache.get_similar("ціна", "ukr") == (None, None)
+        assert cache.embedding_function is None
@@ -0,0 +1,156 @@
+"""
+Тесты для smart_knowledge_updater
+Тестирование обнаружения изменений в данных базы знаний
+"""
+
+import os
+import pytest
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from src.ai import smart_knowledge_updater
+from src.ai.smart_knowledge_updater import SmartKnowledgeUpdater
+
+
+class TestSmartKnowledgeUpdater:
+    """Тесты для умного обновления базы знаний"""
+
+    @pytest.fixture
+    def updater(self, temp_data_dir) -> SmartKnowledgeUpdater:
+        """Fixture для SmartKnowledgeUpdater с временным кешем изменений"""
+        updater = SmartKnowledgeUpdater()
+        updater.changes_cache_file = os.path.join(temp_data_dir, "changes_cache.json")
+        return updater
+
+    def test_content_hash(self, updater, sample_templates) -> None:
+        """Тест отпечатка контента: короткий и зависит только от содержимого"""
+        row = sample_templates[0]
+        content_hash = updater.generate_content_hash(row)
+
+        assert len(content_hash) == 16
+        assert content_hash == updater.generate_content_hash(dict(row))
+        assert content_hash != updater.generate_content_hash(dict(row, answer_ukr="Інший"))
+
+    def test_detect_changes(self, updater, sample_templates) -> None:
+        """Тест обнаружения добавленных, неизмененных и удаленных записей"""
+        changes = updater.detect_changes(sample_templates)
+        assert len(changes["added"]) == len(sample_templates)
+        assert not changes["unchanged"]
+
+        changes = updater.detect_changes(sample_templates)
+        assert not changes["added"]
+        assert len(changes["unchanged"]) == len(sample_templates)
+
+        changes = updater.detect_changes(sample_templates[:1])
+        assert len(changes["unchanged"]) == 1
+        assert len(changes["deleted"]) == len(sample_templates) - 1
+
+    def test_parallel_hashing_keeps_row_order(self, updater, sample_templates, monkeypatch) -> None:
+        """Тест хеширования в пуле потоков: результат совпадает с последовательным"""
+        rows = [
+            dict(row, keywords=f"{row['keywords']} {i}")
+            for i, row in enumerate(sample_templates * 4)
+        ]
+        expected = updater._compute_all_hashes(rows)
+
+        monkeypatch.setattr(smart_knowledge_updater, "_PARALLEL_HASH_MIN_ROWS", 1)
+        monkeypatch.setattr(smart_knowledge_updater.os, "cpu_count", lambda: 3)
+
+        assert updater._compute_all_hashes(rows) == expected
+
+    def test_changes_cache_reloaded_only_when_file_changes(self, updater) -> None:
+        """Тест кеша изменений в памяти: файл перечитывается только после его изменения"""
+        assert updater.load_changes_cache() == {"hashes": {}, "last_update": None}
+
+        updater.save_changes_cache({"hashes": {"a": "1"}})
+        assert updater.load_changes_cache() is updater.load_changes_cache()
+
+        with open(updater.changes_cache_file, "w", encoding="utf-8") as f:
+            f.write('{"hashes": {"b": "22"}, "last_update": null}')
+
+        assert updater.load_changes_cache()["hashes"] == {"b": "22"}
+
+    def test_repeated_analysis_keeps_pending_changes(self, updater, sample_templates) -> None:
+        """Тест повторного анализа тех же данных: изменения не теряются после записи кеша"""
+        strategy = updater.get_update_strategy_recommendation(sample_templates)
+        assert strategy["strategy"] == "full_reload"
+
+        changes = updater._detect_changes_cached([dict(row) for row in sample_templates])
+        assert changes is strategy["changes"]
+        assert len(changes["added"]) == len(sample_templates)
+
+    def test_apply_changes_batches_requests(self, updater, sample_templates) -> None:
+        """Тест применения изменений: одно удаление и одно добавление на весь набор"""
+        collection = Mock()
+        updater.knowledge_base = SimpleNamespace(is_initialized=True, collection=collection)
+        changes = {
+            "added": [{"id": "new", "data": sample_templates[0]}],
+            "modified": [{"id": "changed", "data": sample_templates[1]}],
+            "deleted": ["old"],
+        }
+
+        result = updater._apply_changes_to_chromadb(changes)
+
+        assert result["success"] and result["operations_count"] == 3
+        collection.delete.assert_called_once_with(ids=["old", "changed"])
+        collection.add.assert_called_once()
+        assert collection.add.call_args.kwargs["ids"] == ["new", "changed"]
+
+    def test_apply_changes_in_batches(self, updater, sample_templates, monkeypatch) -> None:
+        """Тест разбиения добавления документов на пачки"""
+        monkeypatch.setattr(smart_knowledge_updater, "_CHROMADB_WRITE_BATCH_SIZE", 1)
+        collection = Mock()
+        updater.knowledge_base = SimpleNamespace(is_initialized=True, collection=collection)
+        changes = {
+            "added": [{"id": f"new_{i}", "data": row} for i, row in enumerate(sample_templates)],
+            "modified": [],
+            "deleted": [],
+        }
+
+        result = updater._apply_changes_to_chromadb(changes)
+
+        assert result["operations_count"] == len(sample_templates)
+        assert collection.add.call_count == len(sample_templates)
+        collection.delete.assert_not_called()
+        added_ids = [call.kwargs["ids"] for call in collection.add.call_args_list]
+        assert added_ids == [[f"new_{i}"] for i in range(len(sample_templates))]
+
+    def test_deleted_admin_records_are_kept(self, updater, sample_templates) -> None:
+        """Тест сохранения админских записей среди удаленных (ID загружаются один раз)"""
+        admin_id = updater.detect_changes(sample_templates)["added"][1]["id"]
+
+        collection = Mock()
+        collection.get.return_value = {
+            "ids": [admin_id],
+            "metadatas": [{"source": "admin_correction"}],
+        }
+        updater.knowledge_base = SimpleNamespace(is_initialized=True, collection=collection)
+
+        changes = updater.detect_changes(sample_templates[:1])
+
+        assert changes["admin_kept"] == [admin_id]
+        assert changes["deleted"] == []
+
+        changes = updater.detect_changes([])
+        assert len(changes["deleted"]) == 1
+        collection.get.assert_called_once()
+
+    def test_unchanged_data_skips_row_comparison(self, updater, sample_templates) -> None:
+        """Тест короткого пути: те же данные не сравниваются построчно"""
+        first = updater.detect_changes(sample_templates)
+        expected_ids = [item["id"] for item in first["added"]]
+
+        updater._compute_all_hashes = Mock(side_effect=AssertionError("rows were hashed"))
+        changes = updater.detect_changes([dict(row) for row in sample_templates])
+
+        assert [item["id"] for item in changes["unchanged"]] == expected_ids
+        assert not changes["added"] and not changes["deleted"]
+
+    def test_fingerprint_distinguishes_missing_fields(self, updater, sample_templates) -> None:
+        """Тест отпечатка: отсутствующее поле отличается от пустого"""
+        row = dict(sample_templates[0])
+        row_without_sort_order = {k: v for k, v in row.items() if k != "sort_order"}
+
+        assert updater._data_fingerprint([dict(row, sort_order="")]) != updater._data_fingerprint(
+            [row_without_sort_order]
+        )
@@ -0,0 +1,236 @@
+"""
+Тесты для upselling_engine
+Тестирование определения триггеров и подбора upselling предложений
+"""
+
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from src.ai import upselling_engine
+from src.ai.upselling_engine import PriceFormatter, UpsellEngine, UpsellTriggerAnalyzer
+
+
+class TestUpsellTriggerAnalyzer:
+    """Тесты для анализатора триггеров"""
+
+    @pytest.fixture(params=["automaton", "fallback"])
+    def analyzer(self, request, monkeypatch) -> UpsellTriggerAnalyzer:
+        """Fixture для анализатора с автоматом Ахо-Корасик и без него"""
+        if request.param == "fallback":
+            monkeypatch.setattr(upselling_engine, "ahocorasick", None)
+        elif upselling_engine.ahocorasick is None:
+            pytest.skip("pyahocorasick не установлен")
+        return UpsellTriggerAnalyzer()
+
+    def test_keyword_triggers(self, analyzer) -> None:
+        """Тест контекстных триггеров: порядок как в trigger_keywords"""
+        triggers = analyzer.analyze_query_triggers("Срочно нужен дизайн, какая цена?")
+
+        assert triggers == ["price", "time", "design", "urgent"]
+
+    def test_overlapping_keywords(self, analyzer) -> None:
+        """Тест пересекающихся ключевых слов: срабатывают все их триггеры"""
+        triggers = analyzer.analyze_query_triggers("очень быстро, сколько дней?")
+
+        assert triggers == ["price", "time", "urgent"]
+
+    def test_behavioral_and_focus_triggers(self, analyzer) -> None:
+        """Тест поведенческих триггеров и фокуса клиента (цена важнее качества)"""
+        context = {"is_first_time": True, "previous_orders": 2}
+
+        triggers = analyzer.analyze_query_triggers("люкс", context)
+        assert triggers == ["premium", "first_time", "returning", "quality_focused"]
+
+        triggers = analyzer.analyze_query_triggers("люкс, но дешевле")
+        assert triggers[-1] == "price_sensitive"
+
+    def test_no_triggers(self, analyzer) -> None:
+        """Тест запроса без ключевых слов"""
+        assert analyzer.analyze_query_triggers("добрий день") == []
+
+    def test_cached_analysis_returns_fresh_list(self, analyzer) -> None:
+        """Тест кеша анализа: изменение результата не влияет на следующий вызов"""
+        first = analyzer.analyze_query_triggers("Цена макета ", {"previous_orders": 3})
+        first.append("mutated")
+
+        second = analyzer.analyze_query_triggers("цена МАКЕТА", {"previous_orders": 3})
+
+        assert second == ["price", "design", "returning"]
+        assert analyzer._analyze_cached.cache_info().hits == 1
+
+    def test_trigger_relevance(self, analyzer) -> None:
+        """Тест релевантности: сумма весов совпавших триггеров опции"""
+        relevance = analyzer.calculate_trigger_relevance("premium, quality,unknown", ["quality"])
+
+        assert relevance == pytest.approx(1.2)
+        assert analyzer.calculate_trigger_relevance("unknown", ["unknown"]) == 0.5
+        assert analyzer.calculate_trigger_relevance("", ["quality"]) == 0.0
+
+    def test_new_trigger_ids_unique_across_threads(self, analyzer) -> None:
+        """Тест ID новых триггеров из нескольких потоков: у каждого триггера свой бит"""
+        triggers = [f"custom_{i}" for i in range(200)]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            masks = list(executor.map(analyzer.trigger_mask, [[t] for t in triggers * 8]))
+
+        assert len(set(masks)) == len(triggers)
+        assert all(mask & (mask - 1) == 0 for mask in masks)
+        assert analyzer.calculate_trigger_relevance(",".join(triggers), triggers) == (
+            pytest.approx(0.5 * len(triggers))
+        )
+
+
+class TestPriceFormatter:
+    """Тесты для форматировщика цен"""
+
+    def test_format_prices(self) -> None:
+        """Тест подстановки цен: числа без дробной части, отсутствующие - 0"""
+        formatter = PriceFormatter()
+        answer = formatter.format_answer_with_prices(
+            "Від {base_price} грн, +{upsell_price} грн, разом {total_price} грн",
+            {"base_price": 150.0, "upsell_price": "50"},
+        )
+
+        assert answer == "Від 150 грн, +50 грн, разом 0 грн"
+
+    def test_other_braces_kept(self) -> None:
+        """Тест шаблона с посторонними фигурными скобками"""
+        formatter = PriceFormatter()
+        answer = formatter.format_answer_with_prices("{base_price} грн {акція}", {"base_price": 99})
+
+        assert answer == "99 грн {акція}"
+
+
+class TestUpsellEngine:
+    """Тесты для движка upselling"""
+
+    @pytest.fixture
+    def engine(self) -> UpsellEngine:
+        """Fixture для движка с фейковой базой знаний"""
+        category_metadatas = [
+            {"category": "визитки", "priority": 10, "answer_ukr": "Базова"},
+            {
+                "category": "визитки",
+                "priority": 3,
+                "upsell_trigger": "premium",
+                "answer_ukr": "Люкс",
+            },
+            {
+                "category": "визитки",
+                "priority": 1,
+                "upsell_trigger": "premium,quality",
+                "answer_ukr": "Тиснення +{upsell_price} грн, разом {total_price} грн",
+                "base_price": 200,
+                "upsell_price": 150,
+            },
+            {
+                "category": "визитки",
+                "priority": 5,
+                "upsell_trigger": "time",
+                "answer_ukr": "Терміново",
+            },
+        ]
+        collection = Mock()
+        collection.get.side_effect = lambda **kwargs: {
+            "metadatas": [dict(metadata) for metadata in category_metadatas]
+        }
+
+        engine = UpsellEngine()
+        engine.knowledge_base = SimpleNamespace(
+            is_initialized=True,
+            collection=collection,
+            search_knowledge=lambda query, language: [
+                {"answer": "Візитки від 200 грн", "metadata": {"category": "визитки"}}
+            ],
+        )
+        return engine
+
+    def test_search_with_upselling(self, engine) -> None:
+        """Тест поиска: базовый ответ и лучшие upselling опции по убыванию скора"""
+        results = engine.search_with_upselling("премиум визитки", max_upsell=2)
+
+        assert [r["answer"] for r in results] == [
+            "Візитки від 200 грн",
+            "Тиснення +150 грн, разом 350 грн",
+            "Люкс",
+        ]
+
+        analytics = engine.get_upselling_analytics(results)
+        assert analytics["base_results"] == 1
+        assert analytics["upsell_results"] == 2
+
+    def test_format_final_answer(self, engine) -> None:
+        """Тест финального ответа с блоком дополнительных возможностей"""
+        results = engine.search_with_upselling("премиум визитки", max_upsell=1)
+
+        assert engine.format_final_answer(results) == (
+            "Візитки від 200 грн\n\n✨ Додаткові можливості:\n• Тиснення +150 грн, разом 350 грн"
+        )
+
+    def test_separate_base_and_upsell_lists(self, engine) -> None:
+        """Тест финального ответа и аналитики по раздельным спискам результатов"""
+        results = engine.search_with_upselling("премиум визитки", max_upsell=1)
+        base_results, upsell_results = results[:1], results[1:]
+
+        assert engine.format_final_answer(
+            base_results, upsell_results=upsell_results
+        ) == engine.format_final_answer(results)
+
+        analytics = engine.get_upselling_analytics(base_results, upsell_results)
+        assert analytics["total_results"] == 2
+        assert analytics["upsell_ratio"] == 0.5
+        assert engine.format_final_answer([], upsell_results=[]) == ""
+
+    def test_category_results_cached(self, engine) -> None:
+        """Тест кеша записей категории: один запрос к ChromaDB до сброса кеша"""
+        engine.search_with_upselling("премиум визитки")
+        results = engine.search_with_upselling("премиум визитки")
+        collection = engine.knowledge_base.collection
+
+        assert collection.get.call_count == 1
+        assert results[1]["metadata"]["is_upselling"]
+        cached = engine._category_cache[("визитки", "ukr")][1].results
+        assert not any("is_upselling" in result["metadata"] for result in cached)
+
+        engine.invalidate_category_cache()
+        engine.search_with_upselling("премиум визитки")
+        assert collection.get.call_count == 2
+
+    def test_no_upsell_when_triggers_absent_in_category(self, engine) -> None:
+        """Тест триггеров, которых нет среди upselling записей категории"""
+        base_results = engine.knowledge_base.search_knowledge("", "ukr")
+
+        assert engine._find_upselling_options(base_results, ["design", "eco"], "ukr") == []
+        index = engine._category_cache[("визитки", "ukr")][1]
+        assert index.trigger_union == engine.trigger_analyzer.trigger_mask(
+            ["premium", "quality", "time"]
+        )
+
+    @pytest.mark.asyncio
+    async def test_search_with_upselling_async(self, engine) -> None:
+        """Тест асинхронного поиска: те же результаты, что и у синхронного"""
+        expected = engine.search_with_upselling("премиум визитки")
+        engine.invalidate_category_cache()
+
+        assert await engine.search_with_upselling_async("премиум визитки") == expected
+        assert await engine.search_with_upselling_async("премиум визитки") == expected
+        assert engine.knowledge_base.collection.get.call_count == 2
+
+    def test_engines_share_trigger_analyzer(self, engine) -> None:
+        """Тест общего анализатора триггеров для всех экземпляров движка"""
+        assert UpsellEngine().trigger_analyzer is engine.trigger_analyzer
+
+    def test_invalid_price_keeps_other_placeholders_formatted(self, engine) -> None:
+        """Тест нечисловой цены: остальные цены подставляются, общая цена = 0"""
+        results = engine._format_results_with_prices(
+            [
+                {
+                    "answer": "Від {base_price} грн, разом {total_price} грн",
+                    "metadata": {"base_price": 200, "upsell_price": "уточнюйте"},
+                }
+            ]
+        )
+
+        assert results[0]["answer"] == "Від 200 грн, разом 0 грн"